@@ -0,0 +1,575 @@
+"""
+array_ops.py
+============
+
+manga_processor.py / frame_separation.py / balloon_detect.py で共通に使う
+NumPy ベースの配列演算群
+
+C++版から移植した画素単位のループ処理を、同じ判定結果を保ったまま
+配列演算に置き換えたもの。
+"""
+
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import cv2
+import numpy as np
+
+# コマとみなすバウンディングボックスの面積の下限（ページ面積との比、C++の judgeAreaOfBoundingBox() と同じ）
+PANEL_AREA_RATIO = 0.048
+
+
+def _page_bands(binary_img: np.ndarray, black_length_th: int) -> Tuple[np.ndarray, ...]:
+    """
+    ページ分類で調べる上端・下端・右端・左端の帯をこの順に返す
+    範囲はC++版のループ範囲と同じで、コピーしないようにスライスのビューで返す
+    （帯の中の走査順は判定に影響しない）
+    """
+    h, w = binary_img.shape[:2]
+    return (binary_img[3:black_length_th, :],                # 上端
+            binary_img[h - black_length_th + 1:h - 2, :],    # 下端
+            binary_img[:, w - black_length_th + 1:w - 2],    # 右端
+            binary_img[:, 3:black_length_th])                # 左端
+
+
+def is_black_page_bands(binary_img: np.ndarray, black_length_th: int = 5) -> bool:
+    """
+    二値化済みページの端の帯からページ種別を判定
+    いずれかの帯が全て黒(0)なら黒ページ(True)、そうでなければ白ページ(False)
+    C++の ClassificationPage::get_page_type() の判定部分に相当
+    """
+    # 帯はビューのままOpenCVに渡し、非0画素が見つかった時点で打ち切る
+    for band in _page_bands(binary_img, black_length_th):
+        if not cv2.hasNonZero(band):
+            return True
+    return False
+
+
+def projection_profile(binary_img: np.ndarray, border: int = 2,
+                       x_border: Optional[Tuple[int, int]] = None,
+                       y_border: Optional[Tuple[int, int]] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    非0画素の射影ヒストグラム（列方向・行方向）を1回の走査で求める
+    C++版と同様に、端から border 画素以内（x<=border, x>=w-border など）は除外する
+    x_border / y_border を指定した場合は、列・行ごとに除外する画素数を (先頭, 末尾) で指定する
+    （FrameDetector は (3, 3) と (0, 0)。省略時は (border + 1, border)）
+    戻り値: (列ごとのカウント[w], 行ごとのカウント[h])
+    """
+    h, w = binary_img.shape[:2]
+    x0, x1 = x_border if x_border is not None else (border + 1, border)
+    y0, y1 = y_border if y_border is not None else (border + 1, border)
+    histogram_x = np.zeros(w, dtype=np.int64)
+    histogram_y = np.zeros(h, dtype=np.int64)
+
+    inner = binary_img[y0:h - y1, x0:w - x1] != 0
+    if inner.size:
+        histogram_x[x0:w - x1] = np.count_nonzero(inner, axis=0)
+        histogram_y[y0:h - y1] = np.count_nonzero(inner, axis=1)
+
+    return histogram_x, histogram_y
+
+
+def profile_extent(histogram: np.ndarray, snap: float = 6,
+                   exclusive_end: bool = False) -> Tuple[int, int]:
+    """
+    ヒストグラムの最初と最後の非0位置を求め、端から snap 画素未満なら端に寄せる
+    exclusive_end=True なら最後の非0位置の次を終端とする（FrameDetector と同じ）
+    非0位置がない場合は (0, n-1) を返す（C++版の初期値と同じ）
+    """
+    n = len(histogram)
+    nonzero = np.flatnonzero(histogram)
+    min_pos = int(nonzero[0]) if nonzero.size else 0
+    max_pos = int(nonzero[-1]) + int(exclusive_end) if nonzero.size else n - 1
+
+    # 誤差は両端に寄せる
+    if min_pos < snap:
+        min_pos = 0
+    if max_pos > n - snap:
+        max_pos = n
+
+    return min_pos, max_pos
+
+
+def half_plane_mask(a: float, b: float, y2x: bool, side: int,
+                    xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """
+    直線 y = a*x + b（y2x=True なら x = a*y + b）に対して、
+    Line.judge_area() が side（0=上/右側, 1=下/左側）を返す画素を True にしたマスク
+    xs は (1, w)、ys は (h, 1) の座標配列を渡し、(h, w) に展開して判定する
+    """
+    if y2x:
+        xs, ys = ys, xs
+    value = a * xs + b
+    if side == 0:
+        return ys > value
+    return ys < value
+
+
+def _edge_kernel(px_th: int, diagonal: bool) -> np.ndarray:
+    """中心から上下左右（diagonal=True なら斜めも）px_th 画素までを1にしたカーネル"""
+    size = 2 * px_th + 1
+    kernel = np.zeros((size, size), dtype=np.uint8)
+    kernel[px_th, :] = 1
+    kernel[:, px_th] = 1
+    if diagonal:
+        np.fill_diagonal(kernel, 1)
+        np.fill_diagonal(np.fliplr(kernel), 1)
+    return kernel
+
+
+def false_balloon_counts(balloon_img: np.ndarray, px_th: int = 5,
+                         diagonal: bool = False) -> Tuple[int, int]:
+    """
+    吹き出し誤検出除去用の黒画素カウント
+    C++版の画素ループと同じく、画像端から px_th 画素以内、または px_th 画素以内に
+    透明画素がある不透明画素を「エッジ」としてマークし、
+    エッジに4近傍で接する黒画素数と、エッジ以外の黒画素数を求める
+    diagonal=True の場合は透明画素の探索に斜め方向も含める（balloon_detect.py版）
+    戻り値: (edge_black_count, black_count)
+    """
+    h, w = balloon_img.shape[:2]
+
+    # BGRAをグレースケールに変換して二値化（150以下が黒）
+    gray_balloon = cv2.cvtColor(balloon_img, cv2.COLOR_BGRA2GRAY)
+    is_black = gray_balloon <= 150
+    opaque = balloon_img[:, :, 3] != 0
+
+    # 画像端から px_th 以内
+    near_border = np.zeros((h, w), dtype=bool)
+    near_border[:px_th + 1, :] = True
+    near_border[max(h - px_th, 0):, :] = True
+    near_border[:, :px_th + 1] = True
+    near_border[:, max(w - px_th, 0):] = True
+
+    # px_th 画素以内に透明画素がある（膨張で一括判定）
+    transparent = (~opaque).astype(np.uint8)
+    near_transparent = cv2.dilate(transparent, _edge_kernel(px_th, diagonal)).astype(bool)
+
+    # エッジのマーク（不透明画素のみ）
+    marked = opaque & (near_border | near_transparent)
+
+    # マークと4近傍で接しているか（シフトした配列の論理和）
+    padded = np.pad(marked, 1, constant_values=False)
+    adjacent_to_marked = (padded[:-2, 1:-1] | padded[2:, 1:-1] |
+                          padded[1:-1, :-2] | padded[1:-1, 2:])
+
+    # マークされた画素は黒として数えない
+    black = opaque & ~marked & is_black
+    edge_black_count = int(np.count_nonzero(black & adjacent_to_marked))
+    black_count = int(np.count_nonzero(black))
+
+    return edge_black_count, black_count
+
+
+def contour_features(contours: Sequence[np.ndarray]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    輪郭群の面積・周囲長・バウンディングボックスを一括で計算
+    全輪郭の点列を連結し、輪郭ごとの区間で集計する
+    面積は cv2.contourArea、周囲長は cv2.arcLength(closed=True)、
+    バウンディングボックスは cv2.boundingRect と同じ値になる
+    （周囲長は OpenCV と同じく各辺の長さを float32 で求めてから合計）
+    戻り値: (areas[n], perimeters[n], bboxes[n, 4] (x, y, w, h))
+    """
+    n = len(contours)
+    if n == 0:
+        return np.zeros(0), np.zeros(0), np.zeros((0, 4), dtype=np.int64)
+
+    lengths = np.fromiter((len(cnt) for cnt in contours), dtype=np.int64, count=n)
+    starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    points = np.concatenate(contours).reshape(-1, 2).astype(np.int64)
+
+    # 各点の直前の点（閉曲線として先頭の直前は末尾）
+    prev_idx = np.arange(len(points)) - 1
+    prev_idx[starts] = starts + lengths - 1
+    x, y = points[:, 0], points[:, 1]
+    prev_x, prev_y = x[prev_idx], y[prev_idx]
+
+    # 面積（台形公式）
+    cross = prev_x * y - prev_y * x
+    areas = np.abs(np.add.reduceat(cross, starts)) * 0.5
+
+    # 周囲長
+    dx = (x - prev_x).astype(np.float32)
+    dy = (y - prev_y).astype(np.float32)
+    segment = np.sqrt(dx * dx + dy * dy).astype(np.float64)
+    perimeters = np.add.reduceat(segment, starts)
+    perimeters[lengths <= 1] = 0.0
+
+    # バウンディングボックス
+    min_x = np.minimum.reduceat(x, starts)
+    min_y = np.minimum.reduceat(y, starts)
+    bboxes = np.stack([min_x, min_y,
+                       np.maximum.reduceat(x, starts) - min_x + 1,
+                       np.maximum.reduceat(y, starts) - min_y + 1], axis=1)
+
+    return areas, perimeters, bboxes
+
+
+def contour_bw_counts(gray: np.ndarray, contour: np.ndarray,
+                      bbox: Tuple[int, int, int, int], th: int = 255 // 3) -> Tuple[int, int]:
+    """
+    バウンディングボックス内で、輪郭（太さ4の線と内部）に覆われていない画素の
+    黒画素数(gray < th)と白画素数(gray > 255 - th)を求める
+    マスクはバウンディングボックスの大きさだけ確保する
+    戻り値: (black, white)
+    """
+    x, y, w, h = bbox
+    mask = np.full((h, w), 255, dtype=np.uint8)
+    cv2.drawContours(mask, [contour], -1, 0, 4, offset=(-x, -y))
+    cv2.drawContours(mask, [contour], -1, 0, -1, offset=(-x, -y))
+
+    roi = gray[y:y+h, x:x+w]
+    uncovered = mask != 0
+    black = int(np.count_nonzero(uncovered & (roi < th)))
+    white = int(np.count_nonzero(uncovered & (roi > 255 - th)))
+    return black, white
+
+
+def contour_depths(parents: np.ndarray) -> np.ndarray:
+    """輪郭階層の親インデックス列から各輪郭の深さ（最外周=0）を求める"""
+    depths = np.zeros(len(parents), dtype=np.int64)
+    ancestors = parents.copy()
+    while True:
+        has_ancestor = ancestors >= 0
+        if not has_ancestor.any():
+            return depths
+        depths[has_ancestor] += 1
+        ancestors[has_ancestor] = parents[ancestors[has_ancestor]]
+
+
+def prune_hole_contours(hierarchy: Optional[np.ndarray],
+                        candidates: np.ndarray) -> Tuple[np.ndarray, int]:
+    """
+    cv2.findContours(RETR_TREE) の階層情報から、候補のうち奇数深さの輪郭
+    （白領域の穴 = 文字や枠線の内側の輪郭）を除外する
+    戻り値: (除外後の候補マスク, 除外数)
+    """
+    keep = candidates.copy()
+    if hierarchy is None or len(keep) == 0:
+        return keep, 0
+    parents = np.asarray(hierarchy).reshape(-1, 4)[:, 3]
+    holes = keep & (contour_depths(parents) % 2 == 1)
+    keep &= ~holes
+    return keep, int(np.count_nonzero(holes))
+
+
+def nearest_candidate_ancestors(hierarchy: Optional[np.ndarray], candidates: np.ndarray) -> np.ndarray:
+    """各候補について、最も近い祖先の候補のインデックス（なければ -1）を求める"""
+    nearest = np.full(len(candidates), -1, dtype=np.int64)
+    if hierarchy is None or len(candidates) == 0:
+        return nearest
+    parents = np.asarray(hierarchy).reshape(-1, 4)[:, 3]
+    ancestors = parents.copy()
+    pending = candidates.copy()
+    while True:
+        active = np.flatnonzero(pending & (ancestors >= 0))
+        if active.size == 0:
+            return nearest
+        found = candidates[ancestors[active]]
+        nearest[active[found]] = ancestors[active[found]]
+        pending[active[found]] = False
+        missed = active[~found]
+        ancestors[missed] = parents[ancestors[missed]]
+
+
+def candidate_children(hierarchy: Optional[np.ndarray], candidates: np.ndarray) -> Dict[int, List[int]]:
+    """候補ごとの、最も近い祖先がその候補である候補のリスト（候補の入れ子の木）"""
+    nearest = nearest_candidate_ancestors(hierarchy, candidates)
+    children: Dict[int, List[int]] = {}
+    for child in np.flatnonzero(nearest >= 0):
+        children.setdefault(int(nearest[child]), []).append(int(child))
+    return children
+
+
+def is_duplicate_contour(idx: int, children: Dict[int, List[int]], areas: np.ndarray,
+                         passes: Callable[[int], bool], dup_ratio: float = 0.8) -> bool:
+    """
+    候補 idx の内側で最も近い、passes() を満たす候補のどれかの面積が dup_ratio 以上なら True
+    （同じ吹き出しの二重線・重複リングの外側）
+    passes() は内側へたどる途中の候補についてだけ呼ぶので、高価な判定を必要な候補に限れる
+    """
+    stack = list(children.get(idx, ()))
+    while stack:
+        child = stack.pop()
+        if passes(child):
+            if areas[child] >= dup_ratio * areas[idx]:
+                return True
+        else:
+            stack.extend(children.get(child, ()))
+    return False
+
+
+def prune_nested_contours(hierarchy: Optional[np.ndarray], areas: np.ndarray,
+                          candidates: np.ndarray,
+                          dup_ratio: float = 0.8) -> Tuple[np.ndarray, Dict[str, int]]:
+    """
+    cv2.findContours(RETR_TREE) の階層情報を使って吹き出し候補を間引く
+
+    - hole: 奇数深さの輪郭（白領域の穴 = 文字や枠線の内側の輪郭）は除外（prune_hole_contours()）
+    - duplicate: 候補の中に面積が dup_ratio 以上の候補が入れ子になっている場合、
+      外側の候補は同じ吹き出しの二重線・重複リングとみなして除外し、最も内側を残す
+
+    戻り値: (間引き後の候補マスク, ルールごとの除外数)
+    """
+    keep, holes = prune_hole_contours(hierarchy, candidates)
+    stats = {"hole": holes, "duplicate": 0}
+    if hierarchy is None or len(areas) == 0:
+        return keep, stats
+
+    # 面積がほぼ同じ候補を内側に持つ候補を除外
+    nearest = nearest_candidate_ancestors(hierarchy, keep)
+    inner = np.flatnonzero(nearest >= 0)
+    similar = inner[areas[inner] >= dup_ratio * areas[nearest[inner]]]
+    duplicates = np.zeros(len(areas), dtype=bool)
+    duplicates[nearest[similar]] = True
+    stats["duplicate"] = int(np.count_nonzero(duplicates))
+    keep &= ~duplicates
+
+    return keep, stats
+
+
+def locate_in_bboxes(bboxes: np.ndarray, xs: np.ndarray, ys: np.ndarray) -> np.ndarray:
+    """
+    点群 (xs, ys) のそれぞれを含むバウンディングボックス (x, y, w, h) を検索
+    複数のボックスに含まれる場合は面積が最小のものを返す
+    1ページのコマ数は少ないため、面積順に並べたボックスと全点を一括で比較する
+    戻り値: 各点を含むボックスのインデックス（含むものがなければ -1）
+    """
+    owners = np.full(len(xs), -1, dtype=np.int64)
+    if len(bboxes) == 0 or len(xs) == 0:
+        return owners
+
+    bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+    order = np.argsort(bboxes[:, 2] * bboxes[:, 3], kind="stable")
+    x0, y0 = bboxes[order, 0], bboxes[order, 1]
+    x1, y1 = x0 + bboxes[order, 2], y0 + bboxes[order, 3]
+
+    xs = np.asarray(xs)[:, np.newaxis]
+    ys = np.asarray(ys)[:, np.newaxis]
+    inside = (x0 <= xs) & (xs < x1) & (y0 <= ys) & (ys < y1)
+
+    found = inside.any(axis=1)
+    owners[found] = order[inside[found].argmax(axis=1)]
+    return owners
+
+
+def _hough_close(rho_a: np.ndarray, theta_a: np.ndarray, rho_b: np.ndarray, theta_b: np.ndarray,
+                 rho_tol: float, theta_tol: float) -> np.ndarray:
+    """直線 a と直線 b の組ごとに近接しているかを返す（(len(a), len(b)) の真偽値配列）"""
+    d_theta = np.abs(theta_a[:, np.newaxis] - theta_b)
+    close = (np.abs(rho_a[:, np.newaxis] - rho_b) <= rho_tol) & (d_theta <= theta_tol)
+    # theta = 0 と pi の付近は rho の符号を反転して比較
+    close |= (np.abs(rho_a[:, np.newaxis] + rho_b) <= rho_tol) & (np.pi - d_theta <= theta_tol)
+    return close
+
+
+def suppress_hough_peaks(lines: np.ndarray, rho_tol: float = 2.0, theta_tol: float = np.pi / 180,
+                         max_lines: int = 100, chunk: int = 256) -> np.ndarray:
+    """
+    HoughLines の結果 (rho, theta) から、投票数の多い順に近接する重複ピークを間引く
+    (rho, theta) と (-rho, theta - pi) は同じ直線として扱う
+    候補は chunk 本ずつ、残した直線とチャンク内の直線に対してまとめて判定する
+    lines は cv2.HoughLines の戻り値（投票数順）または (n, 2) 配列
+    戻り値: 残した直線の (k, 2) 配列（k <= max_lines）
+    """
+    if lines is None:
+        return np.empty((0, 2), dtype=np.float32)
+    lines = np.asarray(lines, dtype=np.float32).reshape(-1, 2)
+    rho, theta = lines[:, 0].astype(np.float64), lines[:, 1].astype(np.float64)
+
+    keep = []
+    for start in range(0, len(lines), chunk):
+        idx = np.arange(start, min(start + chunk, len(lines)))
+        # 既に残した直線に近いものを除外
+        suppressed = _hough_close(rho[idx], theta[idx], rho[keep], theta[keep],
+                                  rho_tol, theta_tol).any(axis=1)
+        close = _hough_close(rho[idx], theta[idx], rho[idx], theta[idx], rho_tol, theta_tol)
+        for i in range(len(idx)):
+            if suppressed[i]:
+                continue
+            keep.append(int(idx[i]))
+            if len(keep) >= max_lines:
+                return lines[keep]
+            suppressed |= close[i]
+    return lines[keep]
+
+
+def clip_hough_lines(lines: np.ndarray, width: int, height: int) -> np.ndarray:
+    """
+    (rho, theta) の直線を画像範囲 [0, width) x [0, height) に切り取った線分を一括で求める
+    （Liang-Barsky 法）。画像と交わらない直線は除く
+    戻り値: 線分端点の (k, 2, 2) int32 配列
+    """
+    lines = np.asarray(lines, dtype=np.float64).reshape(-1, 2)
+    cos_t, sin_t = np.cos(lines[:, 1]), np.sin(lines[:, 1])
+    x0, y0 = cos_t * lines[:, 0], sin_t * lines[:, 0]
+    dx, dy = -sin_t, cos_t
+
+    # 直線上の点 (x0 + t*dx, y0 + t*dy) が画像内に入る t の範囲
+    t_min = np.full(len(lines), -np.inf)
+    t_max = np.full(len(lines), np.inf)
+    visible = np.ones(len(lines), dtype=bool)
+    for p, d, upper in ((x0, dx, width - 1), (y0, dy, height - 1)):
+        parallel = np.abs(d) < 1e-12
+        visible &= ~parallel | ((p >= 0) & (p <= upper))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t0, t1 = (0 - p) / d, (upper - p) / d
+        lo, hi = np.minimum(t0, t1), np.maximum(t0, t1)
+        t_min = np.where(parallel, t_min, np.maximum(t_min, lo))
+        t_max = np.where(parallel, t_max, np.minimum(t_max, hi))
+    visible &= t_min <= t_max
+
+    t_min, t_max = t_min[visible], t_max[visible]
+    x0, y0, dx, dy = x0[visible], y0[visible], dx[visible], dy[visible]
+    segments = np.stack([np.stack([x0 + t_min * dx, y0 + t_min * dy], axis=1),
+                         np.stack([x0 + t_max * dx, y0 + t_max * dy], axis=1)], axis=1)
+    return np.rint(segments).astype(np.int32)
+
+
+def hough_line_evidence(edges: np.ndarray, threshold: int = 50, theta: float = np.pi / 180,
+                        max_lines: int = 100, rho_tol: float = 2.0, theta_tol: float = np.pi / 180,
+                        line_type: int = cv2.LINE_8,
+                        out: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    コマ枠の直線証拠画像を作成
+    Hough変換を1回だけ行い、近接する重複ピークを間引いてから、
+    画像内に切り取った直線をまとめて描画する（直線長はページの大きさに依存しない）
+    out を指定した場合は（0で初期化された）その配列に描画する
+    戻り値: (直線画像, 描画した直線の (k, 2) 配列)
+    """
+    height, width = edges.shape[:2]
+    lines = suppress_hough_peaks(cv2.HoughLines(edges, 1, theta, threshold),
+                                 rho_tol, theta_tol, max_lines)
+    lines_img = np.zeros((height, width), dtype=np.uint8) if out is None else out
+    segments = clip_hough_lines(lines, width, height)
+    if len(segments):
+        cv2.polylines(lines_img, list(segments), False, 255, 1, lineType=line_type)
+    return lines_img, lines
+
+
+def _zero_runs(profile: np.ndarray, min_gap: int) -> np.ndarray:
+    """プロファイル中の長さ min_gap 以上の0の連続区間 [start, end) を (k, 2) 配列で返す"""
+    padded = np.concatenate(([False], profile == 0, [False]))
+    edges = np.flatnonzero(np.diff(padded.astype(np.int8)))
+    runs = edges.reshape(-1, 2)
+    return runs[runs[:, 1] - runs[:, 0] >= min_gap]
+
+
+def xy_cut(binary_img: np.ndarray, min_gap: int = 6, border: int = 2) -> list:
+    """
+    再帰的XYカット: 二値画像（前景=非0）を、前景を含まない行・列の帯（幅 min_gap 以上）で
+    縦横に分割し、それ以上分割できない領域を前景の範囲に詰めて返す
+    端から border 画素以内は projection_profile と同じく除外する
+    戻り値: 葉領域の (x, y, w, h) のリスト（上から、同じ帯では左から）
+    """
+    h, w = binary_img.shape[:2]
+    x0, y0 = border + 1, border + 1
+    ink = binary_img[y0:h - border, x0:w - border] != 0
+
+    def trim(top, bottom, left, right):
+        sub = ink[top:bottom, left:right]
+        rows, cols = np.flatnonzero(sub.any(axis=1)), np.flatnonzero(sub.any(axis=0))
+        if rows.size == 0:
+            return None
+        return (int(top + rows[0]), int(top + rows[-1] + 1),
+                int(left + cols[0]), int(left + cols[-1] + 1))
+
+    leaves = []
+    root = trim(0, ink.shape[0], 0, ink.shape[1])
+    stack = [root] if root is not None else []
+    while stack:
+        top, bottom, left, right = stack.pop()
+        sub = ink[top:bottom, left:right]
+        pieces = []
+        for axis in (1, 0):
+            gaps = _zero_runs(sub.sum(axis=axis), min_gap)
+            if len(gaps):
+                bounds = np.concatenate(([0], gaps.ravel(), [sub.shape[1 - axis]])).reshape(-1, 2)
+                for start, end in bounds:
+                    if axis == 1:
+                        pieces.append(trim(top + start, top + end, left, right))
+                    else:
+                        pieces.append(trim(top, bottom, left + start, left + end))
+                break
+        if not pieces:
+            leaves.append((left + x0, top + y0, right - left, bottom - top))
+            continue
+        # 上・左の領域から処理されるよう逆順に積む
+        stack.extend(p for p in reversed(pieces) if p is not None)
+    return leaves
+
+
+def outer_frame_contour(binary_roi: np.ndarray,
+                        offset: Tuple[int, int] = (0, 0)) -> Tuple[Optional[np.ndarray], float]:
+    """
+    領域内の最大の外側輪郭（offset だけ平行移動）と、その面積と領域の面積の比
+    矩形の枠線で囲まれた領域なら比はほぼ1、斜めの枠や複数のコマを含む領域では小さくなる
+    """
+    contours, _ = cv2.findContours(binary_roi, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=offset)
+    if not contours:
+        return None, 0.0
+    areas = [cv2.contourArea(c) for c in contours]
+    n = int(np.argmax(areas))
+    h, w = binary_roi.shape[:2]
+    return contours[n], areas[n] / float(max(w - 1, 1) * max(h - 1, 1))
+
+
+def rect_deviation(contour: np.ndarray) -> float:
+    """
+    輪郭の各点からバウンディングボックスの最も近い辺までの距離の最大値
+    軸に平行な矩形の枠なら0（角の面取りの点も辺の上にある）、辺が傾いているとほぼその傾きの画素数になる
+    """
+    pts = contour.reshape(-1, 2)
+    x, y, w, h = cv2.boundingRect(contour)
+    dist = np.minimum(np.minimum(pts[:, 0] - x, x + w - 1 - pts[:, 0]),
+                      np.minimum(pts[:, 1] - y, y + h - 1 - pts[:, 1]))
+    return float(dist.max())
+
+
+def dark_level(gray: np.ndarray, max_level: int = 128) -> int:
+    """max_level 未満の輝度で最も多い値（黒ページの地の輝度）"""
+    hist = np.bincount(gray.ravel(), minlength=256)[:max_level]
+    return int(hist.argmax())
+
+
+def nested_bboxes(bboxes: np.ndarray) -> np.ndarray:
+    """
+    他のボックスに完全に含まれるバウンディングボックス (x, y, w, h) を判定
+    同一のボックスは先のものを残す
+    """
+    b = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+    x0, y0, x1, y1 = b[:, 0], b[:, 1], b[:, 0] + b[:, 2], b[:, 1] + b[:, 3]
+    inside = ((x0[:, np.newaxis] >= x0) & (y0[:, np.newaxis] >= y0) &
+              (x1[:, np.newaxis] <= x1) & (y1[:, np.newaxis] <= y1))
+    same = (b[:, np.newaxis] == b).all(axis=2)
+    # 自分自身と、自分より後の同一ボックスは除く
+    inside &= ~(same & ~np.tri(len(b), k=-1, dtype=bool))
+    return inside.any(axis=1)
+
+
+def compress_chain(contour: np.ndarray) -> np.ndarray:
+    """
+    CHAIN_APPROX_NONE の輪郭（隣接画素をたどる点列）から、同じ向きに進む途中の点を除いた
+    int16 の点列を返す（CHAIN_APPROX_SIMPLE 相当、始点は必ず残す）
+    expand_chain() で元の点列に戻せる
+    """
+    pts = contour.reshape(-1, 2).astype(np.int32)
+    if len(pts) < 3:
+        return pts.astype(np.int16).reshape(-1, 1, 2)
+    steps = np.roll(pts, -1, axis=0) - pts
+    keep = np.any(steps != np.roll(steps, 1, axis=0), axis=1)
+    keep[0] = True
+    return pts[keep].astype(np.int16).reshape(-1, 1, 2)
+
+
+def expand_chain(compressed: np.ndarray) -> np.ndarray:
+    """compress_chain() で間引いた点列を、隣接画素をたどる int32 の点列に戻す"""
+    pts = compressed.reshape(-1, 2).astype(np.int32)
+    if len(pts) < 2:
+        return pts.reshape(-1, 1, 2)
+    delta = np.roll(pts, -1, axis=0) - pts
+    lengths = np.abs(delta).max(axis=1)
+    unit = np.sign(delta)
+    seg = np.repeat(np.arange(len(pts)), lengths)
+    offsets = np.arange(len(seg)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return (pts[seg] + unit[seg] * offsets[:, np.newaxis]).reshape(-1, 1, 2)
@@ -1,6 +1,8 @@
 import cv2
 import numpy as np
 
+from array_ops import false_balloon_counts
+
 def judge_area(area, thresh=50):
     return area > thresh
 
@@ -198,105 +200,10 @@ def remove_false_balloons(balloons):
     filtered_balloons = []
     
     for balloon in balloons:
-        balloon_img = balloon['image']
-        h, w = balloon_img.shape[:2]
-        
-        # BGRAをグレースケールに変換
-        gray_balloon = cv2.cvtColor(balloon_img, cv2.COLOR_BGRA2GRAY)
-        
-        # 二値化
-        _, bin_balloon = cv2.threshold(gray_balloon, 150, 255, cv2.THRESH_BINARY)
-        bin_balloon_bgra = cv2.cvtColor(bin_balloon, cv2.COLOR_GRAY2BGRA)
-        
-        # アルファチャンネルを元の画像からコピー
-        bin_balloon_bgra[:, :, 3] = balloon_img[:, :, 3]
-        
-        # 画像端からの距離に基づく領域をマーク
-        marked_img = bin_balloon_bgra.copy()
-        
-        for y in range(h):
-            for x in range(w):
-                p = marked_img[y, x]
-                
-                # 画像端からballoon_px_th以内、または透明でない画素の周辺をチェック
-                if (x <= balloon_px_th or y <= balloon_px_th or 
-                    x >= w - balloon_px_th or y >= h - balloon_px_th):
-                    if p[3] != 0:  # 透明でない場合
-                        marked_img[y, x] = [255, 0, 0, p[3]]  # 赤でマーク
-                else:
-                    # 周辺画素をチェック
-                    is_edge = False
-                    for th in range(1, balloon_px_th + 1):
-                        neighbors = []
-                        if y - th >= 0:
-                            neighbors.append(marked_img[y - th, x])
-                        if y + th < h:
-                            neighbors.append(marked_img[y + th, x])
-                        if x - th >= 0:
-                            neighbors.append(marked_img[y, x - th])
-                        if x + th < w:
-                            neighbors.append(marked_img[y, x + th])
-                        
-                        # 対角線方向もチェック
-                        if y - th >= 0 and x + th < w:
-                            neighbors.append(marked_img[y - th, x + th])
-                        if y - th >= 0 and x - th >= 0:
-                            neighbors.append(marked_img[y - th, x - th])
-                        if y + th < h and x + th < w:
-                            neighbors.append(marked_img[y + th, x + th])
-                        if y + th < h and x - th >= 0:
-                            neighbors.append(marked_img[y + th, x - th])
-                        
-                        for neighbor in neighbors:
-                            if neighbor[3] == 0:  # 透明画素があれば
-                                is_edge = True
-                                break
-                        if is_edge:
-                            break
-                    
-                    if is_edge and p[3] != 0:
-                        marked_img[y, x] = [255, 0, 0, p[3]]  # 赤でマーク
-        
-        # 赤マークと接している黒画素をチェック
-        edge_black_count = 0
-        black_count = 0
-        white_count = 0
-        
-        for y in range(h):
-            for x in range(w):
-                p = marked_img[y, x]
-                
-                if p[3] != 0:  # 透明でない画素
-                    # 隣接画素をチェック
-                    is_adjacent_to_red = False
-                    if y > 0:
-                        neighbor = marked_img[y - 1, x]
-                        if neighbor[0] == 255 and neighbor[1] == 0 and neighbor[2] == 0:
-                            is_adjacent_to_red = True
-                    if y < h - 1:
-                        neighbor = marked_img[y + 1, x]
-                        if neighbor[0] == 255 and neighbor[1] == 0 and neighbor[2] == 0:
-                            is_adjacent_to_red = True
-                    if x > 0:
-                        neighbor = marked_img[y, x - 1]
-                        if neighbor[0] == 255 and neighbor[1] == 0 and neighbor[2] == 0:
-                            is_adjacent_to_red = True
-                    if x < w - 1:
-                        neighbor = marked_img[y, x + 1]
-                        if neighbor[0] == 255 and neighbor[1] == 0 and neighbor[2] == 0:
-                            is_adjacent_to_red = True
-                    
-                    # 赤マークと隣接する黒画素をカウント
-                    if (is_adjacent_to_red and 
-                        not (p[0] == 255 and p[1] == 0 and p[2] == 0) and
-                        p[0] == 0 and p[1] == 0 and p[2] == 0):
-                        edge_black_count += 1
-                    
-                    # 全体の黒白画素をカウント
-                    if p[0] == 0 and p[1] == 0 and p[2] == 0:
-                        black_count += 1
-                    else:
-                        white_count += 1
+        # 画像端・透明画素の周辺（斜め方向を含む）をマークして黒画素をカウント
+        edge_black_count, black_count = false_balloon_counts(
+            balloon['image'], balloon_px_th, diagonal=True
+        )
         
         # 誤検出判定
         if edge_black_count == 0 and black_count >= 100:
@@ -0,0 +1,1301 @@
+#!/usr/bin/env python3
+"""
+benchmark_manga_processor.py
+============================
+
+manga_processor.py の高速化前後を比較するマイクロベンチマーク
+旧実装（C++版をそのまま移植した画素ループ）を比較用に保持し、
+実ページ解像度（1170x827）で処理時間と結果の一致を確認する
+
+Usage:
+    python benchmark_manga_processor.py [benchmark_name] [image_path]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from dataclasses import dataclass
+from unittest import mock
+from typing import Callable, Dict, List, Optional, Tuple
+
+import cv2
+import numpy as np
+
+import frame_separation
+import manga_processor
+from buffer_pool import BufferPool
+from array_ops import (
+    false_balloon_counts, hough_line_evidence, is_black_page_bands, profile_extent, projection_profile
+)
+from manga_processor import Balloon, MangaProcessor, Point, Points
+from page_context import PageContext
+
+
+# ----------------------------------------------------------------------
+# テスト用ページ生成
+# ----------------------------------------------------------------------
+
+def make_synthetic_page(height: int = 1170, width: int = 827, black: bool = False) -> np.ndarray:
+    """
+    ベンチマーク・テスト用の合成ページ（グレースケール）を生成
+    白地に枠線付きのコマ3つと、文字入りの楕円吹き出しを描画する
+    black=True の場合は黒ベタ背景のページを生成
+    """
+    bg, fg = (20, 255) if black else (255, 0)
+    page = np.full((height, width), bg, dtype=np.uint8)
+    margin = int(width * 0.06)
+    gutter = int(height * 0.02)
+    top_h = int(height * 0.4)
+
+    # コマ枠
+    cv2.rectangle(page, (margin, margin), (width - margin, top_h), fg, 2)
+    mid_x = width // 2
+    cv2.rectangle(page, (margin, top_h + gutter), (mid_x - gutter // 2, height - margin), fg, 2)
+    cv2.rectangle(page, (mid_x + gutter // 2, top_h + gutter), (width - margin, height - margin), fg, 2)
+
+    # 吹き出し（白い楕円 + 黒い輪郭 + 文字列）
+    for cx, cy, ax, ay in [(width // 3, top_h // 2, 90, 60), (3 * width // 4, top_h + 200, 70, 110)]:
+        cv2.ellipse(page, (cx, cy), (ax, ay), 0, 0, 360, 255, -1)
+        cv2.ellipse(page, (cx, cy), (ax, ay), 0, 0, 360, 0, 2)
+        for row in range(-ay // 2, ay // 2, 18):
+            cv2.line(page, (cx - ax // 2, cy + row), (cx + ax // 2, cy + row), 0, 3)
+
+    return page
+
+
+def _best_time(func: Callable, *args, repeat: int = 3) -> float:
+    """repeat回実行した最短時間（秒）を返す"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _make_processor() -> MangaProcessor:
+    """出力先を一時フォルダにした MangaProcessor を生成"""
+    return MangaProcessor("dummy", tempfile.mkdtemp(prefix="manga_bench_"))
+
+
+def _report(name: str, legacy_sec: float, new_sec: float) -> None:
+    speedup = legacy_sec / new_sec if new_sec > 0 else float("inf")
+    print(f"  {name:<28} legacy={legacy_sec * 1000:9.2f} ms  new={new_sec * 1000:8.3f} ms  x{speedup:.1f}")
+
+
+# ----------------------------------------------------------------------
+# 旧実装（比較用）
+# ----------------------------------------------------------------------
+
+def legacy_page_type_bands(frame_exist_page: np.ndarray, BLACK_LENGTH_TH: int = 5) -> bool:
+    """旧 MangaProcessor.get_page_type() の端チェック部分（画素ループ）"""
+    h, w = frame_exist_page.shape
+
+    page_type = True
+    for y in range(3, BLACK_LENGTH_TH):
+        for x in range(w):
+            if frame_exist_page[y, x] != 0:
+                page_type = False
+                break
+        if not page_type:
+            break
+    if page_type:
+        return True
+
+    page_type = True
+    for y in range(h - 3, h - BLACK_LENGTH_TH, -1):
+        for x in range(w):
+            if frame_exist_page[y, x] != 0:
+                page_type = False
+                break
+        if not page_type:
+            break
+    if page_type:
+        return True
+
+    page_type = True
+    for y in range(h):
+        for x in range(w - 3, w - BLACK_LENGTH_TH, -1):
+            if frame_exist_page[y, x] != 0:
+                page_type = False
+                break
+        if not page_type:
+            break
+    if page_type:
+        return True
+
+    page_type = True
+    for y in range(h):
+        for x in range(3, BLACK_LENGTH_TH):
+            if frame_exist_page[y, x] != 0:
+                page_type = False
+                break
+        if not page_type:
+            break
+
+    return page_type
+
+
+def legacy_frame_area_bounds(inverse_bin_img: np.ndarray):
+    """
+    旧 MangaProcessor.find_frame_area() のヒストグラム生成と境界検出（画素ループ）
+    戻り値: (min_x, max_x, min_y, max_y)
+    """
+    h, w = inverse_bin_img.shape
+
+    histgram_lr = np.zeros(w, dtype=int)
+    for y in range(h):
+        for x in range(w):
+            if x <= 2 or x >= w - 2 or y <= 2 or y >= h - 2:
+                continue
+            if inverse_bin_img[y, x] > 0:
+                histgram_lr[x] += 1
+
+    min_x_lr = 0
+    max_x_lr = w - 1
+    for x in range(w):
+        if histgram_lr[x] > 0:
+            min_x_lr = x
+            break
+    for x in range(w - 1, -1, -1):
+        if histgram_lr[x] > 0:
+            max_x_lr = x
+            break
+    if min_x_lr < 6:
+        min_x_lr = 0
+    if max_x_lr > w - 6:
+        max_x_lr = w
+
+    histgram_tb = np.zeros(h, dtype=int)
+    for y in range(h):
+        for x in range(w):
+            if x <= 2 or x >= w - 2 or y <= 2 or y >= h - 2:
+                continue
+            if inverse_bin_img[y, x] > 0:
+                histgram_tb[y] += 1
+
+    min_y_tb = 0
+    max_y_tb = h - 1
+    for y in range(h):
+        if histgram_tb[y] > 0:
+            min_y_tb = y
+            break
+    for y in range(h - 1, -1, -1):
+        if histgram_tb[y] > 0:
+            max_y_tb = y
+            break
+    if min_y_tb < 6:
+        min_y_tb = 0
+    if max_y_tb > h - 6:
+        max_y_tb = h
+
+    return min_x_lr, max_x_lr, min_y_tb, max_y_tb
+
+
+def legacy_frame_existence_bounds(inverse_bin: np.ndarray) -> Tuple[int, int]:
+    """旧 FrameDetector.find_frame_existence_area() の左右の境界検出（列ごとのループ）"""
+    histogram = np.sum(inverse_bin[:, 3:-3] > 0, axis=0)
+    min_x = 0
+    max_x = inverse_bin.shape[1] - 1
+    for idx, val in enumerate(histogram, start=3):
+        if val > 0:
+            min_x = idx
+            break
+    for offset, val in enumerate(reversed(histogram), start=3):
+        if val > 0:
+            max_x = inverse_bin.shape[1] - offset
+            break
+    if min_x < 6:
+        min_x = 0
+    if max_x > inverse_bin.shape[1] - 6:
+        max_x = inverse_bin.shape[1]
+    return min_x, max_x
+
+
+def frame_area_bounds(inverse_bin_img: np.ndarray):
+    """新実装: 射影ヒストグラムを1回で求めて境界を検出"""
+    histogram_x, histogram_y = projection_profile(inverse_bin_img)
+    return profile_extent(histogram_x) + profile_extent(histogram_y)
+
+
+def legacy_create_alpha_image(src_page: np.ndarray, definite_panel_point: Points) -> np.ndarray:
+    """旧 MangaProcessor.create_alpha_image()（ページ全体を画素ごとに outside() 判定）"""
+    if len(src_page.shape) == 3:
+        rgba = cv2.cvtColor(src_page, cv2.COLOR_BGR2BGRA)
+    else:
+        rgba = cv2.cvtColor(src_page, cv2.COLOR_GRAY2BGRA)
+
+    definite_panel_point.renew_line()
+
+    height, width = rgba.shape[:2]
+    for y in range(height):
+        for x in range(width):
+            point = Point(x, y)
+            if definite_panel_point.outside(point):
+                rgba[y, x, 3] = 0
+
+    return rgba
+
+
+def legacy_false_balloon_counts(balloon_img: np.ndarray, balloon_px_th: int = 5,
+                                diagonal: bool = False) -> Tuple[int, int]:
+    """
+    旧 MangaProcessor.remove_false_balloons() のエッジマーキングと黒画素カウント（画素ループ）
+    diagonal=True で balloon_detect.py 版（斜め方向の周辺画素もチェック）
+    """
+    h, w = balloon_img.shape[:2]
+    gray_balloon = cv2.cvtColor(balloon_img, cv2.COLOR_BGRA2GRAY)
+    _, bin_balloon = cv2.threshold(gray_balloon, 150, 255, cv2.THRESH_BINARY)
+    bin_balloon_bgra = cv2.cvtColor(bin_balloon, cv2.COLOR_GRAY2BGRA)
+    bin_balloon_bgra[:, :, 3] = balloon_img[:, :, 3]
+    marked_img = bin_balloon_bgra.copy()
+
+    for y in range(h):
+        for x in range(w):
+            p = marked_img[y, x]
+            if (x <= balloon_px_th or y <= balloon_px_th or
+                    x >= w - balloon_px_th or y >= h - balloon_px_th):
+                if p[3] != 0:
+                    marked_img[y, x] = [255, 0, 0, p[3]]
+            else:
+                is_edge = False
+                for th in range(1, balloon_px_th + 1):
+                    neighbors = []
+                    if y - th >= 0:
+                        neighbors.append(marked_img[y - th, x])
+                    if y + th < h:
+                        neighbors.append(marked_img[y + th, x])
+                    if x - th >= 0:
+                        neighbors.append(marked_img[y, x - th])
+                    if x + th < w:
+                        neighbors.append(marked_img[y, x + th])
+                    if diagonal:
+                        if y - th >= 0 and x + th < w:
+                            neighbors.append(marked_img[y - th, x + th])
+                        if y - th >= 0 and x - th >= 0:
+                            neighbors.append(marked_img[y - th, x - th])
+                        if y + th < h and x + th < w:
+                            neighbors.append(marked_img[y + th, x + th])
+                        if y + th < h and x - th >= 0:
+                            neighbors.append(marked_img[y + th, x - th])
+                    for neighbor in neighbors:
+                        if neighbor[3] == 0:
+                            is_edge = True
+                            break
+                    if is_edge:
+                        break
+                if is_edge and p[3] != 0:
+                    marked_img[y, x] = [255, 0, 0, p[3]]
+
+    edge_black_count = 0
+    black_count = 0
+    for y in range(h):
+        for x in range(w):
+            p = marked_img[y, x]
+            if p[3] != 0:
+                is_adjacent_to_red = False
+                for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+                    ny, nx = y + dy, x + dx
+                    if 0 <= ny < h and 0 <= nx < w:
+                        neighbor = marked_img[ny, nx]
+                        if neighbor[0] == 255 and neighbor[1] == 0 and neighbor[2] == 0:
+                            is_adjacent_to_red = True
+                            break
+                if (is_adjacent_to_red and
+                        not (p[0] == 255 and p[1] == 0 and p[2] == 0) and
+                        p[0] == 0 and p[1] == 0 and p[2] == 0):
+                    edge_black_count += 1
+                if p[0] == 0 and p[1] == 0 and p[2] == 0:
+                    black_count += 1
+
+    return edge_black_count, black_count
+
+
+def make_balloon_image(height: int, width: int, seed: int = 0) -> np.ndarray:
+    """
+    テスト用の吹き出し画像（BGRA）を生成
+    楕円内を不透明にし、白地に黒い文字線と外周付近の黒画素を乱数で置く
+    """
+    rng = np.random.default_rng(seed)
+    gray = np.full((height, width), 255, dtype=np.uint8)
+    gray[rng.random((height, width)) > 0.9] = 0
+    for row in range(2, height - 2, 7):
+        cv2.line(gray, (width // 4, row), (3 * width // 4, row), int(rng.integers(0, 200)), 2)
+    alpha = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(alpha, (width // 2, height // 2), (max(width // 2 - 1, 1), max(height // 2 - 1, 1)),
+                0, 0, 360, 255, -1)
+    balloon = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA)
+    balloon[:, :, 3] = alpha
+    return balloon
+
+
+def legacy_speechballoon_detect(panel: np.ndarray) -> List[Balloon]:
+    """旧 MangaProcessor.speechballoon_detect()（輪郭ごとにコマ全体のマスクを作成）"""
+    balloons = []
+
+    # グレースケール変換
+    if len(panel.shape) == 4:  # BGRA
+        gray = cv2.cvtColor(panel, cv2.COLOR_BGRA2GRAY)
+    elif len(panel.shape) == 3:  # BGR
+        gray = cv2.cvtColor(panel, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = panel
+
+    # 二値化
+    _, bin_img = cv2.threshold(gray, 230, 255, cv2.THRESH_BINARY)
+
+    # モルフォロジー処理
+    kernel = np.ones((3, 3), np.uint8)
+    bin_img = cv2.erode(bin_img, kernel, iterations=1)
+    bin_img = cv2.dilate(bin_img, kernel, iterations=1)
+
+    # 輪郭検出
+    contours, _ = cv2.findContours(bin_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+
+    panel_area = panel.shape[0] * panel.shape[1]
+
+    for i, cnt in enumerate(contours):
+        area = cv2.contourArea(cnt)
+        peri = cv2.arcLength(cnt, True)
+
+        if peri == 0:
+            continue
+
+        en = 4.0 * np.pi * area / (peri * peri)  # 円形度
+
+        # C++と同じ面積と円形度フィルタ
+        if not (panel_area * 0.01 <= area < panel_area * 0.9 and en > 0.4):
+            continue
+
+        # バウンディングボックス取得
+        bbox = cv2.boundingRect(cnt)
+        x, y, w, h = bbox
+
+        center_x = x + w // 2
+        center_y = y + h // 2
+
+        # マスク作成（C++と同じ処理）
+        mask = np.full(gray.shape, 255, dtype=np.uint8)  # 初期値255で初期化
+        cv2.drawContours(mask, [cnt], -1, 0, 4)  # 輪郭を太さ4で0（黒）で描画
+        cv2.drawContours(mask, [cnt], -1, 0, -1)  # 内部を0（黒）で塗りつぶし
+
+        # C++のcopyTo処理を再現：マスクを使って背景をグレー（150）にする
+        back_150 = np.full(gray.shape, 150, dtype=np.uint8)
+        masked_img = gray.copy()
+        # マスクが0（黒）の部分にback_150をコピー（C++のcopyTo処理）
+        masked_img = np.where(mask == 0, back_150, gray)
+
+        # 切り出し
+        cropped_region = masked_img[y:y+h, x:x+w]
+
+        # 白黒比率計算
+        TH = 255 // 3  # 85
+        B = np.sum((cropped_region < TH) & (cropped_region != 150))
+        W = np.sum(cropped_region > (255 - TH))
+
+        if W == 0 or not (0.01 < (B / W) < 0.7) or B < 10:
+            continue
+
+        # 形状判定
+        max_rect = w * h * 0.95
+        if area >= max_rect:
+            set_type = 1  # 矩形
+        elif en >= 0.7:
+            set_type = 0  # 円形
+        else:
+            set_type = 2  # ギザギザ
+
+        # コマサイズ判定
+        if w * h >= panel_area * 0.9:
+            continue
+
+        # RGBA画像作成
+        if len(panel.shape) == 3:
+            rgba_panel = cv2.cvtColor(panel, cv2.COLOR_BGR2BGRA)
+        else:
+            rgba_panel = panel.copy()
+
+        # 透明化
+        alpha_mask = np.zeros(gray.shape, dtype=np.uint8)
+        cv2.drawContours(alpha_mask, [cnt], -1, 255, -1)
+        rgba_panel[:, :, 3] = alpha_mask
+
+        # 切り出し
+        balloon_img = rgba_panel[y:y+h, x:x+w].copy()
+
+        balloon = Balloon(
+            image=balloon_img,
+            bbox=(x, y, w, h),
+            contour=cnt,
+            center=(center_x, center_y),
+            area=area,
+            circularity=en,
+            type=set_type,
+            bw_ratio=B / W if W > 0 else 0,
+            panel_idx=0  # 後で設定
+        )
+        balloons.append(balloon)
+
+    return balloons
+
+
+def legacy_manga_line_evidence(edges: np.ndarray, threshold: int = 50, **_) -> Tuple[np.ndarray, np.ndarray]:
+    """旧 MangaProcessor.frame_detect() の直線画像作成（上位100本を長さ±2000で1本ずつ描画）"""
+    lines = cv2.HoughLines(edges, 1, np.pi / 180, threshold)
+    lines_img = np.zeros_like(edges)
+    if lines is not None:
+        for line in lines[:100]:
+            rho, theta = line[0]
+            a, b = np.cos(theta), np.sin(theta)
+            x0, y0 = a * rho, b * rho
+            cv2.line(lines_img, (int(x0 - 2000 * b), int(y0 + 2000 * a)),
+                     (int(x0 + 2000 * b), int(y0 - 2000 * a)), 255, 1)
+    return lines_img, lines
+
+
+def legacy_separation_line_evidence(edges: np.ndarray, **_) -> Tuple[np.ndarray, np.ndarray]:
+    """旧 FrameDetector.detect_panels() の直線画像作成（pi/180 と pi/360 の2回のHough変換）"""
+    h, w = edges.shape[:2]
+    diag = int(np.hypot(w, h))
+    lines_img = np.zeros_like(edges)
+    for theta_res in (np.pi / 180.0, np.pi / 360.0):
+        lines = cv2.HoughLines(edges, 1, theta_res, 50)
+        for rho, theta in ([] if lines is None else lines[:100, 0]):
+            a, b = np.cos(theta), np.sin(theta)
+            x0, y0 = a * rho, b * rho
+            cv2.line(lines_img, (int(x0 - diag * b), int(y0 + diag * a)),
+                     (int(x0 + diag * b), int(y0 - diag * a)), 255, 1, lineType=cv2.LINE_AA)
+    return lines_img, None
+
+
+def make_screentone_panel(height: int = 500, width: int = 400, seed: int = 0) -> np.ndarray:
+    """
+    スクリーントーン（細かい網点）で埋まったコマ（BGRA）を生成
+    輪郭が数千個できる、吹き出し検出の重いケース
+    """
+    rng = np.random.default_rng(seed)
+    gray = np.full((height, width), 255, dtype=np.uint8)
+    for cy in range(3, height, 6):
+        for cx in range(3 + (cy // 6) % 2 * 3, width, 6):
+            cv2.circle(gray, (cx, cy), int(rng.integers(1, 3)), 0, -1)
+    # 網点の上に吹き出しを1つ置く
+    cv2.ellipse(gray, (width // 2, height // 3), (90, 60), 0, 0, 360, 255, -1)
+    cv2.ellipse(gray, (width // 2, height // 3), (90, 60), 0, 0, 360, 0, 2)
+    for row in range(-30, 30, 15):
+        cv2.line(gray, (width // 2 - 45, height // 3 + row), (width // 2 + 45, height // 3 + row), 0, 3)
+    return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA)
+
+
+def make_slanted_quad(page_shape) -> Tuple[Points, Tuple[int, int, int, int]]:
+    """ベンチマーク・テスト用の斜めの辺を持つコマ四隅とそのバウンディングボックス"""
+    h, w = page_shape[:2]
+    corners = Points(
+        Point(w // 10, h // 8),
+        Point(w - w // 7, h // 12),
+        Point(w // 6, h - h // 9),
+        Point(w - w // 10, h - h // 6),
+    )
+    xs = [p.x for p in (corners.lt, corners.rt, corners.lb, corners.rb)]
+    ys = [p.y for p in (corners.lt, corners.rt, corners.lb, corners.rb)]
+    bbox = (min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+    return corners, bbox
+
+
+def make_slanted_page(height: int = 1170, width: int = 827) -> np.ndarray:
+    """
+    斜めの区切りを持つ合成ページ（XYカットで分割できず、Houghで検出されるページ）
+    上段は横長のコマ、下段は斜めの区切りで左右に分かれた2つのコマ
+    """
+    page = np.full((height, width), 255, dtype=np.uint8)
+    margin = int(width * 0.06)
+    top_h = int(height * 0.4)
+    bottom = height - margin
+    cv2.rectangle(page, (margin, margin), (width - margin, top_h), 0, 2)
+    split_top, split_bottom, gutter = int(width * 0.6), int(width * 0.4), int(height * 0.01)
+    y0 = top_h + 2 * gutter
+    left = np.array([(margin, y0), (split_top - gutter, y0), (split_bottom - gutter, bottom), (margin, bottom)])
+    right = np.array([(split_top + gutter, y0), (width - margin, y0), (width - margin, bottom),
+                      (split_bottom + gutter, bottom)])
+    cv2.polylines(page, [left.astype(np.int32), right.astype(np.int32)], True, 0, 2)
+    return page
+
+
+def make_skewed_grid_page(height: int = 1170, width: int = 827, skew: int = 7) -> np.ndarray:
+    """
+    make_synthetic_page と同じ配置で、各コマの横の辺を skew 画素だけ傾けた合成ページ
+    区切りは白いまま残るのでXYカットで分割できるが、コマは矩形ではない（Houghで検出されるページ）
+    """
+    page = np.full((height, width), 255, dtype=np.uint8)
+    margin = int(width * 0.06)
+    gutter = int(height * 0.02)
+    top_h = int(height * 0.4)
+    mid_x = width // 2
+    y0, bottom = top_h + gutter, height - margin
+    top = np.array([(margin, margin), (width - margin, margin + skew), (width - margin, top_h), (margin, top_h - skew)])
+    left = np.array([(margin, y0 + skew), (mid_x - gutter // 2, y0), (mid_x - gutter // 2, bottom),
+                     (margin, bottom - skew)])
+    right = np.array([(mid_x + gutter // 2, y0), (width - margin, y0 + skew), (width - margin, bottom - skew),
+                      (mid_x + gutter // 2, bottom)])
+    cv2.polylines(page, [q.astype(np.int32) for q in (top, left, right)], True, 0, 2)
+    return page
+
+
+def make_flashback_page(height: int = 1170, width: int = 827, seed: int = 0) -> np.ndarray:
+    """
+    回想シーン風の黒ページ（黒地に枠線のない中間調のコマ3つと白い吹き出し）
+    コマの配置は make_synthetic_page と同じ
+    """
+    rng = np.random.default_rng(seed)
+    page = rng.integers(0, 6, size=(height, width), dtype=np.uint8)
+    margin = int(width * 0.06)
+    gutter = int(height * 0.02)
+    top_h = int(height * 0.4)
+    mid_x = width // 2
+    for x0, y0, x1, y1 in [(margin, margin, width - margin, top_h),
+                           (margin, top_h + gutter, mid_x - gutter // 2, height - margin),
+                           (mid_x + gutter // 2, top_h + gutter, width - margin, height - margin)]:
+        h, w = y1 - y0 + 1, x1 - x0 + 1
+        texture = cv2.resize(rng.integers(40, 200, size=(h // 40 + 2, w // 40 + 2), dtype=np.uint8),
+                             (w, h), interpolation=cv2.INTER_CUBIC)
+        page[y0:y1 + 1, x0:x1 + 1] = texture
+        cv2.ellipse(page, ((x0 + x1) // 2, (y0 + y1) // 2), (w // 6, h // 8), 0, 0, 360, 255, -1)
+    return page
+
+
+# ----------------------------------------------------------------------
+# ベンチマーク
+# ----------------------------------------------------------------------
+
+def bench_page_type(page: np.ndarray) -> None:
+    """ページ分類の端チェック（旧: 画素ループ / 新: 帯単位の配列演算）"""
+    print("=== page_type ===")
+    _, binary = cv2.threshold(page, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    # 白ページは最初の画素で打ち切られるため、上下端を走査しきった後に
+    # 右端の全行を走査する最悪ケースも測る
+    worst = np.zeros_like(page)
+    worst[4, -6] = 255
+    worst[-4, -6] = 255
+    inputs = {"input page": binary, "worst case (right edge black)": worst}
+    for name, binary in inputs.items():
+        assert legacy_page_type_bands(binary) == is_black_page_bands(binary)
+        _report(name, _best_time(legacy_page_type_bands, binary), _best_time(is_black_page_bands, binary))
+
+
+def bench_projection_profile(page: np.ndarray) -> None:
+    """
+    コマ存在領域の射影ヒストグラム（旧: find_frame_area で2回 +
+    find_frame_existence_area で1回の全画素ループ / 新: 1回の配列演算）
+    """
+    print("=== projection_profile ===")
+    gaussian_img = cv2.GaussianBlur(page, (3, 3), 0)
+    _, inverse_bin = cv2.threshold(cv2.bitwise_not(gaussian_img), 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    assert legacy_frame_area_bounds(inverse_bin) == frame_area_bounds(inverse_bin)
+    _report("find_frame_area bounds", _best_time(legacy_frame_area_bounds, inverse_bin, repeat=1),
+            _best_time(frame_area_bounds, inverse_bin))
+
+
+def bench_alpha_image(page: np.ndarray) -> None:
+    """
+    コマの透明化（旧: ページ全体を画素ごとに判定してから切り出し /
+    新: バウンディングボックス内だけを配列演算で判定）
+    """
+    print("=== alpha_image ===")
+    processor = _make_processor()
+    corners, bbox = make_slanted_quad(page.shape)
+    x, y, w, h = bbox
+
+    def legacy():
+        return legacy_create_alpha_image(page, corners)[y:y+h, x:x+w].copy()
+
+    def new():
+        return processor.create_alpha_image(page, corners, bbox)
+
+    assert np.array_equal(legacy(), new())
+    _report("create_alpha_image (1 panel)", _best_time(legacy, repeat=1), _best_time(new))
+
+
+def bench_false_balloons(page: np.ndarray) -> None:
+    """誤検出除去の黒画素カウント（旧: 画素ループ / 新: 膨張とシフト配列）"""
+    print("=== false_balloons ===")
+    for height, width in [(120, 160), (300, 400)]:
+        balloon = make_balloon_image(height, width)
+        for diagonal in (False, True):
+            name = f"{height}x{width}{' diagonal' if diagonal else ''}"
+            assert (legacy_false_balloon_counts(balloon, 5, diagonal)
+                    == false_balloon_counts(balloon, 5, diagonal))
+            _report(name, _best_time(legacy_false_balloon_counts, balloon, 5, diagonal, repeat=1),
+                    _best_time(false_balloon_counts, balloon, 5, diagonal))
+
+
+def bench_speechballoon(page: np.ndarray) -> None:
+    """
+    吹き出し検出（旧: 輪郭ごとの特徴量計算とコマ全体のマスク /
+    新: 特徴量の一括計算と安い判定からの絞り込み、バウンディングボックス内のマスク）
+    """
+    print("=== speechballoon ===")
+    processor = _make_processor()
+    panels = [("synthetic page", cv2.cvtColor(page, cv2.COLOR_GRAY2BGRA) if page.ndim == 2 else page),
+              ("screentone panel", make_screentone_panel())]
+    for name, panel in panels:
+        legacy = legacy_speechballoon_detect(panel)
+        new = processor.speechballoon_detect(panel)
+        print(f"  {name}: {len(legacy)} balloons (legacy) -> {len(new)} balloons")
+        _report(name, _best_time(legacy_speechballoon_detect, panel),
+                _best_time(processor.speechballoon_detect, panel))
+    print(f"  pruned candidates (all runs): {processor.balloon_prune_stats}")
+
+
+def upscale_page(page: np.ndarray, factor: float) -> np.ndarray:
+    """高解像度スキャンを模したページ（バイキュービック拡大）"""
+    return cv2.resize(page, None, fx=factor, fy=factor, interpolation=cv2.INTER_CUBIC)
+
+
+def _iou(a: Tuple[int, int, int, int], b: Tuple[int, int, int, int]) -> float:
+    ix = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0], b[0]))
+    iy = max(0, min(a[1] + a[3], b[1] + b[3]) - max(a[1], b[1]))
+    inter = ix * iy
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def _quad_points(panel) -> np.ndarray:
+    """Panel（manga_processor）/ PanelDetection（frame_separation）の四隅座標 (4, 2)"""
+    if hasattr(panel, "corners"):
+        c = panel.corners
+        return np.array([(c.lt.x, c.lt.y), (c.rt.x, c.rt.y), (c.lb.x, c.lb.y), (c.rb.x, c.rb.y)])
+    q = panel.quad
+    return np.array([q.lt, q.rt, q.lb, q.rb])
+
+
+def quad_agreement(reference: List, panels: List, iou_th: float = 0.5) -> Dict[str, float]:
+    """
+    2つのコマ検出結果の一致度
+    バウンディングボックスのIoUが iou_th 以上のコマを対応付け、四隅座標のずれ（画素）を求める
+    """
+    deviations = []
+    for ref in reference:
+        best = max(panels, key=lambda p: _iou(ref.bbox, p.bbox), default=None)
+        if best is None or _iou(ref.bbox, best.bbox) < iou_th:
+            continue
+        deviations.append(np.abs(_quad_points(ref) - _quad_points(best)).max())
+    return {
+        "reference": len(reference),
+        "detected": len(panels),
+        "matched": len(deviations),
+        "max_corner_dev": float(max(deviations, default=0)),
+        "mean_corner_dev": float(np.mean(deviations)) if deviations else 0.0,
+    }
+
+
+def bench_pyramid(page: np.ndarray) -> None:
+    """
+    高解像度ページのコマ検出（旧: 原寸で全処理 / 新: 縮小画像で候補検出し原寸で四隅を精密化）
+    """
+    print("=== pyramid ===")
+    processor = _make_processor()
+    processor.frame_engine = "hough"
+    working_height = page.shape[0]
+    for factor in (3, 4):
+        big = upscale_page(page, factor)
+        agreement = quad_agreement(processor.frame_detect(big),
+                                   processor.frame_detect(big, pyramid_height=working_height))
+        print(f"  x{factor} {big.shape}: panels {agreement['reference']} (full) -> {agreement['detected']} "
+              f"(pyramid), matched={agreement['matched']}  "
+              f"corner dev max={agreement['max_corner_dev']:.0f}px mean={agreement['mean_corner_dev']:.1f}px")
+        _report(f"frame_detect x{factor}", _best_time(processor.frame_detect, big),
+                _best_time(processor.frame_detect, big, working_height))
+
+
+def bench_hough(page: np.ndarray) -> None:
+    """
+    直線証拠画像の作成（旧: 処理ごとのHough変換と1本ずつの描画 /
+    新: 1回のHough変換と重複ピークの間引き、ページ内に切り取った直線の一括描画）
+    コマ検出結果は旧段階に差し替えた場合との一致度を表示する
+    """
+    print("=== hough ===")
+    processor = _make_processor()
+    processor.frame_engine = "hough"
+    detector = frame_separation.FrameDetector()
+    for factor in (1, 3):
+        big = page if factor == 1 else upscale_page(page, factor)
+        edges = cv2.Canny(big, 120, 130, 3)
+        _report(f"manga_processor x{factor}", _best_time(legacy_manga_line_evidence, edges),
+                _best_time(hough_line_evidence, edges))
+        _report(f"frame_separation x{factor}", _best_time(legacy_separation_line_evidence, edges),
+                _best_time(lambda: hough_line_evidence(edges, theta=np.pi / 360, line_type=cv2.LINE_AA)))
+
+        with mock.patch.object(manga_processor, "hough_line_evidence", legacy_manga_line_evidence):
+            legacy_panels = processor.frame_detect(big)
+        agreement = quad_agreement(legacy_panels, processor.frame_detect(big))
+        print(f"  manga_processor x{factor} panels: {agreement}")
+
+        with mock.patch.object(frame_separation, "hough_line_evidence", legacy_separation_line_evidence):
+            legacy_panels = detector.detect_panels(big)
+        agreement = quad_agreement(legacy_panels, detector.detect_panels(big))
+        print(f"  frame_separation x{factor} panels: {agreement}")
+
+
+def bench_xy_cut(page: np.ndarray) -> None:
+    """
+    フレーム検出（旧: 常にHough直線検出 / 新: 格子状のページはXYカット、それ以外はHough）
+    斜めの区切りのページでHoughに切り替わることも確認する
+    """
+    print("=== xy_cut ===")
+    hough = _make_processor()
+    hough.frame_engine = "hough"
+    auto = _make_processor()
+    for name, target in (("grid page", page), ("slanted page", make_slanted_page(*page.shape[:2]))):
+        agreement = quad_agreement(hough.frame_detect(target), auto.frame_detect(target))
+        print(f"  {name}: engine={auto.last_frame_engine}  panels {agreement['reference']} (hough) -> "
+              f"{agreement['detected']}, matched={agreement['matched']}  "
+              f"corner dev max={agreement['max_corner_dev']:.0f}px")
+        _report(f"frame_detect {name}", _best_time(hough.frame_detect, target),
+                _best_time(auto.frame_detect, target))
+
+
+def bench_black_page(page: np.ndarray) -> None:
+    """
+    黒ページのコマ検出（旧: スキップ / 新: 連結成分と射影ヒストグラム）
+    白ページのフレーム検出（Hough）の処理時間を予算として比較する
+    """
+    print("=== black_page ===")
+    processor = _make_processor()
+    processor.frame_engine = "hough"
+    height, width = page.shape[:2]
+    for name, black in (("synthetic black page", make_synthetic_page(height, width, black=True)),
+                        ("flashback page", make_flashback_page(height, width))):
+        panels = processor.black_page_frame_detect(black)
+        print(f"  {name}: black={processor.get_page_type(black)}  panels={[p.bbox for p in panels]}")
+        _report(name, _best_time(processor.frame_detect, page),
+                _best_time(processor.black_page_frame_detect, black))
+
+
+def _pool_run(pooled: bool, n_pages: int, shapes: Tuple[Tuple[int, int], ...]) -> Dict[str, float]:
+    """
+    n_pages ページ分のフレーム検出（両検出器）を実行し、作業用配列の確保回数と
+    最大常駐メモリ（RSS）を返す（別プロセスで実行する）
+    """
+    import resource
+    pages = [make_synthetic_page(h, w) for h, w in shapes]
+    processor = _make_processor()
+    processor.frame_engine = "hough"
+    detector = frame_separation.FrameDetector()
+    if not pooled:
+        # 返却された配列を保持しない（毎回確保する従来の動作と同じ）
+        processor.buffer_pool = BufferPool(max_bytes=0)
+        detector.buffer_pool = BufferPool(max_bytes=0)
+    # 大きさの異なるページが交互に並んだ巻を処理する
+    start = time.perf_counter()
+    for i in range(n_pages):
+        processor.frame_detect(pages[i % len(pages)])
+        detector.detect_panels(pages[i % len(pages)])
+    elapsed = time.perf_counter() - start
+    stats = {key: processor.buffer_pool.stats()[key] + detector.buffer_pool.stats()[key]
+             for key in ("borrows", "hits", "allocations", "allocated_bytes")}
+    stats["seconds"] = elapsed
+    stats["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return stats
+
+
+def bench_buffer_pool(page: np.ndarray, n_pages: int = 1000) -> None:
+    """
+    ページ大の作業用配列（旧: ページごとに確保 / 新: 大きさごとのプールから貸し出し）
+    2種類の大きさが混ざった n_pages ページを別プロセスで処理して比較する
+    """
+    import multiprocessing
+    print(f"=== buffer_pool ({n_pages} pages) ===")
+    h, w = page.shape[:2]
+    shapes = ((h, w), (h + h // 10, w + w // 10))
+    with multiprocessing.get_context("spawn").Pool(2) as pool:
+        legacy, new = pool.starmap(_pool_run, [(False, n_pages, shapes), (True, n_pages, shapes)])
+    for name, stats in (("no pool", legacy), ("pool", new)):
+        print(f"  {name:<8} borrows={stats['borrows']}  hits={stats['hits']}  "
+              f"allocations={stats['allocations']} ({stats['allocated_bytes'] / 2 ** 20:.0f} MiB)  "
+              f"peak RSS={stats['peak_rss_mb']:.0f} MiB")
+    _report("frame detection", legacy["seconds"], new["seconds"])
+
+
+def record_nbytes(record, shared: Tuple[np.ndarray, ...] = ()) -> int:
+    """
+    レコードが保持するオブジェクトの合計サイズ（配列はデータ部を含む）
+    shared に含まれる配列（切り出し元ページなど、レコード間で共有するもの）は数えない
+    """
+    seen = {id(arr) for arr in shared}
+    for arr in shared:
+        if arr.base is not None:
+            seen.add(id(arr.base))
+
+    def size(value) -> int:
+        if id(value) in seen or value is None:
+            return 0
+        seen.add(id(value))
+        total = sys.getsizeof(value)
+        if isinstance(value, np.ndarray):
+            return total if value.base is None else total + size(value.base)
+        if isinstance(value, (tuple, list)):
+            return total + sum(size(v) for v in value)
+        if hasattr(value, "__dict__"):
+            return total + sys.getsizeof(value.__dict__) + sum(size(v) for v in vars(value).values())
+        for slot in getattr(type(value), "__slots__", ()):
+            total += size(getattr(value, slot, None))
+        return total
+
+    return size(record)
+
+
+@dataclass
+class LegacyPanel:
+    """旧 Panel（RGBA画像を作成して保持するデータクラス）"""
+    image: np.ndarray
+    bbox: Tuple[int, int, int, int]
+    corners: Points
+    page_idx: int
+    panel_idx: int
+
+
+@dataclass
+class LegacyBalloon:
+    """旧 Balloon（RGBA画像と全輪郭点を保持するデータクラス）"""
+    image: np.ndarray
+    bbox: Tuple[int, int, int, int]
+    contour: np.ndarray
+    center: Tuple[int, int]
+    area: float
+    circularity: float
+    type: int
+    bw_ratio: float
+    panel_idx: int
+
+
+def bench_records(page: np.ndarray, n_pages: int = 100) -> None:
+    """
+    コマ・吹き出しレコードのメモリ（旧: RGBA画像と全輪郭点を保持 / 新: 圧縮輪郭と元ページへの参照）
+    n_pages ページ分のレコードを保持したときの1レコードあたりのサイズを比較する
+    """
+    print(f"=== records ({n_pages} pages) ===")
+    processor = _make_processor()
+    pages = [page, make_slanted_page(*page.shape[:2]), make_flashback_page(*page.shape[:2])]
+    panels, balloons, sources = [], [], []
+    for i in range(n_pages):
+        ctx = PageContext(pages[i % len(pages)])
+        page_panels = processor.frame_detect(ctx)
+        for owned in processor.speechballoon_detect_page(ctx, page_panels):
+            balloons.extend(owned)
+        panels.extend(page_panels)
+        sources.append(ctx.page)
+    legacy_panels = [LegacyPanel(p.image, p.bbox, p.corners, p.page_idx, p.panel_idx) for p in panels]
+    legacy_balloons = [LegacyBalloon(b.image, b.bbox, b.contour, b.center, b.area, b.circularity,
+                                     b.type, b.bw_ratio, b.panel_idx) for b in balloons]
+    shared = tuple(sources)
+    for name, legacy, new in (("panel", legacy_panels, panels), ("balloon", legacy_balloons, balloons)):
+        if not new:
+            continue
+        legacy_bytes = sum(record_nbytes(r, shared) for r in legacy) / len(legacy)
+        new_bytes = sum(record_nbytes(r, shared) for r in new) / len(new)
+        print(f"  {name:<8} n={len(new):5d}  legacy={legacy_bytes / 1024:8.1f} KiB/record  "
+              f"new={new_bytes / 1024:6.2f} KiB/record  (x{legacy_bytes / new_bytes:.0f} smaller)")
+    page_bytes = sum({id(src.base): src.base.nbytes for src in sources}.values())
+    print(f"  shared source pages: {page_bytes / 2 ** 20:.1f} MiB (referenced by the lazy records)")
+    build_sec = _best_time(lambda: [r.image for r in panels + balloons])
+    print(f"  image build on read: {build_sec * 1000 / (len(panels) + len(balloons)):.3f} ms/record")
+
+
+def bench_threads(page: np.ndarray, threads: int = 4) -> None:
+    """
+    見開き1枚の処理時間（旧: ページ・コマを逐次処理 / 新: スレッドプールで並列処理）
+    単一画像の低遅延処理向け
+    """
+    print(f"=== threads (spread, {threads} threads) ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        spread_path = os.path.join(tmp, "spread.jpg")
+        cv2.imwrite(spread_path, np.hstack([page, make_slanted_page(*page.shape[:2])]))
+        latency = {}
+        for n in (1, threads):
+            processor = MangaProcessor(tmp, os.path.join(tmp, f"out{n}"), threads=n, verbose=False)
+            latency[n] = _best_time(processor.process_image, 0, spread_path)
+    _report("per-image latency", latency[1], latency[threads])
+
+
+def _transport_sender(mode: str, queue, ring_name: Optional[str], n_images: int,
+                      shape: Tuple[int, int]) -> None:
+    """見開きページとRGBAのコマ切り出し4枚を n_images 回送る（bench_transport 用）"""
+    from shm_transport import ShmRing
+    h, w = shape
+    page = np.random.default_rng(0).integers(0, 256, (h, w), dtype=np.uint8)
+    crops = [cv2.cvtColor(page[: h // 2, k * w // 4:(k + 1) * w // 4], cv2.COLOR_GRAY2BGRA) for k in range(4)]
+    ring = ShmRing.attach(ring_name) if mode == "shm" else None
+    for _ in range(n_images):
+        arrays = [page] + crops
+        if ring is not None:
+            # 空きがなければ pickle で送る
+            arrays = [ring.put(a) or a for a in arrays]
+        queue.put(arrays)
+    if ring is not None:
+        ring.close()
+
+
+def bench_transport(page: np.ndarray, n_images: int = 200) -> None:
+    """
+    ワーカープロセスからのページ・切り出し画像の受け渡し（旧: pickle / 新: 共有メモリのリング）
+    1654x1170 の見開きとRGBAのコマ4枚を n_images 回送り、受け取り側でコピーし終えるまでの時間
+    """
+    import multiprocessing
+    from shm_transport import ShmHandle, ShmRing, receive
+    shape = (1170, 1654)
+    per_image = shape[0] * shape[1] * 3   # ページ + ページ半分のRGBA切り出し
+    print(f"=== transport ({n_images} spreads, {per_image / 2 ** 20:.1f} MiB each) ===")
+    ctx = multiprocessing.get_context("spawn")
+    seconds = {}
+    for mode in ("pickle", "shm"):
+        ring = ShmRing.create(64 * 2 ** 20) if mode == "shm" else None
+        try:
+            queue = ctx.Queue(maxsize=8)
+            sender = ctx.Process(target=_transport_sender,
+                                 args=(mode, queue, ring.name if ring else None, n_images, shape))
+            sender.start()
+            queue.get()     # プロセス起動時間を除くため、1回目を受け取ってから計測
+            start = time.perf_counter()
+            for _ in range(n_images - 1):
+                arrays = queue.get()
+                if ring is not None:
+                    received = receive({ring.name: ring}, [a for a in arrays if isinstance(a, ShmHandle)])
+                    arrays = [received.get(a, a) if isinstance(a, ShmHandle) else a for a in arrays]
+            seconds[mode] = time.perf_counter() - start
+            sender.join()
+        finally:
+            if ring is not None:
+                ring.close()
+        print(f"  {mode:<7} {seconds[mode] * 1000 / (n_images - 1):7.2f} ms/spread  "
+              f"{per_image * (n_images - 1) / seconds[mode] / 2 ** 30:5.2f} GiB/s")
+    _report("transfer per spread", seconds["pickle"] / (n_images - 1), seconds["shm"] / (n_images - 1))
+
+
+def _stream_peak(processor: MangaProcessor, streaming: bool) -> Tuple[float, float]:
+    """(最初の結果までの秒数, tracemalloc のピーク MiB)"""
+    import tracemalloc
+    tracemalloc.start()
+    start = time.perf_counter()
+    first = None
+    if streaming:
+        for _ in processor.iter_process():
+            # 結果は下流（索引付けなど）に渡したら保持しない
+            first = first or time.perf_counter() - start
+    else:
+        processor.process_images()
+        first = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first, peak / 2 ** 20
+
+
+def bench_streaming(page: np.ndarray) -> None:
+    """
+    フォルダの処理（旧: process_images() で全結果を集めて返す / 新: iter_process() で1枚ずつ受け取る）
+    フォルダの画像数を変えて、最初の結果までの時間とメモリのピークを比較する
+    """
+    print("=== streaming ===")
+    spread = np.hstack([page, make_slanted_page(*page.shape[:2])])
+    for n_images in (8, 32):
+        with tempfile.TemporaryDirectory() as tmp:
+            input_dir = os.path.join(tmp, "in")
+            os.makedirs(input_dir)
+            for i in range(n_images):
+                cv2.imwrite(os.path.join(input_dir, f"{i:03d}.jpg"), spread)
+            for streaming in (False, True):
+                processor = MangaProcessor(input_dir, os.path.join(tmp, f"out{streaming}"), verbose=False)
+                first, peak = _stream_peak(processor, streaming)
+                label = "iter_process" if streaming else "process_images"
+                print(f"  {n_images:3d} images  {label:<15} first result={first * 1000:8.1f} ms  "
+                      f"peak={peak:7.1f} MiB")
+
+
+def bench_prefetch(page: np.ndarray, n_images: int = 16, latency: float = 0.05, depth: int = 4) -> None:
+    """
+    フォルダの処理（旧: 画像ごとに読み込んでから処理 / 新: 次の depth 枚を先読み）
+    ネットワーク越しのフォルダを模擬して、読み込みごとに latency 秒の遅延を加える
+    """
+    print(f"=== prefetch ({n_images} spreads, +{latency * 1000:.0f} ms per read, depth {depth}) ===")
+    read_gray = manga_processor.read_gray
+    spread = np.hstack([page, make_slanted_page(*page.shape[:2])])
+    seconds = {}
+    with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(manga_processor, "read_gray",
+                              lambda path: time.sleep(latency) or read_gray(path)):
+        input_dir = os.path.join(tmp, "in")
+        os.makedirs(input_dir)
+        for i in range(n_images):
+            cv2.imwrite(os.path.join(input_dir, f"{i:03d}.jpg"), spread)
+        for prefetch in (0, depth):
+            processor = MangaProcessor(input_dir, os.path.join(tmp, f"out{prefetch}"), prefetch=prefetch,
+                                       verbose=False)
+            start = time.perf_counter()
+            results = list(processor.iter_process())
+            seconds[prefetch] = time.perf_counter() - start
+            wait = sum(r.timings["decode"] for r in results)
+            compute = sum(r.timings["detect"] for r in results)
+            print(f"  prefetch={prefetch}  wall={seconds[prefetch]:6.2f} s  decode wait={wait:6.2f} s  "
+                  f"compute={compute:6.2f} s")
+    _report("folder wall time", seconds[0], seconds[depth])
+
+
+def bench_writer(page: np.ndarray, n_images: int = 8, latency: float = 0.005) -> None:
+    """
+    コマ・吹き出し画像の保存（旧: 検出処理の中で cv2.imwrite / 新: CropWriter で並行して保存）
+    ネットワーク越しの保存先を模擬して、保存ごとに latency 秒の遅延を加える
+    """
+    import crop_writer
+    print(f"=== writer ({n_images} spreads, +{latency * 1000:.0f} ms per write) ===")
+    write_image = crop_writer.write_image
+    spread = np.hstack([page, make_slanted_page(*page.shape[:2])])
+    seconds = {}
+    with tempfile.TemporaryDirectory() as tmp, \
+            mock.patch.object(crop_writer, "write_image",
+                              lambda *args: time.sleep(latency) or write_image(*args)):
+        input_dir = os.path.join(tmp, "in")
+        os.makedirs(input_dir)
+        for i in range(n_images):
+            cv2.imwrite(os.path.join(input_dir, f"{i:03d}.jpg"), spread)
+        for writers in (0, 2):
+            processor = MangaProcessor(input_dir, os.path.join(tmp, f"out{writers}"), writers=writers,
+                                       verbose=False)
+            start = time.perf_counter()
+            processor.process_images()
+            seconds[writers] = time.perf_counter() - start
+            stats = processor.writer_stats
+            print(f"  writers={writers}  wall={seconds[writers]:6.2f} s  files={stats['written']}  "
+                  f"backpressure wait={stats['blocked_seconds']:.2f} s")
+    _report("folder wall time", seconds[0], seconds[2])
+
+
+def _sample_crops(page: np.ndarray, tmp: str):
+    """
+    合成の見開き3枚を tmp に書き出して処理し、(processor, [(切り出し画像, 元ページの参照), ...]) を返す
+    """
+    input_dir = os.path.join(tmp, "in")
+    os.makedirs(input_dir)
+    h, w = page.shape[:2]
+    spreads = [np.hstack([page, make_slanted_page(h, w)]),
+               np.hstack([make_flashback_page(h, w), page[:, ::-1]]),
+               np.hstack([page[:, ::-1], page])]
+    for i, spread in enumerate(spreads):
+        cv2.imwrite(os.path.join(input_dir, f"{i:03d}.jpg"), spread)
+    processor = MangaProcessor(input_dir, os.path.join(tmp, "out"), verbose=False)
+    crops = []
+    for result in processor.iter_process():
+        for panel in result.panels:
+            crops.append((panel.image, {"source": result.path, "page": panel.page_idx, "bbox": panel.bbox}))
+        for balloon in result.balloons:
+            page_idx = result.panels[balloon.panel_idx].page_idx
+            crops.append((balloon.image, {"source": result.path, "page": page_idx,
+                                          "bbox": balloon.source_bbox}))
+    return processor, crops
+
+
+def bench_crop_format(page: np.ndarray, formats: Tuple[str, ...] = ("png", "png:0", "png:9", "webp",
+                                                                   "npy", "mask")) -> None:
+    """
+    切り出し画像の保存形式ごとの圧縮時間・ファイルサイズ・読み込み時間
+    （合成の見開き3枚から検出したコマ・吹き出しを1つずつ保存して比較する）
+    """
+    from crop_writer import CropFormat, decode_crop
+    print("=== crop_format ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        processor, crops = _sample_crops(page, tmp)
+        raw_bytes = sum(image.nbytes for image, _ in crops)
+        print(f"  {len(crops)} crops, {raw_bytes / 2 ** 20:.1f} MiB as BGRA")
+        
+        # mask 形式の復元で読み込むページは読み込み済みのものを使う（ページの読み込み時間は含めない）
+        pages = {}
+        
+        def load_page(path: str, page_idx: int) -> np.ndarray:
+            if (path, page_idx) not in pages:
+                pages[path, page_idx] = processor.load_page(path, page_idx)
+            return pages[path, page_idx]
+        
+        for spec in formats:
+            fmt = CropFormat.parse(spec)
+            encode_sec = _best_time(lambda: [fmt.encode(image, ref) for image, ref in crops])
+            paths = []
+            for n, (image, ref) in enumerate(crops):
+                path = os.path.join(tmp, f"{spec.replace(':', '_')}_{n}{fmt.suffix}")
+                fmt.write(path, image, ref)
+                paths.append(path)
+            size = sum(os.path.getsize(path) for path in paths)
+            decode_crop(paths[0], load_page)
+            decode_sec = _best_time(lambda: [decode_crop(path, load_page) for path in paths])
+            print(f"  {spec:<6} encode={encode_sec * 1000 / len(crops):7.3f} ms/crop  "
+                  f"bytes={size / len(crops) / 1024:8.1f} KiB/crop ({100.0 * size / raw_bytes:5.1f}%)  "
+                  f"decode={decode_sec * 1000 / len(crops):7.3f} ms/crop")
+
+
+
+def bench_shards(page: np.ndarray, copies: int = 20, shard_mb: int = 16) -> None:
+    """
+    切り出し画像を1ファイルずつ保存する場合と tar シャードにまとめる場合の
+    作成ファイル数・保存時間・キーを指定した読み出し時間
+    （合成の見開き3枚の切り出し画像を copies 回繰り返して、1巻分程度の件数にする）
+    """
+    import random
+    from crop_writer import CropWriter, decode_crop
+    from shard_archive import ShardReader, ShardWriter
+    print("=== shards ===")
+    with tempfile.TemporaryDirectory() as tmp:
+        _, crops = _sample_crops(page, tmp)
+        names = [f"panels/{n // len(crops):03d}_0_{n % len(crops)}.png" for n in range(copies * len(crops))]
+        print(f"  {len(names)} crops")
+        sample = random.Random(0).sample(names, min(200, len(names)))
+        
+        def write(root: str, sharded: bool) -> None:
+            os.makedirs(os.path.join(root, "panels"))
+            sink = ShardWriter(os.path.join(root, "shards"), max_bytes=shard_mb * 2 ** 20,
+                               base=root) if sharded else None
+            with CropWriter(workers=2, sink=sink) as writer:
+                for n, name in enumerate(names):
+                    writer.submit(os.path.join(root, name), crops[n % len(crops)][0])
+        
+        for sharded in (False, True):
+            label = "shards" if sharded else "files"
+            roots = []
+            
+            def run() -> None:
+                roots.append(os.path.join(tmp, f"{label}{len(roots)}"))
+                write(roots[-1], sharded)
+            
+            write_sec = _best_time(run)
+            root = roots[-1]
+            files = sum(len(f) for _, _, f in os.walk(root))
+            size = sum(os.path.getsize(os.path.join(d, f)) for d, _, fs in os.walk(root) for f in fs)
+            if sharded:
+                with ShardReader(os.path.join(root, "shards")) as reader:
+                    read_sec = _best_time(lambda: [reader.read(name) for name in sample])
+            else:
+                read_sec = _best_time(lambda: [decode_crop(os.path.join(root, name)) for name in sample])
+            print(f"  {label:<6} files={files:6d}  bytes={size / 2 ** 20:7.1f} MiB  "
+                  f"write={write_sec * 1000 / len(names):6.3f} ms/crop  "
+                  f"random read={read_sec * 1000 / len(sample):6.3f} ms/crop")
+
+
+
+def bench_atlas(page: np.ndarray, pages: int = 16, balloons_per_page: int = 12) -> None:
+    """
+    吹き出し画像を1つずつ読み込む場合と、ページごとのアトラスから切り出す場合の
+    開くファイル数・全吹き出しの読み込み時間
+    （1ページ balloons_per_page 個の合成の吹き出しを、pages ページ分保存して比較する）
+    """
+    import json
+    from crop_writer import decode_crop
+    from sprite_atlas import BalloonAtlas, atlas_name, build_atlas
+    print("=== atlas ===")
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        paths, json_paths = [], []
+        for j in range(pages):
+            balloons = {f"000_{j}_{n // 3}_{n % 3}": make_balloon_image(int(rng.integers(60, 220)),
+                                                                    int(rng.integers(60, 220)), seed=n)
+                        for n in range(balloons_per_page)}
+            for key, image in balloons.items():
+                paths.append(os.path.join(tmp, f"{key}.png"))
+                cv2.imwrite(paths[-1], image)
+            atlas, rects = build_atlas(list(balloons.values()))
+            name = atlas_name(0, j)
+            cv2.imwrite(os.path.join(tmp, name + ".png"), atlas)
+            json_paths.append(os.path.join(tmp, name + ".json"))
+            with open(json_paths[-1], "w", encoding="utf-8") as f:
+                json.dump({"image": name + ".png", "balloons": {key: {"rect": list(rect)}
+                                                               for key, rect in zip(balloons, rects)}}, f)
+        
+        def load_files() -> int:
+            return sum(decode_crop(path).size for path in paths)
+        
+        def load_atlases() -> int:
+            return sum(crop.size for path in json_paths for _, crop in BalloonAtlas.load(path).items())
+        
+        assert load_files() == load_atlases()
+        print(f"  {len(paths)} balloons on {pages} pages: {len(paths)} files -> {2 * pages} files (atlas + JSON)")
+        _report("load all balloons", _best_time(load_files), _best_time(load_atlases))
+
+
+def run_page_stages(processor: MangaProcessor, page: np.ndarray, shared: bool) -> Dict[str, int]:
+    """
+    ページ分類 → フレーム検出 → ページ単位の吹き出し検出を実行し、
+    前処理の要求回数・計算回数・確保サイズの合計を返す
+    shared=False は各処理にページ配列を渡す（処理ごとに前処理をやり直す旧来の流れ）
+    """
+    contexts = [PageContext(page) for _ in range(1 if shared else 3)]
+    classify_ctx, frame_ctx, balloon_ctx = (contexts * 3)[:3]
+    processor.get_page_type(classify_ctx)
+    panels = processor.frame_detect(frame_ctx)
+    processor.speechballoon_detect_page(balloon_ctx, panels, processor.speechballoon_max)
+    totals = {"requests": 0, "computed": 0, "allocated_bytes": 0, "page_copies": 0}
+    for ctx in contexts:
+        for key, value in ctx.stats().items():
+            totals[key] += value
+    return totals
+
+
+def bench_page_context(page: np.ndarray) -> None:
+    """ページ単位の前処理（旧: 処理ごとに再計算 / 新: PageContext で共有）"""
+    print("=== page_context ===")
+    processor = _make_processor()
+    for shared in (False, True):
+        stats = run_page_stages(processor, page, shared)
+        label = "shared context" if shared else "per-stage context"
+        print(f"  {label:<18} requests={stats['requests']:3d}  computed={stats['computed']:3d}  "
+              f"allocated={stats['allocated_bytes'] / 1e6:6.2f} MB  full-page copies={stats['page_copies']}")
+    _report("page stages", _best_time(run_page_stages, processor, page, False),
+            _best_time(run_page_stages, processor, page, True))
+
+
+BENCHMARKS: Dict[str, Callable[[np.ndarray], None]] = {
+    "page_type": bench_page_type,
+    "projection_profile": bench_projection_profile,
+    "alpha_image": bench_alpha_image,
+    "false_balloons": bench_false_balloons,
+    "speechballoon": bench_speechballoon,
+    "page_context": bench_page_context,
+    "pyramid": bench_pyramid,
+    "hough": bench_hough,
+    "xy_cut": bench_xy_cut,
+    "black_page": bench_black_page,
+    "buffer_pool": bench_buffer_pool,
+    "records": bench_records,
+    "threads": bench_threads,
+    "transport": bench_transport,
+    "streaming": bench_streaming,
+    "prefetch": bench_prefetch,
+    "writer": bench_writer,
+    "crop_format": bench_crop_format,
+    "shards": bench_shards,
+    "atlas": bench_atlas,
+}
+
+
+def load_page(image_path: Optional[str]) -> np.ndarray:
+    """ベンチマーク対象ページを読み込む（指定がなければ合成ページ）"""
+    if image_path is None:
+        return make_synthetic_page()
+    img = cv2.imread(image_path, 0)
+    if img is None:
+        raise FileNotFoundError(f"Cannot load image from {image_path}")
+    return img
+
+
+def main():
+    names = list(BENCHMARKS)
+    image_path = None
+    if len(sys.argv) > 1:
+        if sys.argv[1] in BENCHMARKS:
+            names = [sys.argv[1]]
+            image_path = sys.argv[2] if len(sys.argv) > 2 else None
+        else:
+            image_path = sys.argv[1]
+
+    page = load_page(image_path)
+    print(f"Page shape: {page.shape}")
+    for name in names:
+        BENCHMARKS[name](page)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+buffer_pool.py
+==============
+
+ページ単位の作業用配列（直線画像、論理積画像、BGRA画像など）を使い回すためのプール
+
+同じ巻のページはほとんど同じ大きさなので、(shape, channels) ごとに確保済みの
+uint8 配列を貸し出し、返却時に0で初期化して次の貸し出しに回す。
+保持する合計サイズが max_bytes を超えた場合は、最も長く使われていない
+大きさの配列から解放する。
+"""
+
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+import numpy as np
+
+PoolKey = Tuple[Tuple[int, int], int]
+
+
+class BufferPool:
+    """(shape, channels) ごとに uint8 の作業用配列を貸し出すプール"""
+
+    def __init__(self, max_bytes: int = 128 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self._free: "OrderedDict[PoolKey, List[np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.pooled_bytes = 0       # 返却されてプールに保持している合計サイズ
+        self.borrows = 0            # 貸し出し回数
+        self.hits = 0               # 保持していた配列を貸し出した回数
+        self.allocations = 0        # 新たに確保した回数
+        self.allocated_bytes = 0    # 新たに確保した合計サイズ
+
+    @staticmethod
+    def key(shape: Sequence[int], channels: int = 1) -> PoolKey:
+        return (int(shape[0]), int(shape[1])), int(channels)
+
+    def borrow(self, shape: Sequence[int], channels: int = 1) -> np.ndarray:
+        """0で初期化された (h, w) または (h, w, channels) の uint8 配列を借りる"""
+        key = self.key(shape, channels)
+        with self._lock:
+            self.borrows += 1
+            free = self._free.get(key)
+            if free:
+                buf = free.pop()
+                self.pooled_bytes -= buf.nbytes
+                self.hits += 1
+                self._free.move_to_end(key)
+                return buf
+        dims = key[0] if channels == 1 else key[0] + (channels,)
+        buf = np.zeros(dims, dtype=np.uint8)
+        with self._lock:
+            self.allocations += 1
+            self.allocated_bytes += buf.nbytes
+        return buf
+
+    def release(self, buf: np.ndarray) -> None:
+        """借りた配列を0で初期化して返却する"""
+        if buf.nbytes > self.max_bytes:
+            return
+        buf.fill(0)
+        key = self.key(buf.shape, buf.shape[2] if buf.ndim == 3 else 1)
+        with self._lock:
+            self._free.setdefault(key, []).append(buf)
+            self._free.move_to_end(key)
+            self.pooled_bytes += buf.nbytes
+            # 上限を超えたら最も長く使われていない大きさから解放
+            while self.pooled_bytes > self.max_bytes:
+                _, evicted = self._free.popitem(last=False)
+                self.pooled_bytes -= sum(b.nbytes for b in evicted)
+
+    @contextmanager
+    def lease(self, shape: Sequence[int], channels: int = 1) -> Iterator[np.ndarray]:
+        """with 文の間だけ配列を借りる"""
+        buf = self.borrow(shape, channels)
+        try:
+            yield buf
+        finally:
+            self.release(buf)
+
+    def stats(self) -> Dict[str, float]:
+        """貸し出し回数・ヒット率・確保回数と確保サイズ"""
+        return {
+            "borrows": self.borrows,
+            "hits": self.hits,
+            "hit_rate": self.hits / self.borrows if self.borrows else 0.0,
+            "allocations": self.allocations,
+            "allocated_bytes": self.allocated_bytes,
+        }
@@ -0,0 +1,270 @@
+"""
+crop_writer.py
+==============
+
+コマ・吹き出しの切り出し画像を、検出処理と並行してスレッドプールでPNG圧縮・保存する
+
+submit() で保存を依頼すると、書き込み待ちが max_pending 件に達している間は
+空きができるまで待つ（保存が追いつかない場合に検出側を止めて、メモリを一定に保つ）。
+書き込みに失敗したファイルは記録しておき、close() ですべての保存を待ってから
+CropWriteError としてまとめて報告する。workers=0 の場合は submit() の中で保存する。
+sink に ShardWriter を渡すと、ファイルを作らずに tar シャードへ追記する（shard_archive.py）。
+
+保存形式（CropFormat.parse() の指定）:
+- png / png:N   PNG（N は圧縮レベル0〜9、省略時は OpenCV の既定）
+- webp          可逆WebP（完全に透明な画素の色は保存しない）
+- npy           無圧縮の配列（np.save）
+- mask          1ビットのアルファと、元ページ上の bbox・元画像のパス・ページ番号（圧縮 .npz）。
+                画素は元ページから切り出して復元する
+"""
+
+import io
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+import cv2
+import numpy as np
+
+if TYPE_CHECKING:
+    from shard_archive import ShardWriter
+
+PathLike = Union[str, Path]
+
+
+class CropWriteError(OSError):
+    """
+    保存に失敗したファイルの一覧 (path, 例外) を持つ例外
+    ワーカープロセスから受け渡す（pickle する）と、例外はメッセージの文字列になる
+    """
+
+    def __init__(self, failures: List[Tuple[str, Union[BaseException, str]]]):
+        self.failures = failures
+        shown = ", ".join(f"{path} ({error})" for path, error in failures[:5])
+        more = f" and {len(failures) - 5} more" if len(failures) > 5 else ""
+        super().__init__(f"failed to write {len(failures)} file(s): {shown}{more}")
+
+    def __reduce__(self):
+        # OSError の既定ではメッセージが failures として渡され、復元できない
+        return CropWriteError, ([(path, str(error)) for path, error in self.failures],)
+
+
+def write_image(path: PathLike, image: np.ndarray, params: Sequence[int] = ()) -> None:
+    """画像を保存する（cv2.imwrite が失敗した場合は OSError）"""
+    if not cv2.imwrite(str(path), image, list(params)):
+        raise OSError(f"cv2.imwrite failed for {path}")
+
+
+# mask 形式の復元に使う元ページの参照（source: 元画像のパス, page: ページ番号, bbox: ページ上の (x, y, w, h)）
+CropRef = Dict[str, Any]
+
+
+@dataclass(frozen=True)
+class CropFormat:
+    """切り出し画像の保存形式"""
+    kind: str = "png"               # png / webp / npy / mask
+    level: Optional[int] = None     # PNGの圧縮レベル（None: OpenCVの既定）
+
+    KINDS = ("png", "webp", "npy", "mask")
+    SUFFIXES = {"png": ".png", "webp": ".webp", "npy": ".npy", "mask": ".npz"}
+
+    @classmethod
+    def parse(cls, spec: Union[str, "CropFormat"]) -> "CropFormat":
+        """"png" / "png:N" / "webp" / "npy" / "mask" を解釈する"""
+        if isinstance(spec, CropFormat):
+            return spec
+        kind, _, level = spec.lower().partition(":")
+        if kind not in cls.KINDS or (level and (kind != "png" or not level.isdigit() or int(level) > 9)):
+            raise ValueError(f"invalid crop format '{spec}' (expected png, png:0-9, webp, npy or mask)")
+        return cls(kind, int(level) if level else None)
+
+    @property
+    def suffix(self) -> str:
+        return self.SUFFIXES[self.kind]
+
+    @property
+    def params(self) -> List[int]:
+        """cv2.imwrite / cv2.imencode に渡す引数"""
+        if self.kind == "png" and self.level is not None:
+            return [cv2.IMWRITE_PNG_COMPRESSION, self.level]
+        if self.kind == "webp":
+            return [cv2.IMWRITE_WEBP_QUALITY, 101]   # 100を超える値で可逆圧縮
+        return []
+
+    def encode(self, image: np.ndarray, ref: Optional[CropRef] = None) -> bytes:
+        """ファイルに書き込む内容を返す"""
+        if self.kind in ("png", "webp"):
+            ok, buf = cv2.imencode(self.suffix, image, self.params)
+            if not ok:
+                raise OSError(f"cv2.imencode failed for {self.suffix}")
+            return buf.tobytes()
+        out = io.BytesIO()
+        if self.kind == "npy":
+            np.save(out, image)
+        else:
+            if ref is None:
+                raise ValueError("mask format needs a reference to the source page")
+            if image.ndim == 3 and image.shape[2] == 4:
+                alpha = image[:, :, 3]
+            else:
+                alpha = np.full(image.shape[:2], 255, dtype=np.uint8)
+            np.savez_compressed(out, alpha=np.packbits(alpha > 0), shape=np.array(alpha.shape),
+                     bbox=np.array(ref["bbox"]), source=np.array(str(ref["source"])), page=np.array(ref["page"]))
+        return out.getvalue()
+
+    def write(self, path: PathLike, image: np.ndarray, ref: Optional[CropRef] = None) -> None:
+        """画像を保存する（path の拡張子は形式に合わせて置き換える）"""
+        path = Path(path).with_suffix(self.suffix)
+        if self.kind in ("png", "webp"):
+            write_image(path, image, self.params)
+        else:
+            path.write_bytes(self.encode(image, ref))
+
+
+def decode_crop_bytes(data: bytes, suffix: str,
+                      load_page: Optional[Callable[[str, int], np.ndarray]] = None) -> np.ndarray:
+    """
+    保存した内容（拡張子 suffix の形式）をBGRA画像に戻す
+    mask 形式は load_page(元画像のパス, ページ番号) で元ページを読み込んで復元する
+    """
+    if suffix == ".npy":
+        return np.load(io.BytesIO(data))
+    if suffix == ".npz":
+        if load_page is None:
+            raise ValueError("mask crops need load_page to restore pixels")
+        with np.load(io.BytesIO(data)) as arrays:
+            h, w = (int(v) for v in arrays["shape"])
+            x, y, bw, bh = (int(v) for v in arrays["bbox"])
+            alpha = np.unpackbits(arrays["alpha"], count=h * w).reshape(h, w) * np.uint8(255)
+            page = load_page(str(arrays["source"]), int(arrays["page"]))
+        roi = page[y:y + bh, x:x + bw]
+        image = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGRA if roi.ndim == 2 else cv2.COLOR_BGR2BGRA)
+        image[:, :, 3] = alpha
+        return image
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise OSError(f"cannot decode {suffix} crop")
+    # 不透明な画像は3チャンネルで読み込まれる
+    if image.ndim == 2 or image.shape[2] == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGRA if image.ndim == 2 else cv2.COLOR_BGR2BGRA)
+    return image
+
+
+def decode_crop(path: PathLike, load_page: Optional[Callable[[str, int], np.ndarray]] = None) -> np.ndarray:
+    """保存した切り出し画像をBGRA画像として読み込む（mask 形式は load_page で元ページから復元）"""
+    path = Path(path)
+    return decode_crop_bytes(path.read_bytes(), path.suffix, load_page)
+
+
+class CropWriter:
+    """書き込み待ちの上限つきで切り出し画像を保存するスレッドプール"""
+
+    def __init__(self, workers: int = 2, max_pending: int = 32,
+                 fmt: Union[str, CropFormat] = "png", sink: Optional["ShardWriter"] = None):
+        self.workers = workers
+        self.format = CropFormat.parse(fmt)
+        self.sink = sink    # 指定した場合はファイルではなくシャードに追記する（close() で閉じる）
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pending: Dict[Future, str] = {}
+        self.failures: List[Tuple[str, BaseException]] = []
+        self.written = 0            # 保存したファイル数
+        self.blocked_seconds = 0.0  # 書き込み待ちが上限に達して submit() で待った時間
+        self._closed = False
+
+    def submit(self, path: PathLike, image: np.ndarray, ref: Optional[CropRef] = None) -> None:
+        """
+        保存を依頼する（書き込み待ちが上限なら空くまで待つ）
+        path の拡張子は保存形式に合わせて置き換え、mask 形式では ref に元ページの参照を渡す
+        """
+        if self._closed:
+            raise RuntimeError("CropWriter is closed")
+        if self._executor is None:
+            self._write(str(path), image, ref)
+            return
+        if not self._slots.acquire(blocking=False):
+            start = time.perf_counter()
+            self._slots.acquire()
+            with self._lock:
+                self.blocked_seconds += time.perf_counter() - start
+        future = self._executor.submit(self._write, str(path), image, ref)
+        with self._lock:
+            self._pending[future] = str(path)
+        future.add_done_callback(self._done)
+
+    def write_bytes(self, path: PathLike, data: bytes) -> None:
+        """画像以外の小さなファイル（JSON など）をその場で保存する（失敗は failures に記録）"""
+        if self._closed:
+            raise RuntimeError("CropWriter is closed")
+        try:
+            if self.sink is not None:
+                self.sink.add(path, data)
+            else:
+                Path(path).write_bytes(data)
+        except Exception as e:
+            with self._lock:
+                self.failures.append((str(path), e))
+            return
+        with self._lock:
+            self.written += 1
+
+    def _write(self, path: str, image: np.ndarray, ref: Optional[CropRef]) -> None:
+        try:
+            if self.sink is not None:
+                self.sink.add(Path(path).with_suffix(self.format.suffix), self.format.encode(image, ref))
+            else:
+                self.format.write(path, image, ref)
+        except Exception as e:
+            with self._lock:
+                self.failures.append((str(Path(path).with_suffix(self.format.suffix)), e))
+            return
+        with self._lock:
+            self.written += 1
+
+    def _done(self, future: Future) -> None:
+        with self._lock:
+            self._pending.pop(future, None)
+        self._slots.release()
+
+    def flush(self) -> None:
+        """依頼済みの保存がすべて終わるまで待つ"""
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            for future in pending:
+                future.result()
+
+    def close(self, raise_errors: bool = True) -> None:
+        """
+        すべての保存を待ってからスレッドを終了する
+        失敗したファイルがあれば CropWriteError を送出する（raise_errors=False なら送出しない）
+        """
+        if not self._closed:
+            self._closed = True
+            self.flush()
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+            if self.sink is not None:
+                self.sink.close()
+        if raise_errors and self.failures:
+            raise CropWriteError(self.failures)
+
+    def stats(self) -> Dict[str, float]:
+        """保存数・失敗数・書き込み待ちで止まった時間"""
+        with self._lock:
+            return {"written": self.written, "failed": len(self.failures),
+                    "blocked_seconds": self.blocked_seconds}
+
+    def __enter__(self) -> "CropWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        # 処理中の例外がある場合はそちらを優先し、保存の失敗は failures に残す
+        self.close(raise_errors=exc_type is None)
+
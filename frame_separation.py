@@ -23,11 +23,22 @@ import math
 import os
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterable, List, Sequence, Tuple
+from typing import List, Sequence, Tuple
 
 import cv2
 import numpy as np
 
+from buffer_pool import BufferPool
+from crop_writer import CropWriter, write_image
+from array_ops import (
+    PANEL_AREA_RATIO,
+    contour_features,
+    hough_line_evidence,
+    profile_extent,
+    projection_profile,
+    prune_nested_contours,
+)
+
 Point = Tuple[int, int]
 
 
@@ -124,9 +135,18 @@ class PanelDetection:
 class FrameDetector:
     """Python port of ``Framedetect`` from the C++ implementation."""
 
-    def __init__(self) -> None:
+    def __init__(self, debug: bool = False) -> None:
+        # When ``debug`` is set, detected quads are drawn on ``debug_page`` (a colour copy of the page).
+        self.debug = debug
+        self.debug_page: np.ndarray | None = None
+        # Full-page copies made by the last ``detect_panels`` call (only the debug overlay copies the page).
+        self.page_copies = 0
         self.page_corners = PanelQuad((0, 0), (0, 0), (0, 0), (0, 0))
         self.page_corners.renew_lines()
+        # Balloon candidates passing the shape filter and how many each pruning rule removed.
+        self.balloon_prune_stats = {"candidates": 0, "hole": 0, "duplicate": 0}
+        # Page-sized scratch canvases (line image, AND image) reused across pages.
+        self.buffer_pool = BufferPool()
 
     # ------------------------------------------------------------------
     # Public API
@@ -143,12 +163,13 @@ class FrameDetector:
     def detect_panels(self, src_page: np.ndarray) -> List[PanelDetection]:
         """Detect panels and return detailed metadata for each."""
 
-        if src_page.ndim == 2:
-            gray_img = src_page.copy()
-            color_page = cv2.cvtColor(src_page, cv2.COLOR_GRAY2BGR)
-        else:
-            color_page = src_page.copy()
-            gray_img = cv2.cvtColor(src_page, cv2.COLOR_BGR2GRAY)
+        pool = self.buffer_pool
+        # The page is only read; crops are copied when they leave as detections.
+        gray_img = src_page if src_page.ndim == 2 else cv2.cvtColor(src_page, cv2.COLOR_BGR2GRAY)
+        self.page_copies = 0
+        if self.debug:
+            self.debug_page = cv2.cvtColor(src_page, cv2.COLOR_GRAY2BGR) if src_page.ndim == 2 else src_page.copy()
+            self.page_copies += 1
 
         img_size = (gray_img.shape[1], gray_img.shape[0])
         detections: List[PanelDetection] = []
@@ -157,7 +178,7 @@ class FrameDetector:
         bin_balloon = cv2.threshold(gray_img, 230, 255, cv2.THRESH_BINARY)[1]
         bin_balloon = cv2.erode(bin_balloon, None, iterations=1)
         bin_balloon = cv2.dilate(bin_balloon, None, iterations=1)
-        contours, hierarchy = cv2.findContours(bin_balloon, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        contours, hierarchy = cv2.findContours(bin_balloon, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
 
         gaussian_img = cv2.GaussianBlur(gray_img, (3, 3), 0)
         self.extract_speech_balloon(contours, hierarchy, gaussian_img)
@@ -167,18 +188,23 @@ class FrameDetector:
         self.find_frame_existence_area(inverse_bin)
 
         canny_img = cv2.Canny(gray_img, 120, 130, apertureSize=3)
-        lines_broad = self._detect_hough_lines(canny_img, rho=1, theta=np.pi / 180.0, threshold=50)
-        lines_fine = self._detect_hough_lines(canny_img, rho=1, theta=np.pi / 360.0, threshold=50)
-        lines_img = np.zeros_like(inverse_bin)
-        self.draw_hough_lines(lines_broad, lines_img)
-        self.draw_hough_lines(lines_fine, lines_img)
+        # A single fine-angle accumulator pass covers the former pi/180 and pi/360 passes;
+        # near-duplicate peaks are suppressed before the lines are drawn.
+        lines_buf = pool.borrow(inverse_bin.shape)
+        lines_img, _ = hough_line_evidence(
+            canny_img, threshold=50, theta=np.pi / 360.0, line_type=cv2.LINE_AA, out=lines_buf
+        )
 
-        and_img = cv2.bitwise_and(inverse_bin, lines_img)
-        tmp_img = and_img.copy()
-        contours_and, _ = cv2.findContours(tmp_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        # findContours leaves its input untouched (OpenCV 4), so the AND image is not copied.
+        and_img = cv2.bitwise_and(inverse_bin, lines_img, dst=pool.borrow(inverse_bin.shape))
+        contours_and, _ = cv2.findContours(and_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
 
-        complement = self.create_and_img_with_bounding_box(and_img.copy(), contours_and, inverse_bin)
+        # The complement is drawn on the line image's canvas, which is no longer needed.
+        np.copyto(lines_buf, and_img)
+        complement = self.create_and_img_with_bounding_box(lines_buf, contours_and, inverse_bin)
         contours_rect, _ = cv2.findContours(complement, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        pool.release(and_img)
+        pool.release(lines_buf)
 
         bounding_boxes: List[cv2.Rect] = []
         for cnt in contours_rect:
@@ -201,9 +227,7 @@ class FrameDetector:
             if quad is None:
                 continue
 
-            alpha_image = self.create_alpha_image(src_page, quad)
-            x, y, w, h = brect
-            panel = alpha_image[y : y + h, x : x + w].copy()
+            panel = self.create_alpha_image(src_page, quad, bbox=brect)
             mask = panel[:, :, 3].copy()
             detections.append(
                 PanelDetection(
@@ -215,15 +239,16 @@ class FrameDetector:
                 )
             )
 
-            # Optional: draw detected panel on a copy (for debugging)
-            cv2.polylines(
-                color_page,
-                [np.array([quad.lt, quad.rt, quad.rb, quad.lb], dtype=np.int32)],
-                True,
-                (0, 0, 255),
-                thickness=2,
-                lineType=cv2.LINE_AA,
-            )
+            # Optional: draw detected panel on the debug copy
+            if self.debug:
+                cv2.polylines(
+                    self.debug_page,
+                    [np.array([quad.lt, quad.rt, quad.rb, quad.lb], dtype=np.int32)],
+                    True,
+                    (0, 0, 255),
+                    thickness=2,
+                    lineType=cv2.LINE_AA,
+                )
 
         return detections
 
@@ -233,38 +258,30 @@ class FrameDetector:
     def extract_speech_balloon(
         self,
         contours: Sequence[np.ndarray],
-        hierarchy: Iterable[Tuple[int, int, int, int]] | None,
+        hierarchy: np.ndarray | None,
         gaussian_img: np.ndarray,
     ) -> None:
         img_area = gaussian_img.shape[0] * gaussian_img.shape[1]
-        hierarchy = list(hierarchy) if hierarchy is not None else [(-1, -1, -1, -1)] * len(contours)
-        for contour, hier in zip(contours, hierarchy):
-            area = cv2.contourArea(contour)
-            length = cv2.arcLength(contour, closed=True)
-            if length == 0:
-                continue
-            if img_area * 0.008 <= area < img_area * 0.03:
-                circularity = 4.0 * math.pi * area / (length * length)
-                if circularity > 0.4:
-                    cv2.drawContours(gaussian_img, [contour], 0, color=0, thickness=-1, lineType=cv2.LINE_AA)
+        areas, lengths, _ = contour_features(contours)
+        valid = lengths > 0
+        circularity = np.zeros_like(areas)
+        circularity[valid] = 4.0 * math.pi * areas[valid] / (lengths[valid] * lengths[valid])
+        candidates = valid & (img_area * 0.008 <= areas) & (areas < img_area * 0.03) & (circularity > 0.4)
+
+        # Drop hole contours and nested duplicate rings before filling.
+        self.balloon_prune_stats["candidates"] += int(np.count_nonzero(candidates))
+        candidates, prune_stats = prune_nested_contours(hierarchy, areas, candidates)
+        for rule, count in prune_stats.items():
+            self.balloon_prune_stats[rule] += count
+
+        for idx in np.flatnonzero(candidates):
+            cv2.drawContours(gaussian_img, contours, int(idx), color=0, thickness=-1, lineType=cv2.LINE_AA)
 
     def find_frame_existence_area(self, inverse_bin: np.ndarray) -> None:
-        histogram = np.sum(inverse_bin[:, 3:-3] > 0, axis=0)
-        min_x = 0
-        max_x = inverse_bin.shape[1] - 1
-        for idx, val in enumerate(histogram, start=3):
-            if val > 0:
-                min_x = idx
-                break
-        for offset, val in enumerate(reversed(histogram), start=3):
-            if val > 0:
-                max_x = inverse_bin.shape[1] - offset
-                break
-
-        if min_x < 6:
-            min_x = 0
-        if max_x > inverse_bin.shape[1] - 6:
-            max_x = inverse_bin.shape[1]
+        # Columns 0-2 and the last three are excluded over every row, as in the original port,
+        # and the right edge is one past the last inked column.
+        histogram, _ = projection_profile(inverse_bin, x_border=(3, 3), y_border=(0, 0))
+        min_x, max_x = profile_extent(histogram, exclusive_end=True)
 
         self.page_corners = PanelQuad(
             (min_x, 0),
@@ -274,18 +291,6 @@ class FrameDetector:
         )
         self.page_corners.renew_lines()
 
-    def draw_hough_lines(self, lines: Sequence[Tuple[float, float]], canvas: np.ndarray) -> None:
-        h, w = canvas.shape[:2]
-        diag = int(math.hypot(w, h))
-        for rho, theta in lines[:100]:
-            a = math.cos(theta)
-            b = math.sin(theta)
-            x0 = a * rho
-            y0 = b * rho
-            pt1 = (int(x0 - diag * b), int(y0 + diag * a))
-            pt2 = (int(x0 + diag * b), int(y0 - diag * a))
-            cv2.line(canvas, pt1, pt2, 255, 1, lineType=cv2.LINE_AA)
-
     def create_and_img_with_bounding_box(
         self,
         src_img: np.ndarray,
@@ -298,12 +303,12 @@ class FrameDetector:
             if not self.judge_area_of_bounding_box(rect, page_area):
                 continue
             cv2.rectangle(src_img, rect, 255, thickness=3)
-        return cv2.bitwise_and(src_img, inverse_bin)
+        return cv2.bitwise_and(src_img, inverse_bin, dst=src_img)
 
     @staticmethod
     def judge_area_of_bounding_box(rect: Tuple[int, int, int, int], page_area: int) -> bool:
         x, y, w, h = rect
-        return (w * h) >= page_area * 0.048
+        return (w * h) >= page_area * PANEL_AREA_RATIO
 
     @staticmethod
     def judge_bounding_box_overlap(
@@ -408,30 +413,26 @@ class FrameDetector:
         if quad.rb[1] > height - threshold:
             quad.rb = (quad.rb[0], height)
 
-    def create_alpha_image(self, src_page: np.ndarray, quad: PanelQuad) -> np.ndarray:
-        if src_page.ndim == 2:
-            rgba = cv2.cvtColor(src_page, cv2.COLOR_GRAY2BGRA)
-        else:
-            rgba = cv2.cvtColor(src_page, cv2.COLOR_BGR2BGRA)
+    def create_alpha_image(
+        self,
+        src_page: np.ndarray,
+        quad: PanelQuad,
+        bbox: Tuple[int, int, int, int] | None = None,
+    ) -> np.ndarray:
+        """Return ``src_page`` as BGRA with everything outside ``quad`` transparent.
+
+        When ``bbox`` is given only that crop is converted (the quad stays in page coordinates).
+        """
+        x, y, w, h = bbox if bbox is not None else (0, 0, src_page.shape[1], src_page.shape[0])
+        code = cv2.COLOR_GRAY2BGRA if src_page.ndim == 2 else cv2.COLOR_BGR2BGRA
+        rgba = cv2.cvtColor(src_page[y : y + h, x : x + w], code)
 
         mask = np.zeros(rgba.shape[:2], dtype=np.uint8)
-        polygon = np.array([quad.lt, quad.rt, quad.rb, quad.lb], dtype=np.int32)
-        cv2.fillPoly(mask, [polygon], 255)
+        polygon = np.array([quad.lt, quad.rt, quad.rb, quad.lb], dtype=np.int32) - (x, y)
+        cv2.fillPoly(mask, [polygon.astype(np.int32)], 255)
         rgba[:, :, 3] = mask
         return rgba
 
-    @staticmethod
-    def _detect_hough_lines(
-        image: np.ndarray,
-        rho: float,
-        theta: float,
-        threshold: int,
-    ) -> List[Tuple[float, float]]:
-        lines = cv2.HoughLines(image, rho, theta, threshold)
-        if lines is None:
-            return []
-        return [tuple(line[0]) for line in lines]
-
 
 # ----------------------------------------------------------------------
 # Command line interface
@@ -446,12 +447,17 @@ def _load_image(path: Path) -> np.ndarray:
     return img
 
 
-def _save_panels(panels: Sequence[np.ndarray], base_path: Path, output_dir: Path) -> None:
+def _save_panels(panels: Sequence[np.ndarray], base_path: Path, output_dir: Path,
+                 writer: CropWriter | None = None) -> None:
+    """Queue the panel crops on ``writer`` (or write them synchronously when no writer is given)."""
     output_dir.mkdir(parents=True, exist_ok=True)
     stem = base_path.stem
     for idx, panel in enumerate(panels, start=1):
         out_path = output_dir / f"{stem}_panel_{idx:02d}.png"
-        cv2.imwrite(str(out_path), panel)
+        if writer is None:
+            write_image(out_path, panel)
+        else:
+            writer.submit(out_path, panel)
 
 
 def run_cli(args: argparse.Namespace) -> None:
@@ -470,20 +476,33 @@ def run_cli(args: argparse.Namespace) -> None:
     if not image_paths:
         raise FileNotFoundError(f"No input images found at {input_path}")
 
-    for image_path in image_paths:
-        image = _load_image(image_path)
-        panels = detector.frame_detect(image)
-        if not panels:
-            print(f"[WARN] No panels detected for {image_path}")
-            continue
-        _save_panels(panels, image_path, output_dir)
-        print(f"[INFO] Saved {len(panels)} panels for {image_path}")
+    # PNG encoding and disk writes overlap with detection; close() waits for them and
+    # raises CropWriteError listing any file that could not be written.
+    with CropWriter(workers=args.writers) as writer:
+        for image_path in image_paths:
+            image = _load_image(image_path)
+            panels = detector.frame_detect(image)
+            if not panels:
+                print(f"[WARN] No panels detected for {image_path}")
+                continue
+            _save_panels(panels, image_path, output_dir, writer)
+            print(f"[INFO] Queued {len(panels)} panels for {image_path}")
+    print(f"[INFO] Wrote {writer.written} panels "
+          f"(backpressure wait {writer.blocked_seconds:.2f}s)")
+
+    stats = detector.balloon_prune_stats
+    print(
+        f"[INFO] Balloon candidates: {stats['candidates']} "
+        f"(pruned hole={stats['hole']}, duplicate={stats['duplicate']})"
+    )
 
 
 def parse_args(argv: Sequence[str] | None = None) -> argparse.Namespace:
     parser = argparse.ArgumentParser(description="Detect manga panels and export them as RGBA crops.")
     parser.add_argument("--input", required=True, help="Input image file or directory of images.")
     parser.add_argument("--output", required=True, help="Directory to store extracted panel PNG files.")
+    parser.add_argument("--writers", type=int, default=2,
+                        help="Threads that encode and write panel PNGs (0 writes synchronously).")
     return parser.parse_args(argv)
 
 
@@ -10,18 +10,53 @@ C++のmain.cppとその関連ファイル群をPythonで再現した統合版
 - 吹き出し検出・抽出
 
 Usage:
-    python manga_processor.py <input_folder> <output_folder>
+    python manga_processor.py <input_folder> <output_folder> [--page-balloons]
 """
 
 import os
 import sys
+import argparse
+import itertools
+import json
+import multiprocessing
+import multiprocessing.util
+import tempfile
+import time
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import deque
+from contextlib import contextmanager
 import cv2
 import numpy as np
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import Any, Callable, Dict, Iterator, List, Tuple, Optional, Union
 from dataclasses import dataclass
 import glob
 
+from buffer_pool import BufferPool
+from crop_writer import CropFormat, CropWriteError, CropWriter, decode_crop
+from page_context import PageContext
+from shard_archive import ShardReader, ShardWriter, remove_shards
+from shm_transport import ShmHandle, ShmRing, receive
+from sprite_atlas import BalloonAtlas, atlas_name, build_atlas
+from thread_budget import (
+    PAGE_THREADS, ThreadBudget, available_cores, candidate_budgets, choose_budget, parse_budget,
+    split_budget
+)
+from array_ops import (
+    PANEL_AREA_RATIO, is_black_page_bands, projection_profile, profile_extent, half_plane_mask,
+    false_balloon_counts, contour_features, contour_bw_counts, prune_hole_contours,
+    candidate_children, is_duplicate_contour, locate_in_bboxes, hough_line_evidence, xy_cut,
+    outer_frame_contour, rect_deviation, dark_level, nested_bboxes, compress_chain, expand_chain
+)
+
+
+# ページ画像（ndarray）またはその前処理結果を共有する PageContext
+PageLike = Union[np.ndarray, PageContext]
+
+# transport="shm" でワーカーごとに作成する共有メモリのリングの大きさ
+SHM_RING_BYTES = 64 * 2 ** 20
+
 
 @dataclass
 class Point:
@@ -115,36 +150,233 @@ class Points:
                 self.right_line.judge_area(p) == 0 or
                 self.bottom_line.judge_area(p) == 0 or
                 self.left_line.judge_area(p) == 1)
+    
+    def outside_mask(self, bbox: Tuple[int, int, int, int]) -> np.ndarray:
+        """
+        bbox (x, y, w, h) 内の全画素について outside() を一括判定
+        戻り値: (h, w) のboolマスク（True=外部）
+        """
+        if not all([self.top_line, self.bottom_line, self.left_line, self.right_line]):
+            self.renew_line()
+        
+        x, y, w, h = bbox
+        xs = np.arange(x, x + w, dtype=np.float64)[np.newaxis, :]
+        ys = np.arange(y, y + h, dtype=np.float64)[:, np.newaxis]
+        
+        mask = np.zeros((h, w), dtype=bool)
+        for line, side in [(self.top_line, 1), (self.right_line, 0),
+                           (self.bottom_line, 0), (self.left_line, 1)]:
+            mask |= half_plane_mask(line.a, line.b, line.y2x, side, xs, ys)
+        return mask
+
+
+def create_alpha_crop(src_page: np.ndarray, corners: Points,
+                      bbox: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+    """
+    C++のcreateAlphaImage()に相当
+    四点座標の4直線による判定を配列演算でまとめて行い、四角形外部を透明化
+    bbox (x, y, w, h) を指定した場合はその範囲だけを切り出して処理する
+    """
+    if bbox is None:
+        bbox = (0, 0, src_page.shape[1], src_page.shape[0])
+    x, y, w, h = bbox
+    roi = src_page[y:y+h, x:x+w]
+    
+    # RGBA変換（切り出し範囲のみ）
+    if len(roi.shape) == 3:
+        rgba = cv2.cvtColor(roi, cv2.COLOR_BGR2BGRA)
+    else:
+        rgba = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGRA)
+    
+    # 直線を更新
+    corners.renew_line()
+    
+    # 四角形外部を透明化
+    rgba[:, :, 3][corners.outside_mask(bbox)] = 0
+    
+    return rgba
+
+
+def create_balloon_crop(src: np.ndarray, contour: np.ndarray,
+                        bbox: Tuple[int, int, int, int]) -> np.ndarray:
+    """
+    bbox (x, y, w, h) の範囲を切り出してRGBA変換し、輪郭の内側以外を透明化
+    contour と bbox は src の座標系で指定する
+    """
+    x, y, w, h = bbox
+    roi = src[y:y+h, x:x+w]
+    if len(roi.shape) == 3:
+        balloon_img = cv2.cvtColor(roi, cv2.COLOR_BGR2BGRA)
+    else:
+        balloon_img = cv2.cvtColor(roi, cv2.COLOR_GRAY2BGRA)
+    
+    alpha_mask = np.zeros(balloon_img.shape[:2], dtype=np.uint8)
+    cv2.drawContours(alpha_mask, [contour], -1, 255, -1, offset=(-x, -y))
+    balloon_img[:, :, 3] = alpha_mask
+    return balloon_img
 
 
-@dataclass 
 class Panel:
-    """コマ（フレーム）情報"""
-    image: np.ndarray  # RGBA画像
-    bbox: Tuple[int, int, int, int]  # (x, y, w, h)
-    corners: Points
-    page_idx: int
-    panel_idx: int
+    """
+    コマ（フレーム）情報
+    bbox・四隅は int32 配列で保持し、RGBA画像は元ページへの参照から
+    image を読んだとき（保存時など）に作成する（作成した画像は保持しない）
+    元ページを参照しているので、Panel を保持している間は元ページも解放されない
+    """
+    __slots__ = ("_bbox", "_corners", "page_idx", "panel_idx", "_source", "_image")
+    
+    def __init__(self, image: Optional[np.ndarray], bbox: Tuple[int, int, int, int],
+                 corners: Points, page_idx: int, panel_idx: int,
+                 source: Optional[np.ndarray] = None):
+        self._image = image        # 作成済みのRGBA画像（source を渡した場合は None）
+        self._source = source      # 切り出し元のページ
+        self.bbox = bbox
+        self.corners = corners
+        self.page_idx = page_idx
+        self.panel_idx = panel_idx
+    
+    @property
+    def bbox(self) -> Tuple[int, int, int, int]:
+        """(x, y, w, h)"""
+        return tuple(int(v) for v in self._bbox)
+    
+    @bbox.setter
+    def bbox(self, value: Tuple[int, int, int, int]) -> None:
+        self._bbox = np.asarray(value, dtype=np.int32)
+    
+    @property
+    def corners(self) -> Points:
+        """四隅座標（lt, rt, lb, rb）"""
+        return Points(*(Point(int(x), int(y)) for x, y in self._corners))
+    
+    @corners.setter
+    def corners(self, value: Points) -> None:
+        self._corners = np.array([[p.x, p.y] for p in (value.lt, value.rt, value.lb, value.rb)],
+                                 dtype=np.int32)
+    
+    @property
+    def image(self) -> np.ndarray:
+        """
+        RGBA画像（四角形外部は透明）
+        読むたびに元ページから bbox 大の画像を確保してマスクを描画するので、続けて使う場合は1回だけ読む
+        """
+        if self._image is not None:
+            return self._image
+        return create_alpha_crop(self._source, self.corners, self.bbox)
+    
+    def __repr__(self) -> str:
+        return (f"Panel(bbox={self.bbox}, corners={self._corners.tolist()}, "
+                f"page_idx={self.page_idx}, panel_idx={self.panel_idx})")
 
 
-@dataclass
 class Balloon:
-    """吹き出し情報"""
-    image: np.ndarray  # RGBA画像
-    bbox: Tuple[int, int, int, int]  # (x, y, w, h)
-    contour: np.ndarray
-    center: Tuple[int, int]
-    area: float
-    circularity: float
-    type: int  # 0:円形, 1:矩形, 2:ギザギザ
-    bw_ratio: float
-    panel_idx: int
+    """
+    吹き出し情報
+    輪郭は同じ向きに進む途中の点を除いた int16 の点列で保持し（contour で元の点列に戻る）、
+    RGBA画像は切り出し元への参照から image を読んだとき（保存時など）に作成する（作成した画像は保持しない）
+    切り出し元（通常は元ページ）を参照しているので、Balloon を保持している間は切り出し元も解放されない
+    """
+    __slots__ = ("_bbox", "_contour", "center", "area", "circularity", "type", "bw_ratio",
+                 "panel_idx", "_source", "_origin", "_image")
+    
+    def __init__(self, image: Optional[np.ndarray], bbox: Tuple[int, int, int, int],
+                 contour: np.ndarray, center: Tuple[int, int], area: float, circularity: float,
+                 type: int, bw_ratio: float, panel_idx: int,
+                 source: Optional[np.ndarray] = None, origin: Tuple[int, int] = (0, 0)):
+        self._image = image        # 作成済みのRGBA画像（source を渡した場合は None）
+        self._source = source      # 切り出し元の画像
+        self._origin = origin      # source 上での座標原点
+        self.bbox = bbox
+        self.contour = contour
+        self.center = center
+        self.area = area
+        self.circularity = circularity
+        self.type = type           # 0:円形, 1:矩形, 2:ギザギザ
+        self.bw_ratio = bw_ratio
+        self.panel_idx = panel_idx
+    
+    @property
+    def bbox(self) -> Tuple[int, int, int, int]:
+        """(x, y, w, h)"""
+        return tuple(int(v) for v in self._bbox)
+    
+    @bbox.setter
+    def bbox(self, value: Tuple[int, int, int, int]) -> None:
+        self._bbox = np.asarray(value, dtype=np.int32)
+    
+    @property
+    def contour(self) -> np.ndarray:
+        """輪郭（CHAIN_APPROX_NONE の int32 点列）"""
+        return expand_chain(self._contour)
+    
+    @contour.setter
+    def contour(self, value: np.ndarray) -> None:
+        self._contour = compress_chain(value)
+    
+    @property
+    def image(self) -> np.ndarray:
+        """
+        RGBA画像（輪郭の外側は透明）
+        読むたびに輪郭を展開し、bbox 大の画像を確保して輪郭内を塗るので、続けて使う場合は1回だけ読む
+        """
+        if self._image is not None:
+            return self._image
+        ox, oy = self._origin
+        x, y, w, h = self.bbox
+        return create_balloon_crop(self._source, self.contour + np.array([ox, oy], dtype=np.int32),
+                                   (x + ox, y + oy, w, h))
+    
+    @property
+    def source_bbox(self) -> Tuple[int, int, int, int]:
+        """切り出し元（set_source() で差し替えた場合はページ）上の (x, y, w, h)"""
+        x, y, w, h = self.bbox
+        return (x + self._origin[0], y + self._origin[1], w, h)
+    
+    def set_source(self, source: np.ndarray, origin: Tuple[int, int] = (0, 0)) -> None:
+        """切り出し元を差し替える（origin は source 上での現在の座標原点）"""
+        if self._image is None:
+            self._source = source
+            self._origin = (int(origin[0]), int(origin[1]))
+    
+    def rebase(self, dx: int, dy: int) -> None:
+        """座標原点を (dx, dy) に移す（bbox・輪郭・中心を平行移動する）"""
+        x, y, w, h = self.bbox
+        self.bbox = (x - dx, y - dy, w, h)
+        self._contour = (self._contour - np.array([dx, dy], dtype=np.int16)).astype(np.int16)
+        self.center = (self.center[0] - dx, self.center[1] - dy)
+        self._origin = (self._origin[0] + dx, self._origin[1] + dy)
+    
+    def __repr__(self) -> str:
+        return (f"Balloon(bbox={self.bbox}, center={self.center}, area={self.area}, "
+                f"circularity={self.circularity}, type={self.type}, bw_ratio={self.bw_ratio}, "
+                f"panel_idx={self.panel_idx})")
+
+
+def read_gray(image_path: str) -> Optional[np.ndarray]:
+    """画像をグレースケールで読み込む（C++と同じ。読み込めなければ None）"""
+    return cv2.imread(image_path, 0)  # 0でグレースケール読み込み
+
+
+@dataclass
+class ImageResult:
+    """1枚の画像の処理結果（iter_process() が画像ごとに返す）"""
+    index: int                  # 画像番号（出力ファイル名の先頭）
+    path: str
+    pages: int                  # ページ分割後のページ数（読み込めなかった場合は0）
+    panels: List[Panel]
+    balloons: List[Balloon]     # panel_idx は panels 内の番号
+    timings: Dict[str, float]   # 秒（decode: 読み込みの待ち時間, detect: ページ分割・検出と保存, total）
 
 
 class MangaProcessor:
     """マンガ処理メインクラス"""
     
-    def __init__(self, input_folder: str, output_folder: str):
+    def __init__(self, input_folder: str, output_folder: str, page_level_balloons: bool = False,
+                 pyramid_height: Optional[int] = None, frame_engine: str = "auto",
+                 debug_copies: bool = False, workers: int = 1, threads: int = 1,
+                 cv_threads: Optional[int] = None, transport: str = "pickle",
+                 prefetch: int = 0, writers: int = 2, crop_format: str = "png",
+                 shard_bytes: Optional[int] = None, balloon_atlas: bool = False, verbose: bool = True):
         self.input_folder = Path(input_folder)
         self.output_folder = Path(output_folder)
         self.output_folder.mkdir(parents=True, exist_ok=True)
@@ -157,6 +389,60 @@ class MangaProcessor:
         
         # パラメータ設定
         self.speechballoon_max = 99  # 最大吹き出し数
+        self.page_level_balloons = page_level_balloons  # True: 吹き出しをページ単位で検出してコマに割り当て
+        self.pyramid_height = pyramid_height  # 指定時: この高さまで縮小してコマ候補を検出し、原寸で四隅を精密化
+        self.frame_engine = frame_engine  # "auto": XYカットを試してだめならHough / "hough": 常にHough
+        
+        # フレーム検出で使ったエンジン（直近のページはスレッドごとに保持し、エンジンごとのページ数）
+        self._thread_state = threading.local()
+        self.frame_engine_stats = {"xycut": 0, "hough": 0, "blackpage": 0}
+        
+        # ページ大の作業用配列のプール
+        self.buffer_pool = BufferPool()
+        
+        # True: ページごとにページ全体のコピー回数を表示（コピーの増加を検出するためのデバッグ用）
+        self.debug_copies = debug_copies
+        
+        # 2以上: process_images() で画像単位にプロセスプールへ分散
+        self.workers = workers
+        
+        # 2以上: 1枚の画像内のページとコマごとの吹き出し検出をスレッドプールで並列処理
+        self.threads = threads
+        
+        # OpenCV内部のスレッド数（None: 変更しない、ワーカープロセスでは1）
+        self.cv_threads = cv_threads
+        
+        # 1以上: 処理中の画像の次の prefetch 枚をバックグラウンドで読み込む（プロセスプール不使用時）
+        self.prefetch = prefetch
+        
+        # コマ・吹き出し画像を保存するスレッド数（0: 検出処理の中で保存）と保存の統計
+        self.writers = writers
+        self._writer: Optional[CropWriter] = None
+        self.writer_stats = {"written": 0, "failed": 0, "blocked_seconds": 0.0}
+        
+        # コマ・吹き出し画像の保存形式（crop_writer.CropFormat.parse() の指定）
+        self.crop_format = CropFormat.parse(crop_format)
+        
+        # 指定時: コマ・吹き出し画像をファイルではなく、この大きさまでの tar シャードにまとめて保存
+        # （shards/ に作成し、メンバー名は panels/000_0_0.png など。open_shards() で読み出す）
+        self.shard_bytes = shard_bytes
+        self.shards_dir = self.output_folder / "shards"
+        
+        # True: 吹き出し画像を1つずつではなく、ページごとのアトラス画像と JSON にまとめて保存
+        # （balloons/000_0.atlas.png と .atlas.json。load_atlas() で読み出す）
+        if balloon_atlas and self.crop_format.kind == "mask":
+            raise ValueError("balloon atlas cannot be saved in mask format")
+        self.balloon_atlas = balloon_atlas
+        
+        # ワーカーからのページ・切り出し画像の受け渡し（"pickle" / "shm": 共有メモリのリング）
+        self.transport = transport
+        
+        # False: process_images() の進捗・集計を表示しない
+        self.verbose = verbose
+        
+        # 吹き出し候補の間引き統計（幾何フィルタ通過数と、ルールごとの除外数）
+        self.balloon_prune_stats = {"candidates": 0, "hole": 0, "duplicate": 0}
+        self._stats_lock = threading.Lock()
         
     def get_image_paths(self, extension: str = "jpg") -> List[str]:
         """フォルダから画像パスを取得"""
@@ -180,7 +466,7 @@ class MangaProcessor:
         else:  # 縦>横の場合:単一ページ画像だと判断しそのまま保存
             return [img]
     
-    def get_page_type(self, page: np.ndarray) -> bool:
+    def get_page_type(self, page: PageLike) -> bool:
         """
         ページ分類：白ページ(False) / 黒ページ(True)
         C++の ClassificationPage::get_page_type() に相当
@@ -189,223 +475,218 @@ class MangaProcessor:
         BLACK_LENGTH_TH = 5
         
         # フレーム存在領域を特定
-        frame_exist_page = self.find_frame_area(page.copy())
+        frame_exist_page = self.find_frame_area(page)
         
         # 大津の手法で二値化
         _, frame_exist_page = cv2.threshold(frame_exist_page, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-        
-        h, w = frame_exist_page.shape
-        
-        # 上端チェック
-        page_type = True
-        for y in range(3, BLACK_LENGTH_TH):
-            for x in range(w):
-                if frame_exist_page[y, x] != 0:
-                    page_type = False
-                    break
-            if not page_type:
-                break
-        if page_type:
-            return True
-        
-        # 下端チェック
-        page_type = True
-        for y in range(h - 3, h - BLACK_LENGTH_TH, -1):
-            for x in range(w):
-                if frame_exist_page[y, x] != 0:
-                    page_type = False
-                    break
-            if not page_type:
-                break
-        if page_type:
-            return True
-        
-        # 右端チェック
-        page_type = True
-        for y in range(h):
-            for x in range(w - 3, w - BLACK_LENGTH_TH, -1):
-                if frame_exist_page[y, x] != 0:
-                    page_type = False
-                    break
-            if not page_type:
-                break
-        if page_type:
-            return True
-        
-        # 左端チェック
-        page_type = True
-        for y in range(h):
-            for x in range(3, BLACK_LENGTH_TH):
-                if frame_exist_page[y, x] != 0:
-                    page_type = False
-                    break
-            if not page_type:
-                break
-        
-        return page_type
+
+        # 上端・下端・右端・左端の帯をまとめて判定
+        return is_black_page_bands(frame_exist_page, BLACK_LENGTH_TH)
     
-    def find_frame_area(self, input_page_image: np.ndarray) -> np.ndarray:
+    def find_frame_area(self, input_page_image: PageLike) -> np.ndarray:
         """
         フレーム存在領域特定（C++のfindFrameArea相当）
+        戻り値はグレースケール画像の書き込み禁止ビュー
         """
-        # グレースケール変換
-        if len(input_page_image.shape) == 3:
-            gray = cv2.cvtColor(input_page_image, cv2.COLOR_BGR2GRAY)
-        else:
-            gray = input_page_image
-        
-        # ガウシアンフィルタ
-        gaussian_img = cv2.GaussianBlur(gray, (3, 3), 0)
-        
-        # 階調反転二値画像の生成
-        inverse_bin_img = cv2.bitwise_not(gaussian_img)
-        _, inverse_bin_img = cv2.threshold(inverse_bin_img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-        
-        h, w = inverse_bin_img.shape
-        
-        # 左右の除去 - ヒストグラム生成
-        histgram_lr = np.zeros(w, dtype=int)
-        
-        for y in range(h):
-            for x in range(w):
-                if x <= 2 or x >= w - 2 or y <= 2 or y >= h - 2:
-                    continue
-                if inverse_bin_img[y, x] > 0:
-                    histgram_lr[x] += 1
-        
-        # 左右境界検出
-        min_x_lr = 0
-        max_x_lr = w - 1
-        
-        for x in range(w):
-            if histgram_lr[x] > 0:
-                min_x_lr = x
-                break
+        ctx = PageContext.of(input_page_image)
         
-        for x in range(w - 1, -1, -1):
-            if histgram_lr[x] > 0:
-                max_x_lr = x
-                break
-        
-        # 誤差は両端に寄せる
-        if min_x_lr < 6:
-            min_x_lr = 0
-        if max_x_lr > w - 6:
-            max_x_lr = w
-        
-        cut_page_img_lr = gray[0:h, min_x_lr:max_x_lr]
-        
-        # 上下の除去 - ヒストグラム生成
-        histgram_tb = np.zeros(h, dtype=int)
-        
-        for y in range(h):
-            for x in range(w):
-                if x <= 2 or x >= w - 2 or y <= 2 or y >= h - 2:
-                    continue
-                if inverse_bin_img[y, x] > 0:
-                    histgram_tb[y] += 1
+        # グレースケール → ガウシアンフィルタ → 階調反転二値画像（大津の手法）
+        gray = ctx.gray
+        inverse_bin_img = ctx.otsu_inverse
         
-        # 上下境界検出
-        min_y_tb = 0
-        max_y_tb = h - 1
-        
-        for y in range(h):
-            if histgram_tb[y] > 0:
-                min_y_tb = y
-                break
-        
-        for y in range(h - 1, -1, -1):
-            if histgram_tb[y] > 0:
-                max_y_tb = y
-                break
+        # 左右・上下のヒストグラムを1回で生成
+        histgram_lr, histgram_tb = projection_profile(inverse_bin_img)
         
-        # 誤差は両端に寄せる
-        if min_y_tb < 6:
-            min_y_tb = 0
-        if max_y_tb > cut_page_img_lr.shape[0] - 6:
-            max_y_tb = cut_page_img_lr.shape[0]
+        # 左右の除去
+        min_x_lr, max_x_lr = profile_extent(histgram_lr)
+        cut_page_img_lr = gray[:, min_x_lr:max_x_lr]
         
+        # 上下の除去
+        min_y_tb, max_y_tb = profile_extent(histgram_tb)
         cut_page_img = cut_page_img_lr[min_y_tb:max_y_tb, :]
         
         return cut_page_img
     
-    def frame_detect(self, page: np.ndarray) -> List[Panel]:
+    def _balloon_filled_gray(self, ctx: PageContext) -> np.ndarray:
+        """吹き出し候補を塗りつぶしたグレースケール画像（フレーム検出の処理用）"""
+        def compute():
+            gray = ctx.writable_copy(ctx.gray, "balloon_fill")  # 元画像を変更しないようにコピー
+            contours, _ = ctx.balloon_contours
+            self.extract_speech_balloon(contours, gray)
+            return gray
+        return ctx.cached("balloon_filled_gray", compute)
+    
+    def _frame_inverse_bin(self, ctx: PageContext) -> np.ndarray:
+        """吹き出し除去後の画像のガウシアン → 閾値210の反転二値画像"""
+        def compute():
+            gaussian_img = cv2.GaussianBlur(self._balloon_filled_gray(ctx), (3, 3), 0)
+            return cv2.threshold(gaussian_img, 210, 255, cv2.THRESH_BINARY_INV)[1]
+        return ctx.cached("inverse_bin_210", compute)
+    
+    def _frame_canny(self, ctx: PageContext) -> np.ndarray:
+        """吹き出し除去後の画像のCannyエッジ"""
+        return ctx.cached("canny", lambda: cv2.Canny(self._balloon_filled_gray(ctx), 120, 130, 3))
+    
+    def frame_detect(self, page: PageLike, pyramid_height: Optional[int] = None) -> List[Panel]:
         """
         フレーム（コマ）検出・抽出
         C++の Framedetect::frame_detect() に相当
+        pyramid_height を指定するとその高さまで縮小した画像でコマ候補を検出し、
+        候補付近だけを原寸画像で精密化する（コース・トゥ・ファイン）
         """
-        panels = []
-        
-        # 元画像を保存（パネル切り出しに使用）
-        original_page = page.copy()
+        ctx = PageContext.of(page)
+        pyramid_height = pyramid_height if pyramid_height is not None else self.pyramid_height
         
-        # グレースケール変換（処理用）
-        if len(page.shape) == 3:
-            gray = cv2.cvtColor(page, cv2.COLOR_BGR2GRAY)
+        if pyramid_height and ctx.shape[0] > pyramid_height:
+            contours, page_corners = self._frame_candidates_pyramid(ctx, pyramid_height / ctx.shape[0])
         else:
-            gray = page.copy()  # 元画像を変更しないようにコピー
-            
-        # 吹き出し検出用の二値化
-        _, bin_img = cv2.threshold(gray, 230, 255, cv2.THRESH_BINARY)
-        bin_img = cv2.erode(bin_img, np.ones((3,3), np.uint8), iterations=1)
-        bin_img = cv2.dilate(bin_img, np.ones((3,3), np.uint8), iterations=1)
-        
-        # 吹き出し輪郭検出
-        contours, _ = cv2.findContours(bin_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+            contours, page_corners = self._frame_candidates(ctx)
         
-        # 吹き出し除去（塗りつぶし）- 処理用画像のみ
-        self.extract_speech_balloon(contours, gray)
-        
-        # ガウシアンフィルタ
-        gaussian_img = cv2.GaussianBlur(gray, (3, 3), 0)
+        return self._build_panels(ctx.page, contours, page_corners)
+    
+    def _frame_candidates(self, ctx: PageContext, scale: float = 1.0):
+        """
+        コマ候補の輪郭とページの四隅座標を検出
+        scale は原寸に対する作業画像の倍率で、画素単位の定数（Hough投票数、
+        補完矩形の線幅、端寄せ幅）をその倍率に合わせる
+        戻り値: (final_contours, page_corners)
+        """
+        page_area = ctx.shape[0] * ctx.shape[1]
         
-        # 二値化（反転）
-        _, inverse_bin = cv2.threshold(gaussian_img, 210, 255, cv2.THRESH_BINARY_INV)
+        # 吹き出し除去（塗りつぶし）済み画像のガウシアンフィルタ → 二値化（反転）
+        inverse_bin = self._frame_inverse_bin(ctx)
         
         # コマ存在領域推定（C++のfindFrameExistenceArea相当）
-        page_corners = self.find_frame_existence_area(inverse_bin)
+        page_corners = self.find_frame_existence_area(inverse_bin, snap=6 * scale)
+        
+        # 格子状のページはXYカットで分割（斜めの枠・白い区切りのないページはHoughへ）
+        if self.frame_engine == "auto":
+            contours = self._xy_cut_contours(inverse_bin, scale)
+            if contours is not None:
+                self._record_frame_engine("xycut")
+                return contours, page_corners
+        self._record_frame_engine("hough")
         
         # Cannyエッジ検出
-        canny = cv2.Canny(gray, 120, 130, 3)
-        
-        # Hough直線検出
-        lines = cv2.HoughLines(canny, 1, np.pi/180, 50)
-        
-        # 直線画像作成
-        lines_img = np.zeros_like(gray)
-        if lines is not None:
-            for line in lines[:100]:  # 最大100本
-                rho, theta = line[0]
-                a = np.cos(theta)
-                b = np.sin(theta)
-                x0 = a * rho
-                y0 = b * rho
-                x1 = int(x0 - 2000 * b)
-                y1 = int(y0 + 2000 * a)
-                x2 = int(x0 + 2000 * b)
-                y2 = int(y0 - 2000 * a)
-                cv2.line(lines_img, (x1, y1), (x2, y2), 255, 1)
-        
-        # 論理積
-        and_img = cv2.bitwise_and(inverse_bin, lines_img)
-        
-        # 輪郭検出
-        contours, _ = cv2.findContours(and_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        
-        # バウンディングボックスで補完
-        for cnt in contours:
-            bbox = cv2.boundingRect(cnt)
-            if self.judge_area_of_bounding_box(bbox, page.shape[0] * page.shape[1]):
-                cv2.rectangle(and_img, bbox, 255, 3)
+        canny = self._frame_canny(ctx)
         
-        # 最終的な補完画像
-        complement_img = cv2.bitwise_and(and_img, inverse_bin)
+        # 直線画像・論理積画像はプールから借りた配列に書き込む
+        with self.buffer_pool.lease(ctx.shape) as lines_buf, self.buffer_pool.lease(ctx.shape) as and_img:
+            # Hough直線検出（重複ピークを間引き、ページ内に切り取った直線を一括描画）
+            lines_img, _ = hough_line_evidence(canny, threshold=max(int(round(50 * scale)), 1), out=lines_buf)
+            
+            # 論理積
+            cv2.bitwise_and(inverse_bin, lines_img, dst=and_img)
+            
+            # 輪郭検出
+            contours, _ = cv2.findContours(and_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+            
+            # バウンディングボックスで補完
+            thickness = max(int(round(3 * scale)), 1)
+            for cnt in contours:
+                bbox = cv2.boundingRect(cnt)
+                if self.judge_area_of_bounding_box(bbox, page_area):
+                    cv2.rectangle(and_img, bbox, 255, thickness)
+            
+            # 最終的な補完画像（直線画像の配列を再利用）
+            complement_img = cv2.bitwise_and(and_img, inverse_bin, dst=lines_buf)
+            
+            # 最終輪郭検出
+            final_contours, _ = cv2.findContours(complement_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
         
-        # 最終輪郭検出
-        final_contours, _ = cv2.findContours(complement_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return final_contours, page_corners
+    
+    def _xy_cut_contours(self, inverse_bin: np.ndarray, scale: float = 1.0, fill_ratio: float = 0.97,
+                         max_deviation: float = 1.0) -> Optional[List[np.ndarray]]:
+        """
+        白い区切り（行・列）で再帰的に分割し、各領域の枠の外側輪郭をコマ輪郭として返す
+        面積判定を通る領域のどれかが矩形の枠で囲まれていない、または枠の辺が max_deviation 画素より
+        傾いていれば None（Houghで検出し直す）
+        """
+        page_area = inverse_bin.shape[0] * inverse_bin.shape[1]
+        leaves = xy_cut(inverse_bin, min_gap=max(int(round(6 * scale)), 1))
+        contours = []
+        # findContours と同じ順（左上の点のラスタ順の逆）に並べる
+        for x, y, w, h in sorted(leaves, key=lambda b: (b[1], b[0]), reverse=True):
+            if not self.judge_area_of_bounding_box((x, y, w, h), page_area):
+                continue
+            cnt, ratio = outer_frame_contour(np.ascontiguousarray(inverse_bin[y:y+h, x:x+w]), (x, y))
+            if ratio < fill_ratio or rect_deviation(cnt) > max_deviation:
+                return None
+            contours.append(cnt)
+        return contours or None
+    
+    @property
+    def last_frame_engine(self) -> str:
+        """このスレッドで直近のフレーム検出に使ったエンジン"""
+        return getattr(self._thread_state, "frame_engine", "")
+    
+    def _record_frame_engine(self, engine: str) -> None:
+        self._thread_state.frame_engine = engine
+        with self._stats_lock:
+            self.frame_engine_stats[engine] += 1
+    
+    def _frame_candidates_pyramid(self, ctx: PageContext, scale: float):
+        """
+        縮小画像でコマ候補とページの四隅を検出し、原寸の座標系に戻す
+        候補の輪郭は原寸画像の候補付近だけを二値化して精密化する
+        """
+        rows, cols = ctx.shape[:2]
+        small = cv2.resize(ctx.gray, (max(int(round(cols * scale)), 1), max(int(round(rows * scale)), 1)),
+                           interpolation=cv2.INTER_AREA)
+        scale_x, scale_y = small.shape[1] / cols, small.shape[0] / rows
+        contours, small_corners = self._frame_candidates(PageContext(small), scale)
+        
+        # ページの四隅（端に寄せた値は原寸の端に対応させる）
+        def to_full_x(v: int) -> int:
+            return cols if v >= small.shape[1] else int(round(v / scale_x))
+        min_x, max_x = to_full_x(small_corners.lt.x), to_full_x(small_corners.rt.x)
+        page_corners = Points(Point(min_x, 0), Point(max_x, 0), Point(min_x, rows), Point(max_x, rows))
+        
+        # 面積判定を通らない候補は精密化しない
+        page_area = small.shape[0] * small.shape[1]
+        refined = [self._refine_frame_contour(ctx, cnt, scale_x, scale_y) for cnt in contours
+                   if self.judge_area_of_bounding_box(cv2.boundingRect(cnt), page_area)]
+
+        return refined, page_corners
+    
+    def _refine_frame_contour(self, ctx: PageContext, contour: np.ndarray,
+                              scale_x: float, scale_y: float) -> np.ndarray:
+        """
+        縮小画像のコマ輪郭を原寸に拡大し、その近傍（縮小1画素分の余白）の
+        原寸二値画像から外側輪郭を求め直す
+        """
+        rows, cols = ctx.shape[:2]
+        pts = contour.reshape(-1, 2).astype(np.float64)
+        pts = np.rint((pts + 0.5) / (scale_x, scale_y) - 0.5).astype(np.int32)
+        margin = int(np.ceil(1.0 / min(scale_x, scale_y))) + 1
+        
+        x, y, w, h = cv2.boundingRect(pts)
+        x0, y0 = max(x - margin, 0), max(y - margin, 0)
+        x1, y1 = min(x + w + margin, cols), min(y + h + margin, rows)
+        
+        # 候補付近だけをガウシアン → 閾値210の反転二値化（原寸処理と同じ）
+        roi = ctx.gray[y0:y1, x0:x1]
+        ink = cv2.threshold(cv2.GaussianBlur(roi, (3, 3), 0), 210, 255, cv2.THRESH_BINARY_INV)[1]
+        
+        # 拡大した候補領域を余白分だけ広げたマスクで制限
+        mask = np.zeros_like(ink)
+        local = (pts - (x0, y0)).reshape(-1, 1, 2)
+        cv2.fillPoly(mask, [local], 255)
+        cv2.polylines(mask, [local], True, 255, 2 * margin + 1)
+        ink &= mask
+        
+        refined, _ = cv2.findContours(ink, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x0, y0))
+        if not refined:
+            return pts.reshape(-1, 1, 2)
+        return max(refined, key=cv2.contourArea)
+    
+    def _build_panels(self, original_page: np.ndarray, contours, page_corners: Points) -> List[Panel]:
+        """コマ輪郭から四隅座標を決定し、元画像から切り出してパネルを作成"""
+        panels = []
         
         # パネル抽出（元画像から切り出し）
-        for i, cnt in enumerate(final_contours):
+        for i, cnt in enumerate(contours):
             bbox = cv2.boundingRect(cnt)
             x, y, w, h = bbox
             
@@ -421,23 +702,57 @@ class MangaProcessor:
             # C++版と同様の輪郭近似と四隅座標決定（ページ角判定を含む）
             corners = self.define_panel_corners(cnt, bbox, original_page.shape, page_corners)
             
-            # 元画像からパネルを切り出し（吹き出しが塗りつぶされていない）
-            panel_img = self.create_alpha_image(original_page, corners)
-            
-            # 切り出し
-            panel_img = panel_img[y:y+h, x:x+w].copy()
-            
+            # RGBA画像は保存時に元画像（吹き出しが塗りつぶされていない）から切り出す
             panel = Panel(
-                image=panel_img,
+                image=None,
                 bbox=(x, y, w, h),
                 corners=corners,
                 page_idx=0,  # 後で設定
-                panel_idx=i
+                panel_idx=i,
+                source=original_page
             )
             panels.append(panel)
         
         return panels
     
+    def black_page_frame_detect(self, page: PageLike, black_margin: int = 10) -> List[Panel]:
+        """
+        黒ページ（回想シーンなど）のフレーム（コマ）検出
+        C++の BFramedetect::blackpageFramedetect()（未完成）の方針を配列演算で実装:
+        地の黒（最頻の暗い輝度 + black_margin 未満）以外の画素の連結成分をコマ候補とし、
+        射影ヒストグラムからページの四隅を求める
+        """
+        ctx = PageContext.of(page)
+        gaussian = ctx.gaussian
+        page_area = ctx.shape[0] * ctx.shape[1]
+        
+        # 黒画素以外の領域（細かな切れ目は3x3のクロージングでつなぐ）
+        th = dark_level(gaussian) + black_margin
+        content = cv2.threshold(gaussian, th - 1, 255, cv2.THRESH_BINARY)[1]
+        content = cv2.morphologyEx(content, cv2.MORPH_CLOSE, np.ones((3, 3), np.uint8))
+        
+        # コマ存在領域推定（白ページと同じ射影ヒストグラム）
+        page_corners = self.find_frame_existence_area(content)
+        
+        # 連結成分の統計から面積判定を一括で行い、他の候補に含まれるもの（大きな吹き出しなど）を除く
+        _, labels, stats, _ = cv2.connectedComponentsWithStats(content, connectivity=8)
+        bboxes = stats[1:, :4]
+        candidates = np.flatnonzero(bboxes[:, 2] * bboxes[:, 3] >= PANEL_AREA_RATIO * page_area)
+        candidates = candidates[~nested_bboxes(bboxes[candidates])]
+        
+        # 候補ごとの外側輪郭（バウンディングボックス内だけで求める）
+        contours = []
+        for idx in candidates:
+            x, y, w, h = (int(v) for v in bboxes[idx])
+            mask = (labels[y:y+h, x:x+w] == idx + 1).astype(np.uint8)
+            outer, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE, offset=(x, y))
+            contours.append(max(outer, key=cv2.contourArea))
+        
+        # findContours と同じ順（左上の点のラスタ順の逆）に並べる
+        contours.sort(key=lambda c: (c[:, 0, 1].min(), c[c[:, 0, 1].argmin(), 0, 0]), reverse=True)
+        self._record_frame_engine("blackpage")
+        return self._build_panels(ctx.page, contours, page_corners)
+    
     def extract_speech_balloon(self, contours: List[np.ndarray], img: np.ndarray):
         """
         吹き出し検出・塗りつぶし（フレーム検出の前処理用）
@@ -454,43 +769,16 @@ class MangaProcessor:
                 if en > 0.4:
                     cv2.drawContours(img, [cnt], -1, 0, -1)
     
-    def find_frame_existence_area(self, inverse_bin_img: np.ndarray) -> Points:
+    def find_frame_existence_area(self, inverse_bin_img: np.ndarray, snap: float = 6) -> Points:
         """
         C++版のfindFrameExistenceArea()に相当
         コマ存在領域を推定してページの四隅座標を返す
         """
         rows, cols = inverse_bin_img.shape
         
-        # ヒストグラム作成
-        histogram = np.zeros(cols, dtype=int)
-        
-        for y in range(rows):
-            for x in range(cols):
-                # 端を除外
-                if x <= 2 or x >= cols - 2 or y <= 2 or y >= rows - 2:
-                    continue
-                if inverse_bin_img[y, x] > 0:
-                    histogram[x] += 1
-        
-        # 左右境界検出
-        min_x = 0
-        max_x = cols - 1
-        
-        for x in range(cols):
-            if histogram[x] > 0:
-                min_x = x
-                break
-        
-        for x in range(cols - 1, -1, -1):
-            if histogram[x] > 0:
-                max_x = x
-                break
-        
-        # 誤差は両端に寄せる
-        if min_x < 6:
-            min_x = 0
-        if max_x > cols - 6:
-            max_x = cols
+        # ヒストグラム作成（端を除外）と左右境界検出
+        histogram, _ = projection_profile(inverse_bin_img)
+        min_x, max_x = profile_extent(histogram, snap)
         
         # ページの四隅座標を設定
         page_corners = Points(
@@ -565,29 +853,10 @@ class MangaProcessor:
         
         return Points(definite_lt, definite_rt, definite_lb, definite_rb)
 
-    def create_alpha_image(self, src_page: np.ndarray, definite_panel_point: Points) -> np.ndarray:
-        """
-        C++のcreateAlphaImage()に相当
-        四点座標を使用してピクセル単位でマスク処理
-        """
-        # RGBA変換
-        if len(src_page.shape) == 3:
-            rgba = cv2.cvtColor(src_page, cv2.COLOR_BGR2BGRA)
-        else:
-            rgba = cv2.cvtColor(src_page, cv2.COLOR_GRAY2BGRA)
-        
-        # 直線を更新
-        definite_panel_point.renew_line()
-        
-        # ピクセル単位で四角形外部を透明化
-        height, width = rgba.shape[:2]
-        for y in range(height):
-            for x in range(width):
-                point = Point(x, y)
-                if definite_panel_point.outside(point):
-                    rgba[y, x, 3] = 0  # アルファチャンネルを0に
-        
-        return rgba
+    def create_alpha_image(self, src_page: np.ndarray, definite_panel_point: Points,
+                           bbox: Optional[Tuple[int, int, int, int]] = None) -> np.ndarray:
+        """C++のcreateAlphaImage()に相当（create_alpha_crop() を参照）"""
+        return create_alpha_crop(src_page, definite_panel_point, bbox)
 
     def judge_area_of_bounding_box(self, bbox: Tuple[int, int, int, int], page_area: int) -> bool:
         """
@@ -595,291 +864,805 @@ class MangaProcessor:
         C++の Framedetect::judgeAreaOfBoundingBox() に相当
         """
         x, y, w, h = bbox
-        return w * h >= 0.048 * page_area
+        return w * h >= PANEL_AREA_RATIO * page_area
     
-    def speechballoon_detect(self, panel: np.ndarray) -> List[Balloon]:
+    def _balloon_contours(self, ctx: PageContext):
         """
-        吹き出し検出・抽出
-        C++の Speechballoon::speechballoon_detect() に相当
+        吹き出し候補の輪郭と特徴量を求める
+        二値化（閾値230）→ 3x3の収縮・膨張 → 輪郭検出（階層付き）はコンテキストで共有
+        戻り値: (contours, hierarchy, areas, circularities, bboxes, valid_peri)
         """
-        balloons = []
+        contours, hierarchy = ctx.balloon_contours
+        
+        # 特徴量の一括計算
+        def compute():
+            areas, peris, bboxes = contour_features(contours)
+            valid_peri = peris > 0
+            circularities = np.zeros_like(areas)
+            circularities[valid_peri] = (4.0 * np.pi * areas[valid_peri] /
+                                         (peris[valid_peri] * peris[valid_peri]))
+            return areas, circularities, bboxes, valid_peri
+        areas, circularities, bboxes, valid_peri = ctx.cached("balloon_features", compute)
+        
+        return contours, hierarchy, areas, circularities, bboxes, valid_peri
+    
+    def _balloon_candidates(self, gray: np.ndarray, contours, hierarchy: Optional[np.ndarray],
+                            areas: np.ndarray, bboxes: np.ndarray, candidates: np.ndarray,
+                            wanted: Optional[Callable[[int], bool]] = None) -> Iterator[Tuple[int, float]]:
+        """
+        幾何フィルタを通った候補から吹き出しを選び、(輪郭番号, 白黒比率) を輪郭の順に返す
+        
+        穴の輪郭は白黒比率の判定の前に除外し、残りの候補を輪郭の順に白黒比率で判定する
+        （輪郭に覆われていない画素、バウンディングボックス内のみ）。判定を通った候補のうち、
+        判定を通った内側の候補と面積がほぼ同じものは重複した入れ子の外側として除外する
+        （外側の候補が白黒比率で除外された場合は内側の候補が残る）。
+        白黒比率は必要になった候補についてだけ判定するので、呼び出し側が打ち切れば残りの候補は
+        判定しない。wanted(i) が False の候補は判定せずに飛ばす。除外数は balloon_prune_stats に集計
+        """
+        n_candidates = int(np.count_nonzero(candidates))
+        candidates, holes = prune_hole_contours(hierarchy, candidates)
+        children = candidate_children(hierarchy, candidates)
+        with self._stats_lock:
+            self.balloon_prune_stats["candidates"] += n_candidates
+            self.balloon_prune_stats["hole"] += holes
+        
+        ratios: Dict[int, Optional[float]] = {}   # 判定済みの白黒比率（除外は None）
+        
+        def passes(i: int) -> bool:
+            if i not in ratios:
+                B, W = contour_bw_counts(gray, contours[i], tuple(int(v) for v in bboxes[i]))
+                ratios[i] = B / W if W > 0 and 0.01 < (B / W) < 0.7 and B >= 10 else None
+            return ratios[i] is not None
+        
+        for i in np.flatnonzero(candidates):
+            i = int(i)
+            if (wanted is not None and not wanted(i)) or not passes(i):
+                continue
+            if is_duplicate_contour(i, children, areas, passes):
+                with self._stats_lock:
+                    self.balloon_prune_stats["duplicate"] += 1
+                continue
+            yield i, ratios[i]
+    
+    def _create_balloon(self, image: np.ndarray, cnt: np.ndarray, area: float, en: float,
+                        bbox: Tuple[int, int, int, int], bw_ratio: float) -> Balloon:
+        """白黒比率の判定を通った候補輪郭から吹き出しを作成"""
+        x, y, w, h = bbox
         
-        # グレースケール変換
-        if len(panel.shape) == 4:  # BGRA
-            gray = cv2.cvtColor(panel, cv2.COLOR_BGRA2GRAY)
-        elif len(panel.shape) == 3:  # BGR
-            gray = cv2.cvtColor(panel, cv2.COLOR_BGR2GRAY)
+        # 形状判定
+        max_rect = w * h * 0.95
+        if area >= max_rect:
+            set_type = 1  # 矩形
+        elif en >= 0.7:
+            set_type = 0  # 円形
         else:
-            gray = panel
-        
-        # 二値化
-        _, bin_img = cv2.threshold(gray, 230, 255, cv2.THRESH_BINARY)
+            set_type = 2  # ギザギザ
+        
+        # RGBA画像は保存時に image から切り出す
+        return Balloon(
+            image=None,
+            bbox=bbox,
+            contour=cnt,
+            center=(x + w // 2, y + h // 2),
+            area=area,
+            circularity=en,
+            type=set_type,
+            bw_ratio=bw_ratio,
+            panel_idx=0,  # 後で設定
+            source=image
+        )
+    
+    def speechballoon_detect(self, panel: PageLike,
+                             max_balloons: Optional[int] = None) -> List[Balloon]:
+        """
+        吹き出し検出・抽出
+        C++の Speechballoon::speechballoon_detect() に相当
         
-        # モルフォロジー処理
-        kernel = np.ones((3, 3), np.uint8)
-        bin_img = cv2.erode(bin_img, kernel, iterations=1)
-        bin_img = cv2.dilate(bin_img, kernel, iterations=1)
+        輪郭の特徴量（面積・周囲長・円形度・バウンディングボックス）は一括で計算し、
+        安い判定から順に候補を絞り込む。輪郭の階層から穴の候補を除外してから
+        白黒比率をバウンディングボックスの範囲だけで判定し、判定を通った候補の中で
+        重複した入れ子の候補を除外する（_balloon_candidates() を参照）。
+        max_balloons を指定した場合、検出数がそれを超えた時点で打ち切り、残りの候補は判定しない
+        （呼び出し側はその結果を max_balloons 超過として扱う）
+        """
+        balloons = []
+        ctx = PageContext.of(panel)
+        panel = ctx.page
+        gray = ctx.gray
         
-        # 輪郭検出
-        contours, _ = cv2.findContours(bin_img, cv2.RETR_LIST, cv2.CHAIN_APPROX_NONE)
+        contours, hierarchy, areas, circularities, bboxes, valid_peri = self._balloon_contours(ctx)
         
         panel_area = panel.shape[0] * panel.shape[1]
         
-        for i, cnt in enumerate(contours):
-            area = cv2.contourArea(cnt)
-            peri = cv2.arcLength(cnt, True)
-            
-            if peri == 0:
-                continue
-                
-            en = 4.0 * np.pi * area / (peri * peri)  # 円形度
-            
-            # C++と同じ面積と円形度フィルタ
-            if not (panel_area * 0.01 <= area < panel_area * 0.9 and en > 0.4):
-                continue
-            
-            # バウンディングボックス取得
-            bbox = cv2.boundingRect(cnt)
-            x, y, w, h = bbox
-            
-            center_x = x + w // 2
-            center_y = y + h // 2
-            
-            # マスク作成（C++と同じ処理）
-            mask = np.full(gray.shape, 255, dtype=np.uint8)  # 初期値255で初期化
-            cv2.drawContours(mask, [cnt], -1, 0, 4)  # 輪郭を太さ4で0（黒）で描画
-            cv2.drawContours(mask, [cnt], -1, 0, -1)  # 内部を0（黒）で塗りつぶし
-            
-            # C++のcopyTo処理を再現：マスクを使って背景をグレー（150）にする
-            back_150 = np.full(gray.shape, 150, dtype=np.uint8)
-            masked_img = gray.copy()
-            # マスクが0（黒）の部分にback_150をコピー（C++のcopyTo処理）
-            masked_img = np.where(mask == 0, back_150, gray)
-            
-            # 切り出し
-            cropped_region = masked_img[y:y+h, x:x+w]
+        # C++と同じ面積と円形度フィルタ、コマサイズ判定（配列でまとめて判定）
+        candidates = (valid_peri &
+                      (panel_area * 0.01 <= areas) & (areas < panel_area * 0.9) &
+                      (circularities > 0.4) &
+                      (bboxes[:, 2] * bboxes[:, 3] < panel_area * 0.9))
+        for i, bw_ratio in self._balloon_candidates(gray, contours, hierarchy, areas, bboxes, candidates):
+            bbox = tuple(int(v) for v in bboxes[i])
+            balloons.append(self._create_balloon(panel, contours[i], float(areas[i]),
+                                                 float(circularities[i]), bbox, bw_ratio))
             
-            # 白黒比率計算
-            TH = 255 // 3  # 85
-            B = np.sum((cropped_region < TH) & (cropped_region != 150))
-            W = np.sum(cropped_region > (255 - TH))
-            
-            if W == 0 or not (0.01 < (B / W) < 0.7) or B < 10:
-                continue
-            
-            # 形状判定
-            max_rect = w * h * 0.95
-            if area >= max_rect:
-                set_type = 1  # 矩形
-            elif en >= 0.7:
-                set_type = 0  # 円形
-            else:
-                set_type = 2  # ギザギザ
-            
-            # コマサイズ判定
-            if w * h >= panel_area * 0.9:
-                continue
-            
-            # RGBA画像作成
-            if len(panel.shape) == 3:
-                rgba_panel = cv2.cvtColor(panel, cv2.COLOR_BGR2BGRA)
-            else:
-                rgba_panel = panel.copy()
-            
-            # 透明化
-            alpha_mask = np.zeros(gray.shape, dtype=np.uint8)
-            cv2.drawContours(alpha_mask, [cnt], -1, 255, -1)
-            rgba_panel[:, :, 3] = alpha_mask
-            
-            # 切り出し
-            balloon_img = rgba_panel[y:y+h, x:x+w].copy()
-            
-            balloon = Balloon(
-                image=balloon_img,
-                bbox=(x, y, w, h),
-                contour=cnt,
-                center=(center_x, center_y),
-                area=area,
-                circularity=en,
-                type=set_type,
-                bw_ratio=B / W if W > 0 else 0,
-                panel_idx=0  # 後で設定
-            )
-            balloons.append(balloon)
+            # 最大吹き出し数を超えたら打ち切り
+            if max_balloons is not None and len(balloons) > max_balloons:
+                break
         
         return balloons
     
+    def speechballoon_detect_page(self, page: PageLike, panels: List[Panel],
+                                  max_balloons: Optional[int] = None) -> List[List[Balloon]]:
+        """
+        ページ全体で一度だけ吹き出しを検出し、コマに割り当てる
+        
+        二値化・輪郭検出はページ単位で1回だけ行い、各候補は中心点を含むコマ
+        （複数ある場合は最小のコマ）に割り当てる。面積・コマサイズの判定は
+        割り当て先のコマの大きさを基準に speechballoon_detect() と同じ条件で行う。
+        コマの境界をまたぐ吹き出しも切れずに1つとして検出される。
+        二値化・輪郭はフレーム検出と同じ PageContext を渡せば共有される。
+        戻り値の bbox・contour・center は割り当て先コマの左上を原点とした座標
+        （コマ外にはみ出す場合は負の値やコマサイズ超えの値になる）
+        戻り値: panels と同じ順のコマごとの吹き出しリスト
+        """
+        panel_balloons: List[List[Balloon]] = [[] for _ in panels]
+        if not panels:
+            return panel_balloons
+        
+        ctx = PageContext.of(page)
+        page = ctx.page
+        gray = ctx.gray
+        
+        contours, hierarchy, areas, circularities, bboxes, valid_peri = self._balloon_contours(ctx)
+        
+        # 候補の中心点からコマを検索
+        panel_bboxes = np.array([panel.bbox for panel in panels], dtype=np.int64).reshape(-1, 4)
+        owners = locate_in_bboxes(panel_bboxes,
+                                  bboxes[:, 0] + bboxes[:, 2] // 2,
+                                  bboxes[:, 1] + bboxes[:, 3] // 2)
+        assigned = owners >= 0
+        owner_area = np.where(assigned, panel_bboxes[owners, 2] * panel_bboxes[owners, 3], 0)
+        
+        # 割り当て先のコマの大きさを基準に面積と円形度フィルタ、コマサイズ判定
+        candidates = (assigned & valid_peri &
+                      (owner_area * 0.01 <= areas) & (areas < owner_area * 0.9) &
+                      (circularities > 0.4) &
+                      (bboxes[:, 2] * bboxes[:, 3] < owner_area * 0.9))
+        # 最大吹き出し数を超えたコマの候補はそれ以上判定しない
+        def wanted(i: int) -> bool:
+            return max_balloons is None or len(panel_balloons[owners[i]]) <= max_balloons
+        
+        for i, bw_ratio in self._balloon_candidates(gray, contours, hierarchy, areas, bboxes, candidates,
+                                                    wanted):
+            bbox = tuple(int(v) for v in bboxes[i])
+            balloon = self._create_balloon(page, contours[i], float(areas[i]),
+                                           float(circularities[i]), bbox, bw_ratio)
+            
+            # コマ基準の座標に変換
+            balloon.rebase(*panels[owners[i]].bbox[:2])
+            panel_balloons[owners[i]].append(balloon)
+        
+        return panel_balloons
+    
     def remove_false_balloons(self, balloons: List[Balloon]) -> List[Balloon]:
         """
         誤検出除去処理
         C++の誤検出除去ロジックに相当
         """
+        return self._filter_false_balloons(balloons)[0]
+    
+    def _filter_false_balloons(self, balloons: List[Balloon]) -> Tuple[List[Balloon], List[np.ndarray]]:
+        """remove_false_balloons() と同じ判定で、残った吹き出しと判定に使ったRGBA画像を返す"""
         balloon_px_th = 5
         filtered_balloons = []
+        images = []
         
         for balloon in balloons:
-            balloon_img = balloon.image
-            h, w = balloon_img.shape[:2]
-            
-            # BGRAをグレースケールに変換
-            gray_balloon = cv2.cvtColor(balloon_img, cv2.COLOR_BGRA2GRAY)
-            
-            # 二値化
-            _, bin_balloon = cv2.threshold(gray_balloon, 150, 255, cv2.THRESH_BINARY)
-            bin_balloon_bgra = cv2.cvtColor(bin_balloon, cv2.COLOR_GRAY2BGRA)
-            bin_balloon_bgra[:, :, 3] = balloon_img[:, :, 3]
-            
-            # エッジマーキング
-            marked_img = bin_balloon_bgra.copy()
-            
-            for y in range(h):
-                for x in range(w):
-                    p = marked_img[y, x]
-                    
-                    # 端から一定距離内または透明画素の周辺をマーク
-                    if (x <= balloon_px_th or y <= balloon_px_th or 
-                        x >= w - balloon_px_th or y >= h - balloon_px_th):
-                        if p[3] != 0:
-                            marked_img[y, x] = [255, 0, 0, p[3]]
-                    else:
-                        # 周辺透明画素チェック
-                        is_edge = False
-                        for th in range(1, balloon_px_th + 1):
-                            neighbors = []
-                            if y - th >= 0:
-                                neighbors.append(marked_img[y - th, x])
-                            if y + th < h:
-                                neighbors.append(marked_img[y + th, x])
-                            if x - th >= 0:
-                                neighbors.append(marked_img[y, x - th])
-                            if x + th < w:
-                                neighbors.append(marked_img[y, x + th])
-                            
-                            for neighbor in neighbors:
-                                if neighbor[3] == 0:
-                                    is_edge = True
-                                    break
-                            if is_edge:
-                                break
-                        
-                        if is_edge and p[3] != 0:
-                            marked_img[y, x] = [255, 0, 0, p[3]]
-            
-            # 黒画素カウント
-            edge_black_count = 0
-            black_count = 0
-            
-            for y in range(h):
-                for x in range(w):
-                    p = marked_img[y, x]
-                    
-                    if p[3] != 0:
-                        # 隣接赤マークチェック
-                        is_adjacent_to_red = False
-                        for dy, dx in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-                            ny, nx = y + dy, x + dx
-                            if 0 <= ny < h and 0 <= nx < w:
-                                neighbor = marked_img[ny, nx]
-                                if (neighbor[0] == 255 and neighbor[1] == 0 and 
-                                    neighbor[2] == 0):
-                                    is_adjacent_to_red = True
-                                    break
-                        
-                        # エッジ黒画素カウント
-                        if (is_adjacent_to_red and 
-                            not (p[0] == 255 and p[1] == 0 and p[2] == 0) and
-                            p[0] == 0 and p[1] == 0 and p[2] == 0):
-                            edge_black_count += 1
-                        
-                        # 全体黒画素カウント
-                        if p[0] == 0 and p[1] == 0 and p[2] == 0:
-                            black_count += 1
+            # エッジマーキングと黒画素カウント（配列演算で一括処理）
+            image = balloon.image
+            edge_black_count, black_count = false_balloon_counts(image, balloon_px_th)
             
             # 判定
             if edge_black_count == 0 and black_count >= 100:
                 filtered_balloons.append(balloon)
+                images.append(image)
         
-        return filtered_balloons
+        return filtered_balloons, images
+    
+    def _log(self, message: str) -> None:
+        if self.verbose:
+            print(message)
+    
+    def process_image(self, i: int, image_path: str) -> Tuple[List[Panel], List[Balloon]]:
+        """
+        1枚の画像を処理してコマ・吹き出し画像を保存する
+        吹き出しの panel_idx は戻り値のコマのリスト内の番号
+        """
+        result = self.process_image_result(i, image_path)
+        return result.panels, result.balloons
+    
+    def process_image_result(self, i: int, image_path: str,
+                             decoded: Optional[Callable[[], Optional[np.ndarray]]] = None) -> ImageResult:
+        """
+        1枚の画像を処理してコマ・吹き出し画像を保存し、処理時間とともに返す
+        decoded を渡した場合は読み込み済み（先読み中）の画像をそこから受け取る
+        threads > 1 の場合は見開きの各ページと、コマごとの吹き出し検出をスレッドプールで並列に行う
+        """
+        start = time.perf_counter()
+        result = ImageResult(i, image_path, 0, [], [], {})
+        
+        self._log(f"Processing: {image_path}")
+        
+        # 画像読み込み（先読みしていなければここで読み込む）
+        img = decoded() if decoded is not None else read_gray(image_path)
+        decode_end = time.perf_counter()
+        pages = self.page_cut(img) if img is not None else []
+        result.pages = len(pages)
+        
+        with self._writing(), self._thread_pools() as (map_pages, map_panels):
+            results = map_pages(lambda j: self._process_page(i, j, pages[j], map_panels, image_path),
+                                range(len(pages)))
+            # ページ順に連結（吹き出しの panel_idx を画像内の通し番号に直す）
+            for panels, balloons in results:
+                for balloon in balloons:
+                    balloon.panel_idx += len(result.panels)
+                result.panels.extend(panels)
+                result.balloons.extend(balloons)
+        
+        end = time.perf_counter()
+        result.timings = {"decode": decode_end - start, "detect": end - decode_end, "total": end - start}
+        return result
+    
+    @contextmanager
+    def _writing(self):
+        """
+        コマ・吹き出し画像の保存先 CropWriter を用意する
+        外側で用意済みならそれを使い、なければ作成して抜けるときにすべての保存を待つ
+        （保存に失敗したファイルがあれば CropWriteError）
+        """
+        if self._writer is not None:
+            yield self._writer
+            return
+        writer = self.open_writer()
+        self._writer = writer
+        try:
+            with writer:
+                yield writer
+        finally:
+            self._writer = None
+            for key, value in writer.stats().items():
+                self.writer_stats[key] += value
+    
+    def open_writer(self, shard_prefix: str = "crops") -> CropWriter:
+        """
+        設定に従って CropWriter を作成する
+        shard_bytes 指定時は shards/<shard_prefix>-NNNNN.tar に追記する（同時に書き込むプロセスごとに別の prefix）
+        """
+        sink = None
+        if self.shard_bytes:
+            sink = ShardWriter(self.shards_dir, shard_prefix, self.shard_bytes, base=self.output_folder)
+        return CropWriter(workers=self.writers, fmt=self.crop_format, sink=sink)
+    
+    @contextmanager
+    def _thread_pools(self):
+        """
+        ページ用・コマ用の map 関数を返す（threads <= 1 なら逐次処理）
+        ページのスレッドがコマのスレッドの完了を待つため、プールは別々に用意する
+        """
+        if self.threads <= 1:
+            yield (lambda f, items: [f(x) for x in items]), (lambda f, items: [f(x) for x in items])
+            return
+        with ThreadPoolExecutor(max_workers=PAGE_THREADS) as page_pool, \
+                ThreadPoolExecutor(max_workers=self.threads) as panel_pool:
+            # map() は完了順によらず投入順に結果を返す
+            yield (lambda f, items: list(page_pool.map(f, items))), \
+                  (lambda f, items: list(panel_pool.map(f, items)))
+    
+    def _process_page(self, i: int, j: int, page: np.ndarray,
+                      map_panels: Callable, image_path: str = "") -> Tuple[List[Panel], List[Balloon]]:
+        """1ページを処理する（吹き出しの panel_idx はページ内のコマ番号）"""
+        # ページ単位の前処理結果を各処理で共有
+        page = PageContext(page)
+        
+        # ページ分類
+        is_black_page = self.get_page_type(page)
+        
+        # フレーム検出（黒ページは専用の検出）
+        if is_black_page:
+            panels = self.black_page_frame_detect(page)
+        else:
+            panels = self.frame_detect(page)
+        self._log(f"  Processing page {i}_{j} (frame engine: {self.last_frame_engine})")
+        
+        # ページ単位の吹き出し検出（コマへの割り当て）
+        page_balloons = None
+        if self.page_level_balloons:
+            page_balloons = self.speechballoon_detect_page(page, panels, self.speechballoon_max)
+        
+        for k, panel in enumerate(panels):
+            panel.page_idx = j
+            panel.panel_idx = k
+        
+        balloons_out: List[Balloon] = []
+        balloon_images: List[np.ndarray] = []
+        for k, (balloons, images) in enumerate(map_panels(
+                lambda k: self._process_panel(i, j, k, page, panels[k], image_path,
+                                              page_balloons[k] if page_balloons else None),
+                range(len(panels)))):
+            for balloon in balloons:
+                balloon.panel_idx = k
+            balloons_out.extend(balloons)
+            if self.balloon_atlas:
+                balloon_images.extend(images)
+        
+        if self.balloon_atlas and balloons_out:
+            self._save_balloon_atlas(i, j, balloons_out, balloon_images, image_path)
+        
+        if self.debug_copies:
+            self._log(f"    full-page copies: {sum(page.page_copies.values())} {dict(page.page_copies)}")
+        
+        return panels, balloons_out
     
-    def process_images(self):
-        """メイン処理"""
-        image_paths = self.get_image_paths()
+    def _process_panel(self, i: int, j: int, k: int, page: PageContext, panel: Panel, image_path: str,
+                       balloons: Optional[List[Balloon]]) -> Tuple[List[Balloon], List[np.ndarray]]:
+        """
+        コマ画像と吹き出し画像を保存し、誤検出除去後の吹き出しとそのRGBA画像を返す
+        保存形式は crop_format（拡張子は形式に合わせて置き換わる。mask 形式は元ページの参照を保存）
+        """
+        # パネル保存（RGBA画像はここで作成し、保存後は保持しない）
+        panel_image = panel.image
+        panel_filename = f"{i:03d}_{j}_{k}.png"
+        self._writer.submit(self.panels_dir / panel_filename, panel_image,
+                            {"source": image_path, "page": j, "bbox": panel.bbox})
+        
+        # 吹き出し検出
+        if balloons is None:
+            balloons = self.speechballoon_detect(panel_image, self.speechballoon_max)
+            # 切り出し元をコマ画像からページに差し替える（コマ画像を保持しない）
+            for balloon in balloons:
+                balloon.set_source(page.page, panel.bbox[:2])
+        
+        if len(balloons) > self.speechballoon_max:
+            return [], []
+        
+        # 誤検出除去（判定に使ったRGBA画像をそのまま保存する）
+        filtered_balloons, images = self._filter_false_balloons(balloons)
+        
+        # 吹き出し保存（balloon_atlas ならページごとにまとめて _process_page() で保存）
+        if not self.balloon_atlas:
+            for l, (balloon, image) in enumerate(zip(filtered_balloons, images)):
+                balloon_filename = f"{i:03d}_{j}_{k}_{l}.png"
+                self._writer.submit(self.balloons_dir / balloon_filename, image,
+                                    {"source": image_path, "page": j, "bbox": balloon.source_bbox})
+        
+        return filtered_balloons, images
+    
+    def _save_balloon_atlas(self, i: int, j: int, balloons: List[Balloon], images: List[np.ndarray],
+                            image_path: str) -> None:
+        """
+        1ページ分の吹き出し（panel_idx はページ内のコマ番号）を、_process_panel() で作成した
+        RGBA画像 images からアトラス画像と JSON にまとめて保存する
+        キーは吹き出しのファイル名と同じ <画像番号>_<ページ>_<コマ番号>_<吹き出し番号>
+        """
+        atlas, rects = build_atlas(images)
+        entries = {}
+        counts: Dict[int, int] = {}
+        for balloon, rect in zip(balloons, rects):
+            k = balloon.panel_idx
+            l = counts[k] = counts.get(k, -1) + 1
+            entries[f"{i:03d}_{j}_{k}_{l}"] = {"rect": list(rect), "bbox": list(balloon.bbox),
+                                              "page_bbox": list(balloon.source_bbox), "panel": k}
+        name = atlas_name(i, j)
+        image_name = name + self.crop_format.suffix
+        meta = {"image": image_name, "source": image_path, "page": j,
+                "size": [atlas.shape[1], atlas.shape[0]], "balloons": entries}
+        self._writer.submit(self.balloons_dir / image_name, atlas)
+        self._writer.write_bytes(self.balloons_dir / f"{name}.json",
+                                 json.dumps(meta, ensure_ascii=False).encode("utf-8"))
+    
+    def load_atlas(self, i: int, j: int, shards: Optional[ShardReader] = None) -> BalloonAtlas:
+        """
+        balloon_atlas で保存した画像番号 i・ページ j の吹き出しのアトラスを読み込む
+        シャードに保存した場合は open_shards() で開いた shards を渡す
+        """
+        json_name = f"{atlas_name(i, j)}.json"
+        if shards is not None:
+            return BalloonAtlas.from_shards(shards, f"{self.balloons_dir.name}/{json_name}")
+        return BalloonAtlas.load(self.balloons_dir / json_name)
+    
+    def load_page(self, image_path: str, page_idx: int) -> np.ndarray:
+        """元画像を読み込んでページ分割し、page_idx 番目のページを返す（mask 形式の復元用）"""
+        img = read_gray(image_path)
+        if img is None:
+            raise FileNotFoundError(f"Cannot load image from {image_path}")
+        return self.page_cut(img)[page_idx]
+    
+    def load_crop(self, path: str) -> np.ndarray:
+        """保存したコマ・吹き出し画像をBGRA画像として読み込む（mask 形式は元ページから復元）"""
+        return decode_crop(path, self.load_page)
+    
+    def open_shards(self) -> ShardReader:
+        """
+        shard_bytes 指定時に保存したシャードを開く
+        read(キー, self.load_page) でキー（000_0_0 など）の画像を展開せずに読み出せる
+        """
+        return ShardReader(self.shards_dir)
+    
+    def _merge_stats(self, stats: Dict[str, Dict[str, int]]) -> None:
+        """ワーカーで集計したフレームエンジン・吹き出し間引きの統計を加算する"""
+        for key, value in stats["frame_engine"].items():
+            self.frame_engine_stats[key] += value
+        for key, value in stats["balloon_prune"].items():
+            self.balloon_prune_stats[key] += value
+        for key, value in stats["writer"].items():
+            self.writer_stats[key] += value
+    
+    def iter_process(self, image_paths: Optional[List[str]] = None) -> Iterator[ImageResult]:
+        """
+        画像を1枚処理するごとに、その画像の結果を画像番号順に返すジェネレータ
+        workers > 1 の場合は画像単位でプロセスプールに分散し、処理中・処理済みで未取得の画像を
+        2 * workers 枚までに抑える（フォルダの大きさによらずメモリ使用量が一定）
+        image_paths を省略した場合は入力フォルダの全画像を処理する
+        """
+        if image_paths is None:
+            image_paths = self.get_image_paths()
+        if self.cv_threads is not None:
+            ThreadBudget(self.workers, self.threads, self.cv_threads).apply()
+        
+        if self.workers > 1 and len(image_paths) > 1:
+            yield from self._iter_pool(image_paths)
+            return
+        # 保存は画像をまたいで検出と並行して行い、最後にすべての保存を待つ
+        with self._writing():
+            if self.prefetch > 0:
+                yield from self._iter_prefetch(image_paths)
+            else:
+                for i, path in enumerate(image_paths):
+                    yield self.process_image_result(i, path)
+    
+    def process_images(self, image_paths: Optional[List[str]] = None):
+        """
+        メイン処理（iter_process() の結果をすべて集める）
+        吹き出しの panel_idx は戻り値のコマのリスト内の通し番号
+        """
+        if image_paths is None:
+            image_paths = self.get_image_paths()
         
         all_panels = []
         all_balloons = []
-        
-        print(f"Processing {len(image_paths)} images...")
-        
-        for i, image_path in enumerate(image_paths):
-            print(f"Processing: {image_path}")
-            
-            # 画像読み込み（C++と同じグレースケール読み込み）
-            img = cv2.imread(image_path, 0)  # 0でグレースケール読み込み
-            if img is None:
-                continue
-            
-            # ページ分割
-            pages = self.page_cut(img)
-            
-            for j, page in enumerate(pages):
-                # ページ分類
-                is_black_page = self.get_page_type(page)
-                if is_black_page:
-                    print(f"  Skipping black page {i}_{j}")
-                    continue
-                
-                print(f"  Processing page {i}_{j}")
-                
-                # フレーム検出
-                panels = self.frame_detect(page)
-                
-                for k, panel in enumerate(panels):
-                    panel.page_idx = j
-                    panel.panel_idx = k
-                    all_panels.append(panel)
-                    
-                    # パネル保存
-                    panel_filename = f"{i:03d}_{j}_{k}.png"
-                    cv2.imwrite(str(self.panels_dir / panel_filename), panel.image)
-                    
-                    # 吹き出し検出
-                    balloons = self.speechballoon_detect(panel.image)
-                    
-                    if len(balloons) > self.speechballoon_max:
-                        continue
-                    
-                    # 誤検出除去
-                    filtered_balloons = self.remove_false_balloons(balloons)
-                    
-                    for l, balloon in enumerate(filtered_balloons):
-                        balloon.panel_idx = len(all_panels) - 1
-                        all_balloons.append(balloon)
-                        
-                        # 吹き出し保存
-                        balloon_filename = f"{i:03d}_{j}_{k}_{l}.png"
-                        cv2.imwrite(str(self.balloons_dir / balloon_filename), balloon.image)
-        
-        print(f"Processing complete!")
-        print(f"Total panels: {len(all_panels)}")
-        print(f"Total balloons: {len(all_balloons)}")
+        timings = {"decode": 0.0, "detect": 0.0}
+        
+        self._log(f"Processing {len(image_paths)} images...")
+        
+        for result in self.iter_process(image_paths):
+            for key in timings:
+                timings[key] += result.timings[key]
+            for balloon in result.balloons:
+                balloon.panel_idx += len(all_panels)
+            all_panels.extend(result.panels)
+            all_balloons.extend(result.balloons)
+        
+        self._log("Processing complete!")
+        self._log(f"Total panels: {len(all_panels)}")
+        self._log(f"Total balloons: {len(all_balloons)}")
+        stats = self.balloon_prune_stats
+        self._log(f"Balloon candidates: {stats['candidates']} "
+                  f"(pruned hole={stats['hole']}, duplicate={stats['duplicate']})")
+        engines = self.frame_engine_stats
+        pages = sum(engines.values())
+        self._log(f"Frame engine: xycut={engines['xycut']}, hough={engines['hough']}, "
+                  f"blackpage={engines['blackpage']} "
+                  f"(fast path {100.0 * engines['xycut'] / pages if pages else 0.0:.1f}%)")
+        writes = self.writer_stats
+        unit = "shard members" if self.shard_bytes else "files"
+        self._log(f"Writer: {writes['written']} {unit} ({writes['failed']} failed), "
+                  f"backpressure wait {writes['blocked_seconds']:.2f} s")
+        busy = timings["decode"] + timings["detect"]
+        self._log(f"Decode wait: {timings['decode']:.2f} s, compute: {timings['detect']:.2f} s "
+                  f"({100.0 * timings['decode'] / busy if busy else 0.0:.1f}% waiting on decode)")
         
         return all_panels, all_balloons
+    
+    def _iter_prefetch(self, image_paths: List[str]) -> Iterator[ImageResult]:
+        """
+        処理中の画像の次の prefetch 枚をバックグラウンドのスレッドで読み込みながら処理する
+        （読み込み済みで未処理の画像は prefetch 枚まで）
+        """
+        decoder = ThreadPoolExecutor(max_workers=self.prefetch)
+        try:
+            tasks = iter(enumerate(image_paths))
+            pending = deque((i, path, decoder.submit(read_gray, path))
+                            for i, path in itertools.islice(tasks, self.prefetch))
+            while pending:
+                i, path, future = pending.popleft()
+                for j, next_path in itertools.islice(tasks, 1):
+                    pending.append((j, next_path, decoder.submit(read_gray, next_path)))
+                yield self.process_image_result(i, path, future.result)
+        finally:
+            decoder.shutdown(wait=True, cancel_futures=True)
+    
+    def _iter_pool(self, image_paths: List[str]) -> Iterator[ImageResult]:
+        """
+        画像単位でプロセスプールに分散し、結果を投入順に返す
+        transport="shm" の場合はワーカーごとの共有メモリのリングでページ・切り出し画像を受け取る
+        （リングは途中で取得をやめた場合や例外時も含めて必ずここで unlink する）
+        """
+        n_workers = min(self.workers, len(image_paths))
+        mp_context = multiprocessing.get_context("spawn")
+        rings: Dict[str, ShmRing] = {}
+        ring_names = None
+        executor = None
+        try:
+            if self.transport == "shm":
+                try:
+                    for _ in range(n_workers):
+                        ring = ShmRing.create(SHM_RING_BYTES)
+                        rings[ring.name] = ring
+                except OSError as e:
+                    self._log(f"Shared memory unavailable ({e}); falling back to pickle transport")
+                    for ring in rings.values():
+                        ring.close()
+                    rings = {}
+                if rings:
+                    # 各ワーカーは起動時にリングを1つずつ受け取る
+                    ring_names = mp_context.SimpleQueue()
+                    for name in rings:
+                        ring_names.put(name)
+            
+            executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                                           initializer=_init_worker,
+                                           initargs=(self.worker_config(), ring_names))
+            # 投入済みで未取得の画像を 2 * n_workers 枚までに抑え、投入順に取り出す
+            tasks = iter(enumerate(image_paths))
+            pending = deque(executor.submit(_process_image_in_worker, i, path)
+                            for i, path in itertools.islice(tasks, 2 * n_workers))
+            while pending:
+                result, stats = pending.popleft().result()
+                for i, path in itertools.islice(tasks, 1):
+                    pending.append(executor.submit(_process_image_in_worker, i, path))
+                if rings:
+                    _unpack_arrays(result.panels + result.balloons, rings)
+                self._merge_stats(stats)
+                yield result
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+            for ring in rings.values():
+                ring.close()
+    
+    def worker_config(self) -> Dict[str, Any]:
+        """ワーカープロセスで同じ設定の MangaProcessor を作るための引数"""
+        return {
+            "input_folder": str(self.input_folder),
+            "output_folder": str(self.output_folder),
+            "page_level_balloons": self.page_level_balloons,
+            "pyramid_height": self.pyramid_height,
+            "frame_engine": self.frame_engine,
+            "debug_copies": self.debug_copies,
+            "threads": self.threads,
+            "cv_threads": self.cv_threads,
+            "transport": self.transport,
+            "prefetch": self.prefetch,
+            "writers": self.writers,
+            "crop_format": self.crop_format,
+            "shard_bytes": self.shard_bytes,
+            "balloon_atlas": self.balloon_atlas,
+            "verbose": self.verbose,
+        }
+
+
+# ワーカープロセスごとの MangaProcessor と送信用の共有メモリのリング（_init_worker() で作成）
+_worker_processor: Optional[MangaProcessor] = None
+_worker_ring: Optional[ShmRing] = None
+
+
+def _init_worker(config: Dict[str, Any], ring_names=None) -> None:
+    global _worker_processor, _worker_ring
+    # OpenCV内部のスレッド数は配分に従う（指定がなければ並列化はプロセス単位で行い、内部では使わない）
+    ThreadBudget(threads=config.get("threads", 1), cv_threads=config.get("cv_threads") or 1).apply()
+    _worker_processor = MangaProcessor(**config)
+    # 保存はワーカーの終了まで続け、画像ごとに完了を待つ（シャードはワーカーごとに別の prefix）
+    writer = _worker_processor.open_writer(shard_prefix=f"crops-{os.getpid()}")
+    _worker_processor._writer = writer
+    multiprocessing.util.Finalize(writer, writer.close, kwargs={"raise_errors": False}, exitpriority=10)
+    if ring_names is not None:
+        _worker_ring = ShmRing.attach(ring_names.get())
+
+
+def _pack_arrays(records, ring: ShmRing) -> None:
+    """
+    レコードが参照するページ・切り出し画像をリングに書き込み、ハンドルに置き換える
+    （同じ配列は1回だけ書き込む。空きがなければ配列のまま pickle で送る）
+    """
+    handles: Dict[int, Any] = {}
+    for record in records:
+        for slot in ("_source", "_image"):
+            arr = getattr(record, slot)
+            if isinstance(arr, np.ndarray):
+                if id(arr) not in handles:
+                    handles[id(arr)] = ring.put(arr) or arr
+                setattr(record, slot, handles[id(arr)])
+
+
+def _unpack_arrays(records, rings: Dict[str, ShmRing]) -> None:
+    """_pack_arrays() で置き換えたハンドルを、リングからコピーした配列に戻す"""
+    slots = [(record, slot) for record in records for slot in ("_source", "_image")
+             if isinstance(getattr(record, slot), ShmHandle)]
+    arrays = receive(rings, (getattr(record, slot) for record, slot in slots))
+    for record, slot in slots:
+        setattr(record, slot, arrays[getattr(record, slot)])
+
+
+def _process_image_in_worker(i: int, image_path: str):
+    """ワーカーで1枚を処理し、結果とその画像分の統計を返す"""
+    processor = _worker_processor
+    writer = processor._writer
+    failed = len(writer.failures)
+    before = {"frame_engine": dict(processor.frame_engine_stats),
+              "balloon_prune": dict(processor.balloon_prune_stats),
+              "writer": writer.stats()}
+    result = processor.process_image_result(i, image_path)
+    # この画像の保存が終わってから返す（失敗したファイルがあれば CropWriteError）
+    writer.flush()
+    if len(writer.failures) > failed:
+        raise CropWriteError(writer.failures[failed:])
+    if _worker_ring is not None:
+        _pack_arrays(result.panels + result.balloons, _worker_ring)
+    stats = {"frame_engine": {k: v - before["frame_engine"][k]
+                              for k, v in processor.frame_engine_stats.items()},
+             "balloon_prune": {k: v - before["balloon_prune"][k]
+                               for k, v in processor.balloon_prune_stats.items()},
+             "writer": {k: v - before["writer"][k] for k, v in writer.stats().items()}}
+    return result, stats
+
+
+def measure_throughput(config: Dict[str, Any], budget: ThreadBudget,
+                       image_paths: Optional[List[str]] = None) -> float:
+    """
+    budget の配分で画像を処理し、スループット（ページ/秒）を返す
+    出力は一時フォルダに書き出して破棄する
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        processor = MangaProcessor(**dict(config, output_folder=tmp, verbose=False,
+                                          workers=budget.workers, threads=budget.threads,
+                                          cv_threads=budget.cv_threads))
+        start = time.perf_counter()
+        processor.process_images(image_paths)
+        elapsed = time.perf_counter() - start
+    pages = sum(processor.frame_engine_stats.values())
+    return pages / elapsed if elapsed > 0 else 0.0
+
+
+def auto_budget(config: Dict[str, Any], cores: int, threads: int = 1,
+                sample_images: Optional[int] = None) -> ThreadBudget:
+    """
+    入力フォルダ先頭のサンプル画像で候補の配分ごとにスループットを測り、最も速い配分を返す
+    サンプル数の既定は最大ワーカー数の2倍（8枚以上）
+    """
+    candidates = candidate_budgets(cores, threads)
+    image_paths = MangaProcessor(**dict(config, verbose=False)).get_image_paths()
+    if sample_images is None:
+        sample_images = max(8, 2 * candidates[-1].workers)
+    sample = image_paths[:sample_images]
+    best, results = choose_budget(candidates, lambda b: measure_throughput(config, b, sample))
+    print(f"Concurrency auto ({cores} cores, {len(sample)} sample images):")
+    for budget, pages_per_sec in results:
+        mark = "*" if budget == best else " "
+        print(f"  {mark} {budget}  {pages_per_sec:7.2f} pages/s")
+    return best
+
+
+def scaling_report(config: Dict[str, Any], max_workers: int,
+                   cores: Optional[int] = None) -> List[Tuple[int, float]]:
+    """
+    同じ入力フォルダを1〜max_workersプロセス（1, 2, 4, ... と max_workers）で処理し、
+    スループット（ページ/秒）を表示する。OpenCVのスレッドには残りのコアを割り当てる
+    """
+    cores = cores or available_cores()
+    counts = sorted({min(2 ** p, max_workers) for p in range(max_workers.bit_length() + 1)})
+    results = []
+    print("Scaling report:")
+    for n in counts:
+        budget = split_budget(cores, n, config.get("threads", 1))
+        throughput = measure_throughput(config, budget)
+        results.append((n, throughput))
+        print(f"  {budget}  {throughput:7.2f} pages/s  "
+              f"x{throughput / results[0][1] if results[0][1] else 0.0:.2f}")
+    return results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="マンガ画像からコマと吹き出しを検出・抽出")
+    parser.add_argument("input_folder", help="入力画像フォルダ")
+    parser.add_argument("output_folder", help="出力フォルダ")
+    parser.add_argument("--page-balloons", action="store_true",
+                        help="吹き出しをページ単位で一度だけ検出し、コマに割り当てる")
+    parser.add_argument("--frame-engine", choices=["auto", "hough"], default="auto",
+                        help="auto: 格子状のページはXYカットで分割し、それ以外はHough直線検出 / "
+                             "hough: 常にHough直線検出")
+    parser.add_argument("--debug-copies", action="store_true",
+                        help="ページごとにページ全体のコピー回数を表示する（デバッグ用）")
+    parser.add_argument("--pyramid", nargs="?", type=int, const=1170, default=None, metavar="HEIGHT",
+                        help="高解像度ページを高さHEIGHT（省略時1170）に縮小してコマ候補を検出し、"
+                             "四隅だけを原寸で精密化する")
+    parser.add_argument("--workers", type=int, default=1, metavar="N",
+                        help="画像単位でN個のプロセスに分散して処理する（出力は1プロセスの場合と同じ）")
+    parser.add_argument("--scaling-report", action="store_true",
+                        help="処理後に同じ入力を1〜Nプロセスで処理し、スループットを表示する")
+    parser.add_argument("--threads", type=int, default=1, metavar="N",
+                        help="1枚の画像内の2ページと、コマごとの吹き出し検出をN個のスレッドで並列に処理する")
+    parser.add_argument("--concurrency", default=None, metavar="SPEC",
+                        help="コアの配分: W（ワーカー数、OpenCVのスレッドは残りのコア）/ "
+                             "WxC（ワーカー数 x OpenCVのスレッド数）/ auto（サンプル画像で測って選ぶ）。"
+                             "指定時は --workers より優先")
+    parser.add_argument("--prefetch", type=int, default=0, metavar="K",
+                        help="処理中の画像の次のK枚をバックグラウンドのスレッドで読み込む")
+    parser.add_argument("--writers", type=int, default=2, metavar="N",
+                        help="コマ・吹き出し画像をN個のスレッドで検出と並行して保存する（0: 検出処理の中で保存）")
+    parser.add_argument("--crop-format", default="png", metavar="FORMAT",
+                        help="コマ・吹き出し画像の保存形式: png（既定）/ png:0〜9（圧縮レベル）/ "
+                             "webp（可逆）/ npy（無圧縮）/ mask（1ビットのアルファと元ページ上のbbox）")
+    parser.add_argument("--shards", nargs="?", type=int, const=256, default=None, metavar="MAX_MB",
+                        help="コマ・吹き出し画像を個別のファイルではなく、MAX_MB（省略時256）MBまでの "
+                             "tar シャードにまとめて shards/ に保存する（前回のシャードは削除）")
+    parser.add_argument("--balloon-atlas", action="store_true",
+                        help="吹き出し画像を1つずつではなく、ページごとに1枚のアトラス画像と"
+                             "矩形・bboxの JSON にまとめて保存する")
+    parser.add_argument("--transport", choices=["pickle", "shm"], default="pickle",
+                        help="ワーカーからのページ・切り出し画像の受け渡し方法 "
+                             "(shm: 共有メモリのリングバッファ)")
+    return parser.parse_args(argv)
 
 
 def main():
-    if len(sys.argv) != 3:
-        print("Usage: python manga_processor.py <input_folder> <output_folder>")
+    args = parse_args()
+    
+    if not os.path.exists(args.input_folder):
+        print(f"Error: Input folder '{args.input_folder}' does not exist.")
         sys.exit(1)
     
-    input_folder = sys.argv[1]
-    output_folder = sys.argv[2]
+    config = {
+        "input_folder": args.input_folder,
+        "output_folder": args.output_folder,
+        "page_level_balloons": args.page_balloons,
+        "pyramid_height": args.pyramid,
+        "frame_engine": args.frame_engine,
+        "debug_copies": args.debug_copies,
+        "threads": args.threads,
+        "transport": args.transport,
+        "prefetch": args.prefetch,
+        "writers": args.writers,
+        "crop_format": args.crop_format,
+        "shard_bytes": args.shards * 2 ** 20 if args.shards else None,
+        "balloon_atlas": args.balloon_atlas,
+    }
     
-    if not os.path.exists(input_folder):
-        print(f"Error: Input folder '{input_folder}' does not exist.")
+    # コアをワーカーとOpenCVのスレッドに配分
+    cores = available_cores()
+    try:
+        if CropFormat.parse(args.crop_format).kind == "mask" and args.balloon_atlas:
+            raise ValueError("--balloon-atlas cannot be used with --crop-format mask")
+        if args.concurrency == "auto":
+            budget = auto_budget(config, cores, args.threads)
+        elif args.concurrency is not None:
+            budget = parse_budget(args.concurrency, cores, args.threads)
+        else:
+            budget = split_budget(cores, args.workers, args.threads)
+    except ValueError as e:
+        print(f"Error: {e}")
         sys.exit(1)
+    print(f"Concurrency: {budget} ({cores} cores)")
     
-    processor = MangaProcessor(input_folder, output_folder)
+    processor = MangaProcessor(**config, workers=budget.workers, cv_threads=budget.cv_threads)
+    if processor.shard_bytes:
+        remove_shards(processor.shards_dir)
+    start = time.perf_counter()
     panels, balloons = processor.process_images()
+    elapsed = time.perf_counter() - start
+    pages = sum(processor.frame_engine_stats.values())
+    print(f"Throughput: {pages / elapsed if elapsed > 0 else 0.0:.2f} pages/s ({budget})")
+    
+    if args.scaling_report:
+        scaling_report(processor.worker_config(), budget.workers, cores)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,127 @@
+"""
+page_context.py
+===============
+
+1ページ分の前処理結果（グレースケール、ガウシアン、各種二値化、輪郭など）を
+初回使用時に計算して保持し、ページ分類・フレーム検出・吹き出し検出の各処理で
+共有するためのコンテキスト
+
+保持する配列は書き込み禁止にして渡すため、各処理で書き換えが必要な場合は
+writable_copy() で明示的にコピーする（ページ全体のコピーは page_copies に記録）。
+計算回数と要求回数を記録し、処理間で共有できた OpenCV呼び出し・配列確保の数を
+確認できる。
+"""
+
+from collections import Counter
+from typing import Any, Callable, Dict, Union
+
+import cv2
+import numpy as np
+
+
+def readonly(arr: np.ndarray) -> np.ndarray:
+    """書き込み禁止のビューを返す（元の配列はそのまま）"""
+    view = arr.view()
+    view.flags.writeable = False
+    return view
+
+
+class PageContext:
+    """1ページ分の前処理結果を遅延計算して共有するクラス"""
+
+    def __init__(self, page: np.ndarray):
+        self.page = readonly(page)
+        self._cache: Dict[str, Any] = {}
+        self.requests: Counter = Counter()      # 中間結果ごとの要求回数
+        self.computed: Counter = Counter()      # 中間結果ごとの計算回数
+        self.allocated_bytes = 0                # 計算で確保した配列の合計サイズ
+        self.page_copies: Counter = Counter()   # 用途ごとのページ全体のコピー回数
+
+    @classmethod
+    def of(cls, page: Union[np.ndarray, "PageContext"]) -> "PageContext":
+        """ndarray ならコンテキストを作成し、コンテキストならそのまま返す"""
+        if isinstance(page, cls):
+            return page
+        return cls(page)
+
+    @property
+    def shape(self):
+        return self.page.shape
+
+    def cached(self, key: str, compute: Callable[[], Any]) -> Any:
+        """
+        key の中間結果を返す（未計算なら compute() で計算して保持）
+        配列は書き込み禁止にして保持する
+        """
+        self.requests[key] += 1
+        if key not in self._cache:
+            value = compute()
+            self.computed[key] += 1
+            if isinstance(value, np.ndarray):
+                if not np.may_share_memory(value, self.page):
+                    self.allocated_bytes += value.nbytes
+                value = readonly(value)
+            self._cache[key] = value
+        return self._cache[key]
+
+    def writable_copy(self, arr: np.ndarray, label: str) -> np.ndarray:
+        """
+        書き換え用のコピーを作成する
+        ページと同じ大きさの配列なら、用途 label ごとにページ全体のコピーとして記録する
+        """
+        if arr.shape[:2] == self.page.shape[:2]:
+            self.page_copies[label] += 1
+        return arr.copy()
+
+    # ------------------------------------------------------------------
+    # 共通の中間結果
+    # ------------------------------------------------------------------
+    @property
+    def gray(self) -> np.ndarray:
+        """グレースケール画像"""
+        def compute():
+            if self.page.ndim == 2:
+                return self.page
+            if self.page.shape[2] == 4:
+                return cv2.cvtColor(self.page, cv2.COLOR_BGRA2GRAY)
+            return cv2.cvtColor(self.page, cv2.COLOR_BGR2GRAY)
+        return self.cached("gray", compute)
+
+    @property
+    def gaussian(self) -> np.ndarray:
+        """ガウシアンフィルタ(3x3)後の画像"""
+        return self.cached("gaussian", lambda: cv2.GaussianBlur(self.gray, (3, 3), 0))
+
+    @property
+    def otsu_inverse(self) -> np.ndarray:
+        """ガウシアン画像を階調反転して大津の手法で二値化した画像（コマ存在領域の特定用）"""
+        return self.cached("otsu_inverse", lambda: cv2.threshold(
+            cv2.bitwise_not(self.gaussian), 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1])
+
+    @property
+    def bin_230(self) -> np.ndarray:
+        """閾値230の二値画像"""
+        return self.cached("bin_230", lambda: cv2.threshold(self.gray, 230, 255, cv2.THRESH_BINARY)[1])
+
+    @property
+    def balloon_bin(self) -> np.ndarray:
+        """吹き出し検出用の二値画像（bin_230 を3x3で収縮・膨張）"""
+        def compute():
+            kernel = np.ones((3, 3), np.uint8)
+            return cv2.dilate(cv2.erode(self.bin_230, kernel, iterations=1), kernel, iterations=1)
+        return self.cached("balloon_bin", compute)
+
+    @property
+    def balloon_contours(self):
+        """吹き出し検出用二値画像の輪郭と階層（RETR_TREE, CHAIN_APPROX_NONE）"""
+        return self.cached("balloon_contours", lambda: cv2.findContours(
+            self.balloon_bin, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE))
+
+    def stats(self) -> Dict[str, Any]:
+        """中間結果の要求回数・計算回数と確保した配列サイズ"""
+        return {
+            "requests": sum(self.requests.values()),
+            "computed": sum(self.computed.values()),
+            "allocated_bytes": self.allocated_bytes,
+            "page_copies": sum(self.page_copies.values()),
+        }
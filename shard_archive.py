@@ -0,0 +1,210 @@
+"""
+shard_archive.py
+================
+
+コマ・吹き出しの切り出し画像を、1ファイルずつではなく大きさの上限つきの tar（シャード）に
+まとめて書き込み、展開せずにキーで読み出すためのモジュール
+
+シャードは <prefix>-00000.tar, <prefix>-00001.tar, ... の順に作成し、上限 max_bytes を
+超える前に次のシャードに切り替える（閉じたときの終端と切り上げも含めて上限以下にする）。メンバー名は出力フォルダからの相対パス
+（panels/000_0_0.png, balloons/000_0_0_0.png など）で、拡張子を除いた名前（000_0_0 など）を
+キーとする（キーが重なるメンバーはメンバー名で読み出す）。メンバーを追加するごとに、データの位置を1行のJSONとしてシャードごとの
+索引 <シャード名>.idx に追記する（異常終了しても書き込み済みのメンバーは読み出せる）。
+ShardReader は索引だけを読み込み、キーから該当シャードの位置を seek して読み出す。
+
+既存のシャードは上書きせず、同じ prefix の続きの番号から作成する。同じキーが複数の
+シャードにある場合は、索引の更新が新しいものを読み出す（remove_shards() で前回の出力を削除できる）。
+プロセスごとに別の prefix を使えば、複数のプロセスが同じフォルダに書き込める。
+"""
+
+import io
+import json
+import tarfile
+import threading
+import time
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterator, Optional, Tuple, Union
+
+import numpy as np
+
+from crop_writer import decode_crop_bytes
+
+PathLike = Union[str, Path]
+
+SHARD_INDEX_SUFFIX = ".idx"
+
+
+def shard_key(name: str) -> str:
+    """メンバー名から拡張子とフォルダを除いたキー（panels/000_0_0.png -> 000_0_0）"""
+    return Path(name).stem
+
+
+def remove_shards(shard_dir: PathLike) -> int:
+    """shard_dir のシャードと索引を削除し、削除したシャード数を返す"""
+    shard_dir = Path(shard_dir)
+    if not shard_dir.is_dir():
+        return 0
+    removed = 0
+    for path in shard_dir.glob("*.tar"):
+        path.unlink()
+        removed += 1
+    for path in shard_dir.glob(f"*.tar{SHARD_INDEX_SUFFIX}"):
+        path.unlink()
+    return removed
+
+
+class ShardWriter:
+    """切り出し画像を大きさの上限つきの tar シャードに追記するクラス（スレッドセーフ）"""
+
+    def __init__(self, shard_dir: PathLike, prefix: str = "crops", max_bytes: int = 256 * 2 ** 20,
+                 base: Optional[PathLike] = None):
+        self.shard_dir = Path(shard_dir)
+        self.shard_dir.mkdir(parents=True, exist_ok=True)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.base = Path(base) if base is not None else None   # メンバー名をこのフォルダからの相対パスにする
+        self._lock = threading.Lock()
+        # 既存のシャードの続きの番号から作成する
+        numbers = [int(p.stem[len(prefix) + 1:]) for p in self.shard_dir.glob(f"{prefix}-*.tar")
+                   if p.stem[len(prefix) + 1:].isdigit()]
+        self._shard_no = max(numbers, default=-1)
+        self._file: Optional[BinaryIO] = None
+        self._tar: Optional[tarfile.TarFile] = None
+        self._index = None
+        self._members = 0
+        self.shards = 0     # 作成したシャード数
+        self.members = 0    # 書き込んだメンバー数
+
+    def _member_name(self, path: PathLike) -> str:
+        path = Path(path)
+        if self.base is not None and path.is_absolute() == self.base.is_absolute():
+            try:
+                path = path.relative_to(self.base)
+            except ValueError:
+                pass
+        return path.as_posix()
+
+    def _roll(self) -> None:
+        """現在のシャードを閉じて次のシャードを開く"""
+        self._close_shard()
+        self._shard_no += 1
+        path = self.shard_dir / f"{self.prefix}-{self._shard_no:05d}.tar"
+        self._file = open(path, "wb")
+        self._tar = tarfile.open(fileobj=self._file, mode="w", format=tarfile.PAX_FORMAT)
+        self._index = open(str(path) + SHARD_INDEX_SUFFIX, "w", encoding="utf-8")
+        self._members = 0
+        self.shards += 1
+
+    def _closed_size(self, info: tarfile.TarInfo) -> int:
+        """info のメンバーを追記してから閉じた場合のシャードの大きさ"""
+        # ヘッダ（長い名前や非ASCIIの名前は拡張ヘッダを含む）とデータ（512バイト単位に切り上げ）
+        header = len(info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors))
+        size = self._file.tell() + header + -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        # 終端の2ブロックを書き、全体を RECORDSIZE 単位に切り上げる
+        size += 2 * tarfile.BLOCKSIZE
+        return -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+    def _close_shard(self) -> None:
+        if self._tar is None:
+            return
+        self._tar.close()
+        self._file.close()
+        self._index.close()
+        self._tar = self._file = self._index = None
+
+    def add(self, path: PathLike, data: bytes) -> None:
+        """
+        path（出力フォルダ内のファイルパス）をメンバー名として data を追記する
+        追記後に閉じたときの大きさ（終端とレコード単位の切り上げを含む）が max_bytes を超える場合は
+        次のシャードに書き込む（1つのメンバーだけで超える場合は、そのメンバーだけのシャードになる）
+        """
+        name = self._member_name(path)
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        with self._lock:
+            if self._tar is None or (self._members > 0 and self._closed_size(info) > self.max_bytes):
+                self._roll()
+            self._tar.addfile(info, io.BytesIO(data))
+            self._file.flush()
+            # データはヘッダの直後に置かれ、512バイト単位に切り上げて書き込まれる
+            offset = self._tar.offset - -(-len(data) // 512) * 512
+            self._index.write(json.dumps({"key": shard_key(name), "name": name,
+                                          "offset": offset, "size": len(data)}) + "\n")
+            self._index.flush()
+            self._members += 1
+            self.members += 1
+
+    def close(self) -> None:
+        """現在のシャードを閉じる（tar の終端を書き込む）"""
+        with self._lock:
+            self._close_shard()
+
+    def __enter__(self) -> "ShardWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class ShardReader:
+    """シャードの索引を読み込み、キーで切り出し画像を読み出すクラス"""
+
+    def __init__(self, shard_dir: PathLike):
+        self.shard_dir = Path(shard_dir)
+        # メンバー名 -> (シャードのパス, データの位置, 大きさ) と、キー -> メンバー名
+        self._entries: Dict[str, Tuple[Path, int, int]] = {}
+        self._names: Dict[str, str] = {}
+        self._files: Dict[Path, BinaryIO] = {}
+        self._lock = threading.Lock()
+        # 更新の古い索引から読み、同じキーは新しい方で上書きする
+        index_paths = sorted(self.shard_dir.glob(f"*.tar{SHARD_INDEX_SUFFIX}"),
+                             key=lambda p: (p.stat().st_mtime_ns, p.name))
+        for index_path in index_paths:
+            shard_path = index_path.with_name(index_path.name[:-len(SHARD_INDEX_SUFFIX)])
+            with open(index_path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.endswith("\n"):
+                        break   # 書き込み途中で終了した行
+                    entry = json.loads(line)
+                    self._entries[entry["name"]] = (shard_path, entry["offset"], entry["size"])
+                    self._names[entry["key"]] = entry["name"]
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._names)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries or key in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def name(self, key: str) -> str:
+        """キー（000_0_0 など）またはメンバー名のメンバー名（panels/000_0_0.png など）"""
+        return key if key in self._entries else self._names[key]
+
+    def read_bytes(self, key: str) -> bytes:
+        """キー（000_0_0 など）またはメンバー名のデータを読み出す"""
+        shard_path, offset, size = self._entries[self.name(key)]
+        with self._lock:
+            f = self._files.get(shard_path)
+            if f is None:
+                f = self._files[shard_path] = open(shard_path, "rb")
+            f.seek(offset)
+            return f.read(size)
+
+    def read(self, key: str, load_page: Optional[Callable[[str, int], np.ndarray]] = None) -> np.ndarray:
+        """キーの切り出し画像をBGRA画像として読み出す（mask 形式は load_page で元ページから復元）"""
+        return decode_crop_bytes(self.read_bytes(key), Path(self.name(key)).suffix, load_page)
+
+    def close(self) -> None:
+        with self._lock:
+            for f in self._files.values():
+                f.close()
+            self._files.clear()
+
+    def __enter__(self) -> "ShardReader":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
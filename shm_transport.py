@@ -0,0 +1,125 @@
+"""
+shm_transport.py
+================
+
+プロセス間でページ画像・切り出し画像を受け渡すための共有メモリのリングバッファ
+
+送り側は配列をリングに書き込み、(オフセット, shape, dtype) のハンドル ShmHandle だけを
+pickle して送る。受け取り側はハンドルから配列をコピーして取り出し、その範囲を解放する。
+1つのリングの書き込みは1プロセス、読み出しは1プロセス（書き込んだ順に解放）とする。
+リングに空きがない場合、put() は None を返すので送り側は配列をそのまま pickle して送る。
+
+セグメントの寿命の規則:
+- セグメントは受け取り側（親プロセス）が ShmRing.create() で作成し、close() で unlink する。
+  with 文か try/finally で必ず close() する
+- 送り側（ワーカー）は ShmRing.attach() で接続するだけで unlink しない。
+  ワーカーが異常終了しても親の close() で unlink される
+- 親が異常終了した場合は、multiprocessing の resource_tracker が作成済みのセグメントを unlink する
+- receive() は配列をコピーしてから解放するので、受け取った配列がリングを参照し続けることはない
+"""
+
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+HEADER_BYTES = 64   # 先頭に書き込み位置・解放位置（int64）を置く
+ALIGN = 64
+
+
+@dataclass(frozen=True)
+class ShmHandle:
+    """リング上の配列の位置（end は書き込み位置の通算値で、解放に使う）"""
+    name: str
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: str
+    end: int
+
+
+class ShmRing:
+    """1プロセスが書き込み、1プロセスが読み出す共有メモリのリングバッファ"""
+
+    def __init__(self, shm: shared_memory.SharedMemory, owner: bool):
+        self._shm = shm
+        self.name = shm.name
+        self.owner = owner
+        # [0]: 書き込み位置, [1]: 解放位置（どちらもリング先頭からの通算バイト数）
+        self._positions = np.ndarray((2,), dtype=np.int64, buffer=shm.buf)
+        self.capacity = shm.size - HEADER_BYTES
+        self.fallbacks = 0   # 空きがなく put() できなかった回数
+
+    @classmethod
+    def create(cls, capacity: int) -> "ShmRing":
+        """受け取り側でセグメントを作成する（close() で unlink する）"""
+        shm = shared_memory.SharedMemory(create=True, size=capacity + HEADER_BYTES)
+        ring = cls(shm, owner=True)
+        ring._positions[:] = 0
+        return ring
+
+    @classmethod
+    def attach(cls, name: str) -> "ShmRing":
+        """送り側で作成済みのセグメントに接続する（unlink しない）"""
+        return cls(shared_memory.SharedMemory(name=name), owner=False)
+
+    def put(self, arr: np.ndarray) -> Optional[ShmHandle]:
+        """配列を書き込んでハンドルを返す（空きがなければ None）"""
+        nbytes = arr.nbytes
+        size = -(-nbytes // ALIGN) * ALIGN
+        head, tail = (int(v) for v in self._positions)
+        start = head
+        # 末尾に収まらない場合は先頭に戻る（末尾の残りは使わない）
+        if start % self.capacity + size > self.capacity:
+            start += self.capacity - start % self.capacity
+        if size > self.capacity or start + size - tail > self.capacity:
+            self.fallbacks += 1
+            return None
+        offset = HEADER_BYTES + start % self.capacity
+        dst = np.ndarray(arr.shape, dtype=arr.dtype, buffer=self._shm.buf, offset=offset)
+        dst[...] = arr
+        del dst
+        self._positions[0] = start + size
+        return ShmHandle(self.name, offset, tuple(arr.shape), arr.dtype.str, start + size)
+
+    def view(self, handle: ShmHandle) -> np.ndarray:
+        """ハンドルの配列を参照する（解放後は書き換わるので、保持する場合はコピーする）"""
+        return np.ndarray(handle.shape, dtype=np.dtype(handle.dtype),
+                          buffer=self._shm.buf, offset=handle.offset)
+
+    def release(self, handle: ShmHandle) -> None:
+        """handle までの範囲を解放する（書き込んだ順に解放する）"""
+        self._positions[1] = max(int(self._positions[1]), handle.end)
+
+    def close(self) -> None:
+        """接続を閉じる（作成した側ならセグメントを unlink する）"""
+        if self._shm is None:
+            return
+        del self._positions
+        self._shm.close()
+        if self.owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self) -> "ShmRing":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def receive(rings: Dict[str, ShmRing], handles: Iterable[ShmHandle]) -> Dict[ShmHandle, np.ndarray]:
+    """
+    ハンドルの配列をすべてコピーしてから、リングごとに最後のハンドルまでを解放する
+    （先に解放すると、まだコピーしていない範囲を送り側が上書きする可能性がある）
+    """
+    arrays: Dict[ShmHandle, np.ndarray] = {}
+    last: Dict[str, ShmHandle] = {}
+    for handle in handles:
+        if handle not in arrays:
+            arrays[handle] = rings[handle.name].view(handle).copy()
+            if handle.name not in last or handle.end > last[handle.name].end:
+                last[handle.name] = handle
+    for name, handle in last.items():
+        rings[name].release(handle)
+    return arrays
@@ -0,0 +1,120 @@
+"""
+sprite_atlas.py
+===============
+
+1ページ分の吹き出し画像を1枚のアトラス画像にまとめて保存し、切り出して読み出すためのモジュール
+
+吹き出しを高さの順に並べて棚詰め（shelf packing）し、アトラス画像 <画像番号>_<ページ>.atlas.png と、
+キー（000_0_0_0 など、吹き出しのファイル名と同じ）ごとのアトラス上の矩形・吹き出しの bbox を記録した
+JSON <画像番号>_<ページ>.atlas.json を保存する。BalloonAtlas はアトラス画像を1回だけ読み込み、
+各吹き出しをアトラス画像のビューとして返す（吹き出しごとのファイルの読み込みがなくなる）。
+
+JSON の形式:
+{"image": "000_0.atlas.png", "source": 元画像のパス, "page": ページ番号, "size": [幅, 高さ],
+ "balloons": {"000_0_0_0": {"rect": [x, y, w, h],      # アトラス上の矩形
+                            "bbox": [x, y, w, h],      # Balloon.bbox
+                            "page_bbox": [x, y, w, h], # 元ページ上の bbox
+                            "panel": コマ番号}, ...}}
+"""
+
+import json
+import math
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from crop_writer import decode_crop, decode_crop_bytes
+
+PathLike = Union[str, Path]
+
+ATLAS_SUFFIX = ".atlas"
+
+
+def atlas_name(i: int, j: int) -> str:
+    """画像番号 i・ページ j のアトラスのファイル名（拡張子なし）"""
+    return f"{i:03d}_{j}{ATLAS_SUFFIX}"
+
+
+def shelf_pack(sizes: Sequence[Tuple[int, int]],
+               max_width: Optional[int] = None) -> Tuple[List[Tuple[int, int]], Tuple[int, int]]:
+    """
+    (幅, 高さ) の矩形を高い順に左から並べ、幅 max_width を超えたら次の棚（行）に移る
+    max_width を省略した場合は、全体がおおよそ正方形になる幅（最も広い矩形の幅以上）
+    戻り値: (各矩形の左上 (x, y)（sizes の順）, アトラスの (幅, 高さ))
+    """
+    if not sizes:
+        return [], (0, 0)
+    if max_width is None:
+        area = sum(w * h for w, h in sizes)
+        max_width = max(max(w for w, _ in sizes), math.ceil(math.sqrt(area)))
+    positions: List[Tuple[int, int]] = [(0, 0)] * len(sizes)
+    x = y = shelf_height = width = 0
+    for n in sorted(range(len(sizes)), key=lambda n: (-sizes[n][1], -sizes[n][0])):
+        w, h = sizes[n]
+        if x > 0 and x + w > max_width:
+            y += shelf_height
+            x = shelf_height = 0
+        positions[n] = (x, y)
+        x += w
+        shelf_height = max(shelf_height, h)
+        width = max(width, x)
+    return positions, (width, y + shelf_height)
+
+
+def build_atlas(images: Sequence[np.ndarray]) -> Tuple[np.ndarray, List[Tuple[int, int, int, int]]]:
+    """BGRA画像を棚詰めした透明なアトラスと、各画像の矩形 (x, y, w, h) を返す"""
+    positions, (width, height) = shelf_pack([(image.shape[1], image.shape[0]) for image in images])
+    atlas = np.zeros((height, width, 4), dtype=np.uint8)
+    rects = []
+    for (x, y), image in zip(positions, images):
+        h, w = image.shape[:2]
+        atlas[y:y + h, x:x + w] = image
+        rects.append((x, y, w, h))
+    return atlas, rects
+
+
+class BalloonAtlas:
+    """1ページ分の吹き出しのアトラス（crop() はアトラス画像のビューを返す）"""
+
+    def __init__(self, image: np.ndarray, meta: Dict[str, Any]):
+        self.image = image
+        self.meta = meta
+        self.entries: Dict[str, Dict[str, Any]] = meta["balloons"]
+
+    @classmethod
+    def load(cls, json_path: PathLike) -> "BalloonAtlas":
+        """JSON と、同じフォルダのアトラス画像を読み込む"""
+        json_path = Path(json_path)
+        meta = json.loads(json_path.read_text(encoding="utf-8"))
+        return cls(decode_crop(json_path.with_name(meta["image"])), meta)
+
+    @classmethod
+    def from_shards(cls, reader, json_name: str) -> "BalloonAtlas":
+        """シャード（shard_archive.ShardReader）のメンバー名 json_name の JSON とアトラス画像を読み込む"""
+        meta = json.loads(reader.read_bytes(json_name).decode("utf-8"))
+        image_name = str(Path(json_name).with_name(meta["image"]).as_posix())
+        return cls(decode_crop_bytes(reader.read_bytes(image_name), Path(image_name).suffix), meta)
+
+    def crop(self, key: str) -> np.ndarray:
+        """キー（000_0_0_0 など）の吹き出し画像（アトラス画像のビュー）"""
+        x, y, w, h = self.entries[key]["rect"]
+        return self.image[y:y + h, x:x + w]
+
+    def bbox(self, key: str) -> Tuple[int, int, int, int]:
+        """キーの吹き出しの Balloon.bbox"""
+        return tuple(self.entries[key]["bbox"])
+
+    def keys(self) -> Iterator[str]:
+        return iter(self.entries)
+
+    def items(self) -> Iterator[Tuple[str, np.ndarray]]:
+        """(キー, 吹き出し画像) をキーの順に返す"""
+        for key in self.entries:
+            yield key, self.crop(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
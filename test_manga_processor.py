@@ -9,8 +9,15 @@ manga_processor.pyのテスト用スクリプト
 
 import cv2
 import numpy as np
+import pytest
 from pathlib import Path
-from manga_processor import MangaProcessor
+from manga_processor import MangaProcessor, Panel, Point, Points
+from benchmark_manga_processor import (
+    make_synthetic_page, make_slanted_quad, legacy_page_type_bands, legacy_frame_area_bounds,
+    frame_area_bounds, legacy_frame_existence_bounds, legacy_create_alpha_image, legacy_false_balloon_counts,
+    make_balloon_image, legacy_speechballoon_detect, make_screentone_panel
+)
+from array_ops import is_black_page_bands, false_balloon_counts, locate_in_bboxes
 
 def test_single_image():
     """単一画像でのテスト"""
@@ -139,10 +146,781 @@ def visualize_detection_steps():
         break  # 最初のページのみ
 
 
+def test_page_type_matches_legacy():
+    """ページ分類の端チェックが旧実装（画素ループ）と一致するか"""
+    rng = np.random.default_rng(0)
+    pages = [
+        make_synthetic_page(),
+        make_synthetic_page(black=True),
+        np.zeros((60, 40), dtype=np.uint8),
+        np.full((60, 40), 255, dtype=np.uint8),
+    ]
+    # 端の帯だけ黒いページ（上下左右それぞれ）
+    for band in [(slice(0, 5), slice(None)), (slice(-5, None), slice(None)),
+                 (slice(None), slice(0, 5)), (slice(None), slice(-5, None))]:
+        page = np.full((60, 40), 255, dtype=np.uint8)
+        page[band] = 0
+        pages.append(page)
+    pages += [(rng.random((30, 20)) > 0.97).astype(np.uint8) * 255 for _ in range(50)]
+
+    for page in pages:
+        assert is_black_page_bands(page) == legacy_page_type_bands(page)
+
+
+def test_projection_profile_matches_legacy():
+    """射影ヒストグラムによる境界検出（端2画素除外・6画素寄せ）が旧実装と一致するか"""
+    rng = np.random.default_rng(1)
+    images = [np.zeros((40, 30), dtype=np.uint8), np.full((40, 30), 255, dtype=np.uint8)]
+    # 端の除外・寄せの境界付近に1画素だけ置いたケース
+    for y, x in [(3, 3), (2, 10), (36, 27), (37, 26), (8, 7), (33, 22), (20, 5), (20, 24)]:
+        img = np.zeros((40, 30), dtype=np.uint8)
+        img[y, x] = 255
+        images.append(img)
+    images += [(rng.random((40, 30)) > 0.995).astype(np.uint8) * 255 for _ in range(50)]
+
+    for img in images:
+        assert frame_area_bounds(img) == legacy_frame_area_bounds(img)
+
+    # frame_separation.FrameDetector は列 0〜2 と末尾3列を全行で除外する（行の端は除外しない）
+    from frame_separation import FrameDetector
+    detector = FrameDetector()
+    for y, x in [(0, 10), (39, 15), (1, 3), (20, 2), (20, 26), (20, 27), (0, 0), (39, 29)]:
+        img = np.zeros((40, 30), dtype=np.uint8)
+        img[y, x] = 255
+        images.append(img)
+    for img in images:
+        detector.find_frame_existence_area(img)
+        corners = detector.page_corners
+        assert (corners.lt[0], corners.rt[0]) == legacy_frame_existence_bounds(img)
+
+
+def test_alpha_image_matches_legacy(tmp_path):
+    """バウンディングボックス内の配列演算による透明化が旧実装（画素ごとの判定）と一致するか"""
+    processor = MangaProcessor("dummy", str(tmp_path))
+    page = make_synthetic_page(120, 90)
+    cases = [make_slanted_quad(page.shape)]
+    # ページ端に寄せた矩形・縦横の辺が一致するケース
+    rect = Points(Point(0, 0), Point(90, 0), Point(0, 60), Point(90, 60))
+    cases.append((rect, (0, 0, 90, 60)))
+    cases.append((Points(Point(10, 5), Point(50, 20), Point(10, 70), Point(50, 70)), (10, 5, 40, 65)))
+
+    for corners, bbox in cases:
+        x, y, w, h = bbox
+        expected = legacy_create_alpha_image(page, corners)
+        assert np.array_equal(processor.create_alpha_image(page, corners, bbox), expected[y:y+h, x:x+w])
+        assert np.array_equal(processor.create_alpha_image(page, corners), expected)
+
+
+def test_false_balloon_counts_match_legacy():
+    """誤検出除去の黒画素カウントが旧実装（画素ループ）と一致するか"""
+    balloons = [make_balloon_image(h, w, seed) for seed, (h, w) in
+                enumerate([(40, 50), (25, 30), (12, 14), (8, 20), (3, 3), (60, 35)])]
+    # 全面不透明・黒画素を多く含むもの
+    opaque = make_balloon_image(30, 30, 10)
+    opaque[:, :, 3] = 255
+    balloons.append(opaque)
+
+    for balloon in balloons:
+        for diagonal in (False, True):
+            assert (false_balloon_counts(balloon, 5, diagonal)
+                    == legacy_false_balloon_counts(balloon, 5, diagonal))
+
+
+def test_speechballoon_detect_matches_legacy(tmp_path):
+    """吹き出し検出の一括特徴量・絞り込みが旧実装と同じ吹き出しを返すか"""
+    processor = MangaProcessor("dummy", str(tmp_path))
+    panels = [panel.image for panel in processor.frame_detect(make_synthetic_page())]
+    panels.append(make_screentone_panel(300, 260))
+    panels.append(cv2.cvtColor(make_synthetic_page(400, 300), cv2.COLOR_GRAY2BGR))
+
+    for panel in panels:
+        # 輪郭の取得順（RETR_LIST / RETR_TREE）が異なるため位置順で比較
+        expected = sorted(legacy_speechballoon_detect(panel), key=lambda b: b.bbox)
+        balloons = sorted(processor.speechballoon_detect(panel), key=lambda b: b.bbox)
+        assert len(balloons) == len(expected)
+        for balloon, legacy in zip(balloons, expected):
+            assert balloon.bbox == legacy.bbox
+            assert balloon.center == legacy.center
+            assert balloon.area == legacy.area
+            assert balloon.circularity == legacy.circularity
+            assert balloon.type == legacy.type
+            assert balloon.bw_ratio == legacy.bw_ratio
+            assert np.array_equal(balloon.contour, legacy.contour)
+            assert np.array_equal(balloon.image, legacy.image)
+
+    # 最大数を超えた時点で打ち切る
+    screentone = make_screentone_panel(300, 260)
+    assert len(legacy_speechballoon_detect(screentone)) >= 1
+    assert len(processor.speechballoon_detect(screentone, max_balloons=0)) == 1
+
+
+def test_speechballoon_prunes_nested_outlines(tmp_path):
+    """二重線の吹き出しで、穴の輪郭と重複した外側の輪郭が候補から除外されるか"""
+    gray = np.full((300, 260), 255, dtype=np.uint8)
+    gray[:40, :] = 0
+    for axes in [(100, 70), (92, 62)]:
+        cv2.ellipse(gray, (130, 150), axes, 0, 0, 360, 0, 2)
+    for row in range(-30, 30, 15):
+        cv2.line(gray, (90, 150 + row), (170, 150 + row), 0, 3)
+    panel = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA)
+
+    processor = MangaProcessor("dummy", str(tmp_path))
+    balloons = processor.speechballoon_detect(panel)
+
+    # 旧実装は同じ吹き出しを3重に検出していた
+    assert len(legacy_speechballoon_detect(panel)) == 3
+    assert [b.bbox for b in balloons] == [(40, 90, 181, 121)]
+    # 穴の輪郭は白黒比率の判定の前に除外し、重複は判定を通った候補の中だけで判定する
+    assert processor.balloon_prune_stats == {"candidates": 5, "hole": 2, "duplicate": 1}
+    
+    # 内側の輪郭の角に黒い塗りがあり内側だけが白黒比率で除外される場合は、外側の輪郭が残る
+    for x, y in [(48, 98), (212, 98), (48, 202), (212, 202)]:
+        cv2.circle(gray, (x, y), 9, 0, -1)
+    processor = MangaProcessor("dummy", str(tmp_path))
+    balloons = processor.speechballoon_detect(cv2.cvtColor(gray, cv2.COLOR_GRAY2BGRA))
+    assert [b.bbox for b in balloons] == [(32, 82, 197, 137)]
+
+
+def test_page_level_balloons_match_panel_detection(tmp_path):
+    """ページ単位の吹き出し検出が、コマ内に収まる吹き出しについてコマ単位の検出と一致するか"""
+    processor = MangaProcessor("dummy", str(tmp_path))
+    page = make_synthetic_page()
+    panels = processor.frame_detect(page)
+    page_balloons = processor.speechballoon_detect_page(page, panels)
+
+    assert len(page_balloons) == len(panels)
+    for panel, balloons in zip(panels, page_balloons):
+        expected = processor.speechballoon_detect(panel.image)
+        assert [b.bbox for b in balloons] == [b.bbox for b in expected]
+        for balloon, legacy in zip(balloons, expected):
+            assert balloon.center == legacy.center
+            assert np.array_equal(balloon.contour, legacy.contour)
+            assert np.array_equal(balloon.image, legacy.image)
+
+
+def test_page_level_balloon_crossing_panel_border(tmp_path):
+    """コマの境界をまたぐ吹き出しが、切れずに中心を含むコマへ1つだけ割り当てられるか"""
+    page = np.full((800, 600), 255, dtype=np.uint8)
+    boxes = [(40, 40, 520, 340), (40, 400, 520, 360)]
+    for x, y, w, h in boxes:
+        cv2.rectangle(page, (x, y), (x + w, y + h), 0, 2)
+    cv2.ellipse(page, (300, 375), (120, 60), 0, 0, 360, 255, -1)
+    cv2.ellipse(page, (300, 375), (120, 60), 0, 0, 360, 0, 2)
+
+    processor = MangaProcessor("dummy", str(tmp_path))
+    panels = []
+    for k, (x, y, w, h) in enumerate(boxes):
+        corners = Points(Point(x, y), Point(x + w, y), Point(x, y + h), Point(x + w, y + h))
+        panels.append(Panel(processor.create_alpha_image(page, corners, (x, y, w, h)),
+                            (x, y, w, h), corners, 0, k))
+
+    # コマ単位では下端で切れる
+    assert [b.bbox for b in processor.speechballoon_detect(panels[0].image)] == [(142, 277, 237, 63)]
+    page_balloons = processor.speechballoon_detect_page(page, panels)
+    assert [[b.bbox for b in balloons] for balloons in page_balloons] == [[(142, 277, 237, 117)], []]
+
+
+def test_locate_in_bboxes():
+    """点を含む最小のバウンディングボックスが選ばれるか"""
+    bboxes = np.array([[0, 0, 100, 100], [10, 10, 20, 20], [200, 0, 50, 50]])
+    owners = locate_in_bboxes(bboxes, np.array([15, 50, 220, 300, 0]), np.array([15, 50, 10, 300, 99]))
+    assert owners.tolist() == [1, 0, 2, -1, 0]
+
+
+def test_page_context_shares_preprocessing(tmp_path):
+    """PageContext を共有しても結果は同じで、各中間結果は1回だけ計算される"""
+    from page_context import PageContext
+    processor = MangaProcessor("dummy", str(tmp_path))
+    page = make_synthetic_page()
+    
+    panels = processor.frame_detect(page)
+    balloons = processor.speechballoon_detect_page(page, panels)
+    
+    ctx = PageContext(page)
+    assert processor.get_page_type(ctx) == processor.get_page_type(page)
+    shared_panels = processor.frame_detect(ctx)
+    shared_balloons = processor.speechballoon_detect_page(ctx, shared_panels)
+    
+    assert [p.bbox for p in shared_panels] == [p.bbox for p in panels]
+    assert all(np.array_equal(a.image, b.image) for a, b in zip(shared_panels, panels))
+    assert [[b.bbox for b in bs] for bs in shared_balloons] == [[b.bbox for b in bs] for bs in balloons]
+    assert set(ctx.computed.values()) == {1}
+    assert ctx.requests["balloon_contours"] >= 2
+    assert not ctx.gray.flags.writeable
+
+
+def test_pyramid_frame_detect_matches_full_resolution(tmp_path):
+    """高解像度ページでは縮小画像で検出しても原寸処理と同じコマ四隅が得られる"""
+    from benchmark_manga_processor import upscale_page, quad_agreement
+    page = make_synthetic_page()
+    big = upscale_page(page, 3)
+    
+    for engine in ("hough", "auto"):
+        processor = MangaProcessor("dummy", str(tmp_path), frame_engine=engine)
+        full = processor.frame_detect(big)
+        pyramid = processor.frame_detect(big, pyramid_height=page.shape[0])
+        
+        assert [p.bbox for p in pyramid] == [p.bbox for p in full]
+        agreement = quad_agreement(full, pyramid)
+        assert agreement["matched"] == len(full) == 3
+        assert agreement["max_corner_dev"] <= 3
+    # 作業解像度以下のページは原寸処理のまま
+    assert [p.bbox for p in processor.frame_detect(page, pyramid_height=2000)] == \
+        [p.bbox for p in processor.frame_detect(page)]
+
+
+def test_hough_line_evidence_matches_legacy_panels(tmp_path):
+    """直線証拠画像を1回のHough変換に置き換えても両方の検出器のコマは変わらない"""
+    from unittest import mock
+    import frame_separation
+    import manga_processor
+    from array_ops import clip_hough_lines, suppress_hough_peaks
+    from benchmark_manga_processor import (
+        legacy_manga_line_evidence, legacy_separation_line_evidence, quad_agreement
+    )
+    page = make_synthetic_page()
+    processor = MangaProcessor("dummy", str(tmp_path), frame_engine="hough")
+    detector = frame_separation.FrameDetector()
+    
+    with mock.patch.object(manga_processor, "hough_line_evidence", legacy_manga_line_evidence):
+        legacy = processor.frame_detect(page)
+    assert quad_agreement(legacy, processor.frame_detect(page))["max_corner_dev"] == 0
+    assert [p.bbox for p in processor.frame_detect(page)] == [p.bbox for p in legacy]
+    
+    # 旧実装の直線は垂線の足から±2000画素で、それより大きいページでは途中で切れて
+    # 下段のコマが短く検出されていた。新実装はページ全体を横切る直線で、コマ枠の下端まで検出する
+    large = make_synthetic_page(3000, 2100)
+    bottom = 3000 - int(2100 * 0.06)
+    with mock.patch.object(manga_processor, "hough_line_evidence", legacy_manga_line_evidence):
+        legacy = processor.frame_detect(large)
+    lower = [p.bbox for p in processor.frame_detect(large) if p.bbox[1] > 3000 * 0.4]
+    assert len(lower) == 2 and all(abs(y + h - bottom) <= 3 for _, y, _, h in lower)
+    assert all(y + h < bottom - 500 for _, y, _, h in (p.bbox for p in legacy) if y > 3000 * 0.4)
+    
+    with mock.patch.object(frame_separation, "hough_line_evidence", legacy_separation_line_evidence):
+        legacy = detector.detect_panels(page)
+    assert [d.bbox for d in detector.detect_panels(page)] == [d.bbox for d in legacy]
+    
+    # 重複ピーク（theta = 0 と pi をまたぐものを含む）の間引きとページ内への切り取り
+    lines = np.array([[10, 0.0], [11, 0.01], [-10, np.pi - 0.005], [50, 1.0]])
+    assert suppress_hough_peaks(lines).tolist() == [[10.0, 0.0], [50.0, 1.0]]
+    segments = clip_hough_lines(np.array([[10, 0.0], [10, np.pi / 2], [-5, np.pi / 4]]), 100, 60)
+    assert segments.tolist() == [[[10, 0], [10, 59]], [[99, 10], [0, 10]]]
+
+
+def test_xy_cut_fast_path_and_fallback(tmp_path):
+    """格子状のページはXYカットでHoughと同じコマを検出し、斜めの区切りや傾いた枠ではHoughに切り替わる"""
+    from benchmark_manga_processor import make_skewed_grid_page, make_slanted_page
+    hough = MangaProcessor("dummy", str(tmp_path), frame_engine="hough")
+    auto = MangaProcessor("dummy", str(tmp_path))
+    
+    def summary(panels):
+        return [(p.bbox, p.panel_idx, p.corners) for p in panels]
+    
+    page = make_synthetic_page()
+    expected = hough.frame_detect(page)
+    panels = auto.frame_detect(page)
+    assert auto.last_frame_engine == "xycut"
+    assert summary(panels) == summary(expected)
+    assert all(np.array_equal(p.image, q.image) for p, q in zip(panels, expected))
+    
+    slanted = make_slanted_page()
+    panels = auto.frame_detect(slanted)
+    assert auto.last_frame_engine == "hough"
+    assert summary(panels) == summary(hough.frame_detect(slanted))
+    
+    # 区切りは白いが枠が6〜8画素傾いたページは矩形のコマにせずHoughで検出する
+    for skew in (6, 8):
+        skewed = make_skewed_grid_page(skew=skew)
+        panels = auto.frame_detect(skewed)
+        assert auto.last_frame_engine == "hough"
+        expected = hough.frame_detect(skewed)
+        assert summary(panels) == summary(expected)
+        assert all(np.array_equal(p.image, q.image) for p, q in zip(panels, expected))
+    assert auto.frame_engine_stats == {"xycut": 1, "hough": 3, "blackpage": 0}
+
+
+def test_black_page_frame_detect(tmp_path):
+    """黒ページも白ページと同じ配置のコマとして検出される"""
+    from benchmark_manga_processor import make_flashback_page
+    processor = MangaProcessor("dummy", str(tmp_path))
+    expected = [p.bbox for p in processor.frame_detect(make_synthetic_page())]
+    
+    black = make_synthetic_page(black=True)
+    assert processor.get_page_type(black)
+    assert [p.bbox for p in processor.black_page_frame_detect(black)] == expected
+    
+    flashback = make_flashback_page()
+    assert processor.get_page_type(flashback)
+    panels = processor.black_page_frame_detect(flashback)
+    assert len(panels) == len(expected)
+    for panel, (x, y, w, h) in zip(panels, expected):
+        assert np.abs(np.array(panel.bbox) - (x + 1, y + 1, w - 2, h - 2)).max() <= 1
+    assert processor.frame_engine_stats["blackpage"] == 2
+
+
+def test_buffer_pool_reuses_reset_canvases(tmp_path):
+    """同じ大きさのページでは作業用配列が使い回され、返却時に0で初期化される"""
+    from buffer_pool import BufferPool
+    pool = BufferPool()
+    with pool.lease((4, 5), 4) as buf:
+        buf[:] = 7
+    again = pool.borrow((4, 5), 4)
+    assert again is buf and not again.any()
+    assert pool.borrow((4, 5)).shape == (4, 5)
+    assert pool.stats()["allocations"] == 2 and pool.hits == 1
+    
+    # プールを使っても検出結果は同じで、2ページ目以降は新たに確保しない
+    processor = MangaProcessor("dummy", str(tmp_path), frame_engine="hough")
+    page = make_synthetic_page()
+    first = processor.frame_detect(page)
+    allocations = processor.buffer_pool.allocations
+    second = processor.frame_detect(page)
+    assert processor.buffer_pool.allocations == allocations
+    assert [p.bbox for p in second] == [p.bbox for p in first]
+
+
+def test_page_pipeline_copies_only_balloon_fill(tmp_path):
+    """ページは書き込み禁止のまま各処理に渡り、ページ全体のコピーは吹き出し塗りつぶし用の1回だけ"""
+    import frame_separation
+    from page_context import PageContext
+    processor = MangaProcessor("dummy", str(tmp_path), frame_engine="hough")
+    page = make_synthetic_page()
+    original = page.copy()
+    
+    ctx = PageContext(page)
+    assert not processor.get_page_type(ctx)
+    panels = processor.frame_detect(ctx)
+    processor.speechballoon_detect_page(ctx, panels)
+    assert dict(ctx.page_copies) == {"balloon_fill": 1}
+    assert not ctx.page.flags.writeable and np.array_equal(page, original)
+    # パイプラインから出るコマ画像は書き換え可能な切り出し
+    assert all(p.image.flags.writeable and p.image.shape[:2] == p.bbox[:1:-1] for p in panels)
+    
+    detector = frame_separation.FrameDetector()
+    detector.detect_panels(page)
+    assert detector.page_copies == 0 and detector.debug_page is None
+
+
+def test_lazy_records_match_materialized_images(tmp_path):
+    """コマ・吹き出しは元ページへの参照から読み出し時に画像を作り、従来の切り出しと一致する"""
+    from array_ops import compress_chain, expand_chain
+    from page_context import PageContext
+    processor = MangaProcessor("dummy", str(tmp_path))
+    page = make_synthetic_page()
+    ctx = PageContext(page)
+    panels = processor.frame_detect(ctx)
+    page_balloons = processor.speechballoon_detect_page(ctx, panels)
+    
+    for panel, owned in zip(panels, page_balloons):
+        assert panel._image is None and panel._bbox.dtype == np.int32
+        expected = processor.create_alpha_image(page, panel.corners, panel.bbox)
+        assert np.array_equal(panel.image, expected)
+        # コマ画像から検出した吹き出しと、ページ参照・コマ座標の吹き出しが一致
+        for balloon, legacy in zip(owned, processor.speechballoon_detect(expected)):
+            assert balloon._image is None and balloon._contour.dtype == np.int16
+            assert balloon.bbox == legacy.bbox
+            assert np.array_equal(balloon.contour, legacy.contour)
+            assert np.array_equal(balloon.image, legacy.image)
+    assert sum(len(owned) for owned in page_balloons) > 0
+    
+    # 輪郭の圧縮は元の点列に戻せる
+    contours, _ = cv2.findContours(ctx.balloon_bin, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    for cnt in contours:
+        compressed = compress_chain(cnt)
+        assert compressed.dtype == np.int16 and len(compressed) <= len(cnt)
+        assert np.array_equal(expand_chain(compressed), cnt)
+
+
+@pytest.fixture
+def spread_input_dir(tmp_path):
+    """見開きの a.jpg と単ページの b.jpg を置いた入力フォルダ"""
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    page = make_synthetic_page()
+    cv2.imwrite(str(input_dir / "a.jpg"), np.hstack([page, page[:, ::-1]]))
+    cv2.imwrite(str(input_dir / "b.jpg"), page)
+    return input_dir
+
+
+def test_process_pool_matches_serial_output(tmp_path, spread_input_dir):
+    """--workers N でも出力ファイル名・画像・集計が1プロセスの場合と同じ"""
+    input_dir = spread_input_dir
+    cv2.imwrite(str(input_dir / "c.jpg"), 255 - make_synthetic_page())
+    
+    results = {}
+    for workers in (1, 2):
+        out = tmp_path / f"out{workers}"
+        processor = MangaProcessor(str(input_dir), str(out), workers=workers, verbose=False)
+        panels, balloons = processor.process_images()
+        files = sorted(p.relative_to(out).as_posix() for p in out.rglob("*.png"))
+        images = [cv2.imread(str(out / f), cv2.IMREAD_UNCHANGED) for f in files]
+        results[workers] = (files, images, [p.bbox for p in panels], [b.panel_idx for b in balloons],
+                            processor.frame_engine_stats, processor.balloon_prune_stats)
+    
+    serial, pooled = results[1], results[2]
+    assert serial[0] and serial[0] == pooled[0]
+    assert all(np.array_equal(a, b) for a, b in zip(serial[1], pooled[1]))
+    assert serial[2:] == pooled[2:]
+
+
+def test_thread_pool_matches_serial_output(tmp_path):
+    """--threads N でもページ・コマ・吹き出しの番号と出力が逐次処理と同じ"""
+    spread = tmp_path / "spread.jpg"
+    page = make_synthetic_page()
+    cv2.imwrite(str(spread), np.hstack([page, page[:, ::-1]]))
+    
+    for page_level in (False, True):
+        results = {}
+        for threads in (1, 4):
+            out = tmp_path / f"out{threads}_{page_level}"
+            processor = MangaProcessor(str(tmp_path), str(out), threads=threads,
+                                       page_level_balloons=page_level, verbose=False)
+            panels, balloons = processor.process_image(7, str(spread))
+            files = sorted(p.relative_to(out).as_posix() for p in out.rglob("*.png"))
+            images = [cv2.imread(str(out / f), cv2.IMREAD_UNCHANGED) for f in files]
+            results[threads] = (files, images,
+                                [(p.page_idx, p.panel_idx, p.bbox) for p in panels],
+                                [(b.panel_idx, b.bbox) for b in balloons],
+                                processor.frame_engine_stats, processor.balloon_prune_stats)
+        
+        serial, threaded = results[1], results[4]
+        assert serial[0] and serial[0] == threaded[0] and serial[0][0].startswith("balloons/007_")
+        assert all(np.array_equal(a, b) for a, b in zip(serial[1], threaded[1]))
+        assert serial[2:] == threaded[2:]
+
+
+def test_thread_budget_splits_cores(tmp_path):
+    """ワーカー数 × OpenCVのスレッド数がコア数に収まるように配分し、最速の候補を選ぶ"""
+    from thread_budget import ThreadBudget, candidate_budgets, choose_budget, parse_budget, split_budget
+    assert split_budget(32, 4) == ThreadBudget(4, 1, 8)
+    # 画像内のスレッドはコマのスレッド2個とページのスレッド2個
+    assert split_budget(32, 4, threads=2) == ThreadBudget(4, 2, 2)
+    assert split_budget(32, 4, threads=2).cores == 32
+    assert [b.workers for b in candidate_budgets(32, threads=2)] == [1, 2, 4, 8]
+    assert parse_budget("8", 32) == ThreadBudget(8, 1, 4)
+    assert parse_budget("3x2", 32) == ThreadBudget(3, 1, 2)
+    with pytest.raises(ValueError):
+        parse_budget("0x4", 32)
+    
+    candidates = candidate_budgets(32)
+    assert [b.workers for b in candidates] == [1, 2, 4, 8, 16, 32]
+    assert all(b.cores == 32 for b in candidates)
+    best, results = choose_budget(candidates, lambda b: 100.0 / abs(b.workers - 8.5))
+    assert best == ThreadBudget(8, 1, 4) and len(results) == len(candidates)
+    
+    # process_images は配分されたOpenCVのスレッド数を設定する
+    previous = cv2.getNumThreads()
+    try:
+        MangaProcessor(str(tmp_path), str(tmp_path / "out"), cv_threads=1, verbose=False).process_images()
+        assert cv2.getNumThreads() == 1
+    finally:
+        cv2.setNumThreads(previous)
+
+
+def test_shared_memory_transport(tmp_path, monkeypatch):
+    """共有メモリのリングで受け取ったレコードは pickle と同じで、例外時もセグメントを残さない"""
+    import os
+    from shm_transport import ShmRing, receive
+    
+    # リング: 末尾に収まらない配列は先頭に戻り、空きがなければ put() は None
+    with ShmRing.create(3500) as ring:
+        arrays = [np.full((20, 50), k, dtype=np.uint8) for k in range(3)]
+        handles = [ring.put(a) for a in arrays]
+        assert handles[2] is not None and ring.put(arrays[0]) is None and ring.fallbacks == 1
+        received = receive({ring.name: ring}, handles)
+        assert all(np.array_equal(received[h], a) for h, a in zip(handles, arrays))
+        wrapped = ring.put(np.zeros((30, 50), dtype=np.uint8))
+        assert wrapped is not None and wrapped.offset < handles[1].offset
+    assert not os.path.exists(f"/dev/shm/{ring.name}")
+    
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    page = make_synthetic_page()
+    for name in ("a", "b", "c"):
+        cv2.imwrite(str(input_dir / f"{name}.jpg"), np.hstack([page, page]))
+    
+    results = {}
+    for transport in ("pickle", "shm"):
+        processor = MangaProcessor(str(input_dir), str(tmp_path / transport), workers=2,
+                                   transport=transport, verbose=False)
+        panels, balloons = processor.process_images()
+        results[transport] = [p.image for p in panels] + [b.image for b in balloons]
+    assert len(results["shm"]) == len(results["pickle"]) > 0
+    assert all(np.array_equal(a, b) for a, b in zip(results["pickle"], results["shm"]))
+    
+    # 受け取り側で例外が起きてもリングは unlink される
+    created = []
+    original_create = ShmRing.create
+    monkeypatch.setattr(ShmRing, "create",
+                        classmethod(lambda cls, size: created.append(original_create(size)) or created[-1]))
+    processor = MangaProcessor(str(input_dir), str(tmp_path / "crash"), workers=2,
+                               transport="shm", verbose=False)
+    monkeypatch.setattr(processor, "_merge_stats", lambda *args: 1 / 0)
+    with pytest.raises(ZeroDivisionError):
+        processor.process_images()
+    assert len(created) == 2
+    assert not any(os.path.exists(f"/dev/shm/{ring.name.lstrip('/')}") for ring in created)
+
+
+def test_iter_process_streams_per_image_results(tmp_path):
+    """iter_process() は画像ごとに結果を返し、process_images() はそれを集めるだけ"""
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    page = make_synthetic_page()
+    for name in ("a", "b", "c"):
+        cv2.imwrite(str(input_dir / f"{name}.jpg"), np.hstack([page, page]))
+    
+    processor = MangaProcessor(str(input_dir), str(tmp_path / "stream"), writers=0, verbose=False)
+    stream = processor.iter_process()
+    first = next(stream)
+    # 1枚目の結果を受け取った時点では2枚目以降は未処理
+    written = {p.name[:3] for p in (tmp_path / "stream").rglob("*.png")}
+    assert written == {"000"}
+    assert first.index == 0 and first.path.endswith("a.jpg") and first.pages == 2
+    assert set(first.timings) == {"decode", "detect", "total"} and first.timings["total"] > 0
+    results = [first] + list(stream)
+    assert [r.index for r in results] == [0, 1, 2]
+    
+    panels, balloons = MangaProcessor(str(input_dir), str(tmp_path / "batch"),
+                                      verbose=False).process_images()
+    assert [p.bbox for p in panels] == [p.bbox for r in results for p in r.panels]
+    # 吹き出しの panel_idx は画像内の番号、process_images() では通し番号
+    offsets = np.cumsum([0] + [len(r.panels) for r in results])
+    assert [b.panel_idx for b in balloons] == [b.panel_idx + offsets[r.index]
+                                               for r in results for b in r.balloons]
+    
+    # プロセスプールでも途中で取得をやめられる
+    pooled = MangaProcessor(str(input_dir), str(tmp_path / "pool"), workers=2, verbose=False)
+    stream = pooled.iter_process()
+    assert next(stream).index == 0
+    stream.close()
+
+
+def test_prefetch_decoder_overlaps_reads(tmp_path, monkeypatch):
+    """先読みしても結果は同じで、読み込みの待ち時間が減る"""
+    import time
+    import manga_processor
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    page = make_synthetic_page()
+    for name in ("a", "b", "c", "d"):
+        cv2.imwrite(str(input_dir / f"{name}.jpg"), page)
+    
+    # 遅いディスクを模擬する（読み込みごとに0.2秒）
+    read_gray = manga_processor.read_gray
+    monkeypatch.setattr(manga_processor, "read_gray", lambda path: time.sleep(0.2) or read_gray(path))
+    
+    results = {}
+    for prefetch in (0, 2):
+        processor = MangaProcessor(str(input_dir), str(tmp_path / f"out{prefetch}"), prefetch=prefetch,
+                                   verbose=False)
+        results[prefetch] = list(processor.iter_process())
+    
+    serial, prefetched = results[0], results[2]
+    assert [[p.bbox for p in r.panels] for r in serial] == [[p.bbox for p in r.panels] for r in prefetched]
+    assert all(r.timings["decode"] >= 0.2 for r in serial)
+    # 2枚目以降は前の画像の処理中に読み込み済み
+    assert sum(r.timings["decode"] for r in prefetched[1:]) < sum(r.timings["decode"] for r in serial[1:])
+
+
+def test_crop_writer_backpressure_and_errors(tmp_path, monkeypatch):
+    """保存は上限つきの待ち行列で並行して行い、失敗は close() でまとめて報告する"""
+    import threading
+    import time
+    import crop_writer
+    from crop_writer import CropWriteError, CropWriter
+    crop = np.zeros((8, 8, 4), dtype=np.uint8)
+    
+    # 書き込みが遅いと submit() が待たされ、同時に待つ件数は max_pending まで
+    in_flight, peak = [0], [0]
+    lock = threading.Lock()
+    write_image = crop_writer.write_image
+    
+    def slow_write(path, image, params=()):
+        with lock:
+            in_flight[0] += 1
+            peak[0] = max(peak[0], in_flight[0])
+        time.sleep(0.02)
+        write_image(path, image, params)
+        with lock:
+            in_flight[0] -= 1
+    
+    monkeypatch.setattr(crop_writer, "write_image", slow_write)
+    with CropWriter(workers=2, max_pending=3) as writer:
+        for k in range(10):
+            writer.submit(tmp_path / f"{k}.png", crop)
+    assert writer.written == 10 and len(list(tmp_path.glob("*.png"))) == 10
+    assert peak[0] <= 2 and writer.blocked_seconds > 0
+    monkeypatch.setattr(crop_writer, "write_image", write_image)
+    
+    # 保存できなかったファイルは close() で報告される
+    writer = CropWriter(workers=2)
+    writer.submit(tmp_path / "ok.png", crop)
+    writer.submit(tmp_path / "missing" / "ng.png", crop)
+    with pytest.raises(CropWriteError) as excinfo:
+        writer.close()
+    assert [path for path, _ in excinfo.value.failures] == [str(tmp_path / "missing" / "ng.png")]
+    assert writer.written == 1
+    
+    # MangaProcessor の保存は非同期でも同期でも同じ
+    input_dir = tmp_path / "in"
+    input_dir.mkdir()
+    cv2.imwrite(str(input_dir / "a.jpg"), make_synthetic_page())
+    outputs = {}
+    for writers in (0, 4):
+        out = tmp_path / f"out{writers}"
+        processor = MangaProcessor(str(input_dir), str(out), writers=writers, verbose=False)
+        processor.process_images()
+        files = sorted(p.relative_to(out).as_posix() for p in out.rglob("*.png"))
+        outputs[writers] = [(f, cv2.imread(str(out / f), cv2.IMREAD_UNCHANGED)) for f in files]
+        assert processor.writer_stats["written"] == len(files) > 0
+    assert [f for f, _ in outputs[0]] == [f for f, _ in outputs[4]]
+    assert all(np.array_equal(a, b) for (_, a), (_, b) in zip(outputs[0], outputs[4]))
+
+
+def test_crop_write_error_from_worker_processes(tmp_path, spread_input_dir):
+    """保存の失敗は --workers N でも1プロセスの場合と同じ CropWriteError として報告される"""
+    import pickle
+    from crop_writer import CropWriteError
+    error = pickle.loads(pickle.dumps(CropWriteError([("a.png", OSError("disk full"))])))
+    assert error.failures == [("a.png", "disk full")] and "a.png (disk full)" in str(error)
+    
+    for workers in (1, 2):
+        out = tmp_path / f"out{workers}"
+        # 保存先にフォルダがあるとコマ画像を書き込めない
+        (out / "panels" / "000_0_0.png").mkdir(parents=True)
+        processor = MangaProcessor(str(spread_input_dir), str(out), workers=workers, verbose=False)
+        with pytest.raises(CropWriteError) as excinfo:
+            processor.process_images()
+        assert [path for path, _ in excinfo.value.failures] == [str(out / "panels" / "000_0_0.png")]
+
+
+def test_crop_formats_round_trip(tmp_path, spread_input_dir):
+    """どの保存形式でも、読み込んだ切り出し画像の見える画素は PNG と同じ"""
+    from crop_writer import CropFormat
+    input_dir = spread_input_dir
+    
+    def load_all(fmt):
+        out = tmp_path / fmt.replace(":", "_")
+        processor = MangaProcessor(str(input_dir), str(out), crop_format=fmt, verbose=False)
+        processor.process_images()
+        files = sorted(out.rglob("*.*"))
+        assert files and all(f.suffix == CropFormat.parse(fmt).suffix for f in files)
+        return {f.relative_to(out).with_suffix("").as_posix(): processor.load_crop(str(f)) for f in files}
+    
+    reference = load_all("png")
+    assert any(name.startswith("balloons/") for name in reference)
+    for fmt in ("png:9", "webp", "npy", "mask"):
+        crops = load_all(fmt)
+        assert crops.keys() == reference.keys()
+        for name, crop in crops.items():
+            expected = reference[name]
+            visible = expected[:, :, 3] > 0
+            assert crop.shape == expected.shape
+            assert np.array_equal(crop[:, :, 3], expected[:, :, 3])
+            assert np.array_equal(crop[visible], expected[visible])
+    
+    with pytest.raises(ValueError):
+        CropFormat.parse("png:10")
+
+
+def test_shard_output_random_access(tmp_path, spread_input_dir):
+    """シャード出力は1ファイルずつの出力と同じ画像を、展開せずにキーで読み出せる"""
+    import tarfile
+    from shard_archive import ShardReader, ShardWriter
+    input_dir = spread_input_dir
+    
+    files_out = tmp_path / "files"
+    MangaProcessor(str(input_dir), str(files_out), verbose=False).process_images()
+    files = {f.stem: f for f in files_out.rglob("*.png")}
+    assert any(len(key.split("_")) == 4 for key in files)
+    
+    # 小さな上限で複数のシャードに分かれ、プロセスプールでも同じ内容になる
+    for workers in (1, 2):
+        out = tmp_path / f"shards{workers}"
+        processor = MangaProcessor(str(input_dir), str(out), workers=workers,
+                                   shard_bytes=64 * 1024, verbose=False)
+        processor.process_images()
+        assert not any(out.rglob("*.png"))
+        shards = sorted(processor.shards_dir.glob("*.tar"))
+        assert len(shards) > 1
+        assert all(path.stat().st_size <= 64 * 1024 for path in shards)
+        with processor.open_shards() as reader:
+            assert sorted(reader.keys()) == sorted(files)
+            for key, path in files.items():
+                assert reader.name(key) == path.relative_to(files_out).as_posix()
+                assert np.array_equal(reader.read(key), processor.load_crop(str(path)))
+            # シャードは通常の tar として読め、索引の位置のデータはメンバーの内容と同じ
+            with tarfile.open(shards[0]) as tar:
+                for member in tar.getmembers():
+                    assert member.name.startswith(("panels/", "balloons/"))
+                    assert reader.read_bytes(member.name) == tar.extractfile(member).read()
+    
+    # 既存のシャードは上書きせず、同じキーは新しく書いた方を読み出す
+    shard_dir = tmp_path / "extra"
+    for data in (b"old", b"new"):
+        with ShardWriter(shard_dir, max_bytes=1024) as writer:
+            writer.add("panels/000_0_0.png", data)
+    assert len(list(shard_dir.glob("*.tar"))) == 2
+    with ShardReader(shard_dir) as reader:
+        assert reader.read_bytes("000_0_0") == b"new"
+    
+    # 終端・レコード単位の切り上げと、長い名前や非ASCIIの名前の拡張ヘッダを含めて上限を超えない
+    shard_dir = tmp_path / "capped"
+    with ShardWriter(shard_dir, max_bytes=4 * tarfile.RECORDSIZE) as writer:
+        for n in range(40):
+            name = f"balloons/{'長い名前' * 30 if n % 2 else 'x' * 120}_{n}.png"
+            writer.add(name, bytes(n * 100))
+    shards = sorted(shard_dir.glob("*.tar"))
+    assert len(shards) > 1
+    assert all(path.stat().st_size <= 4 * tarfile.RECORDSIZE for path in shards)
+    with ShardReader(shard_dir) as reader:
+        assert len(reader) == 40 and reader.read_bytes("x" * 120 + "_38") == bytes(3800)
+
+
+def test_balloon_atlas_matches_balloon_files(tmp_path, spread_input_dir):
+    """ページごとのアトラスから切り出した吹き出しは、1つずつ保存した吹き出し画像と同じ"""
+    from sprite_atlas import shelf_pack
+    input_dir = spread_input_dir
+    
+    files_out = tmp_path / "files"
+    MangaProcessor(str(input_dir), str(files_out), verbose=False).process_images()
+    expected = {f.stem: cv2.imread(str(f), cv2.IMREAD_UNCHANGED) for f in (files_out / "balloons").glob("*.png")}
+    assert expected
+    
+    for options in ({}, {"workers": 2}, {"shard_bytes": 2 ** 20}):
+        out = tmp_path / ("atlas_" + "_".join(options))
+        processor = MangaProcessor(str(input_dir), str(out), balloon_atlas=True, verbose=False, **options)
+        _, balloons = processor.process_images()
+        assert len(balloons) == len(expected)
+        crops = {}
+        shards = processor.open_shards() if "shard_bytes" in options else None
+        for i, j in sorted({tuple(int(v) for v in key.split("_")[:2]) for key in expected}):
+            atlas = processor.load_atlas(i, j, shards)
+            for key, crop in atlas.items():
+                assert crop.base is not None   # アトラス画像のビュー
+                crops[key] = crop
+        if shards is not None:
+            shards.close()
+        else:
+            assert not any((out / "balloons").glob("*_*_*_*.png"))
+        assert crops.keys() == expected.keys()
+        assert all(np.array_equal(crops[key], image) for key, image in expected.items())
+    
+    # 棚詰めした矩形は重ならず、アトラスに収まる
+    sizes = [(30, 10), (5, 40), (25, 25), (60, 5), (8, 8)]
+    positions, (width, height) = shelf_pack(sizes)
+    canvas = np.zeros((height, width), dtype=np.int32)
+    for (x, y), (w, h) in zip(positions, sizes):
+        canvas[y:y + h, x:x + w] += 1
+    assert canvas.max() == 1 and canvas.sum() == sum(w * h for w, h in sizes)
+
+
 if __name__ == "__main__":
     import sys
     
     if len(sys.argv) > 1 and sys.argv[1] == "debug":
         visualize_detection_steps()
     else:
-        test_single_image()
\ No newline at end of file
+        test_single_image()
@@ -0,0 +1,95 @@
+"""
+thread_budget.py
+================
+
+CPUコアを、パイプラインの並列数（ワーカープロセス数 × 画像内のスレッド数）と
+OpenCV内部のスレッド数（cv2.setNumThreads）に配分する
+画像内のスレッドは、threads > 1 の場合はコマのスレッド threads 個に加えてページのスレッド
+PAGE_THREADS 個が動く（MangaProcessor._thread_pools()）ので、その分も数える
+
+OpenCVは関数ごとに内部のスレッドプールで並列化するため、その外側でワーカーを
+増やすとコア数を超えるスレッドが動いてスループットが落ちる。
+パイプラインの並列数 × OpenCVのスレッド数がコア数に収まるように配分し、
+MangaProcessor の処理の開始時と各ワーカープロセスの起動時に apply() で設定する
+（cv2.setNumThreads はプロセス単位の設定なので、同じプロセス内のスレッドにも適用される）。
+auto の場合はサンプル画像で候補の配分ごとに処理速度を測って選ぶ。
+"""
+
+import os
+from dataclasses import dataclass
+from typing import Callable, List, Tuple
+
+import cv2
+
+# threads > 1 の場合に、コマのスレッドとは別に1枚の画像内のページを並列処理するスレッド数
+PAGE_THREADS = 2
+
+
+def available_cores() -> int:
+    """このプロセスが使えるCPUコア数"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+@dataclass(frozen=True)
+class ThreadBudget:
+    """ワーカープロセス数・画像内のスレッド数・OpenCVのスレッド数の配分"""
+    workers: int = 1
+    threads: int = 1
+    cv_threads: int = 1
+
+    @property
+    def pipeline_threads(self) -> int:
+        """1つのワーカープロセスで同時に動く画像内のスレッド数（コマのスレッドとページのスレッド）"""
+        return self.threads + PAGE_THREADS if self.threads > 1 else 1
+
+    @property
+    def cores(self) -> int:
+        """この配分で同時に動くスレッド数"""
+        return self.workers * self.pipeline_threads * self.cv_threads
+
+    def apply(self) -> None:
+        """このプロセスのOpenCVのスレッド数を設定する"""
+        cv2.setNumThreads(self.cv_threads)
+
+    def __str__(self) -> str:
+        return f"workers={self.workers} threads={self.threads} cv2_threads={self.cv_threads}"
+
+
+def split_budget(cores: int, workers: int = 1, threads: int = 1) -> ThreadBudget:
+    """パイプラインの並列数を決めて、残りのコアをOpenCVのスレッドに割り当てる"""
+    budget = ThreadBudget(max(int(workers), 1), max(int(threads), 1))
+    return ThreadBudget(budget.workers, budget.threads,
+                        max(cores // (budget.workers * budget.pipeline_threads), 1))
+
+
+def parse_budget(spec: str, cores: int, threads: int = 1) -> ThreadBudget:
+    """
+    "W"（ワーカー数、OpenCVのスレッドは残りのコア）または
+    "WxC"（ワーカー数 × OpenCVのスレッド数）を解釈する
+    """
+    parts = spec.lower().split("x")
+    if len(parts) > 2 or not all(p.isdigit() and int(p) > 0 for p in parts):
+        raise ValueError(f"invalid concurrency '{spec}' (expected auto, W or WxC)")
+    if len(parts) == 1:
+        return split_budget(cores, int(parts[0]), threads)
+    return ThreadBudget(int(parts[0]), max(int(threads), 1), int(parts[1]))
+
+
+def candidate_budgets(cores: int, threads: int = 1) -> List[ThreadBudget]:
+    """ワーカー数を1, 2, 4, ... とコア数まで増やした配分の候補"""
+    max_workers = max(cores // ThreadBudget(threads=max(threads, 1)).pipeline_threads, 1)
+    counts = sorted({min(2 ** p, max_workers) for p in range(max_workers.bit_length() + 1)})
+    return [split_budget(cores, n, threads) for n in counts]
+
+
+def choose_budget(candidates: List[ThreadBudget],
+                  measure: Callable[[ThreadBudget], float]) -> Tuple[ThreadBudget, List[Tuple[ThreadBudget, float]]]:
+    """
+    候補ごとに measure()（ページ/秒）を測り、最も速い配分を選ぶ
+    戻り値: (選んだ配分, [(候補, ページ/秒), ...])
+    """
+    results = [(budget, measure(budget)) for budget in candidates]
+    best = max(results, key=lambda r: r[1])[0]
+    return best, results